@@ -3,11 +3,13 @@
 """
 import os
 import logging
+import time
 from typing import AsyncGenerator
 
 from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine, async_sessionmaker
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy import MetaData
+from sqlalchemy import MetaData, text
+from sqlalchemy.pool import AsyncAdaptedQueuePool
 
 logger = logging.getLogger(__name__)
 
@@ -33,16 +35,125 @@ def get_database_url() -> str:
     return database_url
 
 
-# Создание асинхронного движка
+# Триггеры публикуют изменения api_keys и webkassa_tenants в каналы LISTEN/NOTIFY,
+# чтобы все воркеры получали ротацию токенов и правки реестра без опроса базы
+NOTIFY_TRIGGERS_DDL = [
+    """
+    CREATE OR REPLACE FUNCTION notify_api_key_change() RETURNS trigger AS $$
+    BEGIN
+        PERFORM pg_notify('webkassa_token', json_build_object(
+            'id', NEW.id,
+            'service_name', NEW.service_name,
+            'api_key', NEW.api_key,
+            'user_id', NEW.user_id,
+            'created_at', NEW.created_at,
+            'updated_at', NEW.updated_at
+        )::text);
+        RETURN NEW;
+    END;
+    $$ LANGUAGE plpgsql
+    """,
+    """
+    CREATE OR REPLACE TRIGGER api_keys_notify
+    AFTER INSERT OR UPDATE ON api_keys
+    FOR EACH ROW EXECUTE FUNCTION notify_api_key_change()
+    """,
+    """
+    CREATE OR REPLACE FUNCTION notify_tenant_change() RETURNS trigger AS $$
+    BEGIN
+        IF TG_OP = 'DELETE' THEN
+            PERFORM pg_notify('webkassa_tenant', OLD.company_id::text);
+        ELSE
+            PERFORM pg_notify('webkassa_tenant', NEW.company_id::text);
+        END IF;
+        RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql
+    """,
+    """
+    CREATE OR REPLACE TRIGGER webkassa_tenants_notify
+    AFTER INSERT OR UPDATE OR DELETE ON webkassa_tenants
+    FOR EACH ROW EXECUTE FUNCTION notify_tenant_change()
+    """,
+]
+
+
+class PoolStats:
+    """Счетчики ожидания соединения из пула (для подбора размера пула по данным)"""
+
+    def __init__(self):
+        self.checkouts = 0
+        self.wait_seconds_total = 0.0
+        self.wait_seconds_max = 0.0
+        self.slow_checkouts = 0
+        self.slow_threshold = float(os.getenv("DB_POOL_SLOW_CHECKOUT", "0.1"))
+
+    def record_wait(self, seconds: float):
+        self.checkouts += 1
+        self.wait_seconds_total += seconds
+        self.wait_seconds_max = max(self.wait_seconds_max, seconds)
+        if seconds >= self.slow_threshold:
+            self.slow_checkouts += 1
+
+
+pool_stats = PoolStats()
+
+
+class InstrumentedPool(AsyncAdaptedQueuePool):
+    """Пул, замеряющий время ожидания свободного соединения"""
+
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            pool_stats.record_wait(time.perf_counter() - started)
+
+
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "10"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "20"))
+
+# Создание асинхронного движка.
+# Соединения пересоздаются раньше, чем их закроет сервер или прокси (DB_POOL_RECYCLE),
+# а pool_pre_ping проверяет соединение перед выдачей: после перезапуска или
+# переключения Postgres оборванные соединения пула заменяются без ошибки в webhook
+# клиента. DB_POOL_PRE_PING=False убирает этот запрос, если сбой одного запроса допустим.
 engine = create_async_engine(
     get_database_url(),
     echo=os.getenv("DEBUG", "False").lower() == "true",  # Логирование SQL запросов в debug режиме
-    pool_size=10,
-    max_overflow=20,
-    pool_pre_ping=True,  # Проверка соединения перед использованием
-    pool_recycle=3600,   # Переподключение каждый час
+    poolclass=InstrumentedPool,
+    pool_size=DB_POOL_SIZE,
+    max_overflow=DB_MAX_OVERFLOW,
+    pool_timeout=float(os.getenv("DB_POOL_TIMEOUT", "30")),
+    pool_pre_ping=os.getenv("DB_POOL_PRE_PING", "True").lower() == "true",
+    pool_recycle=int(os.getenv("DB_POOL_RECYCLE", "1800")),
+    pool_use_lifo=True,  # Редко используемые соединения простаивают и пересоздаются по recycle
+    connect_args={
+        # Кэш подготовленных выражений asyncpg на соединение: горячие запросы
+        # (upsert webhook, обновление статуса) не разбираются сервером заново.
+        # 0 - для PgBouncer в режиме transaction
+        "prepared_statement_cache_size": int(os.getenv("DB_STATEMENT_CACHE_SIZE", "500")),
+    },
 )
 
+
+def get_pool_stats() -> dict:
+    """Текущее состояние пула соединений и накопленное время ожидания"""
+    pool = engine.sync_engine.pool
+    checkouts = pool_stats.checkouts
+    return {
+        "size": pool.size(),
+        "in_use": pool.checkedout(),
+        "idle": pool.checkedin(),
+        "overflow": max(pool.overflow(), 0),
+        "max_overflow": DB_MAX_OVERFLOW,
+        "checkouts": checkouts,
+        "wait_ms_avg": round(pool_stats.wait_seconds_total / checkouts * 1000, 3) if checkouts else 0,
+        "wait_ms_max": round(pool_stats.wait_seconds_max * 1000, 3),
+        "slow_checkouts": pool_stats.slow_checkouts,
+        "slow_checkout_threshold_ms": pool_stats.slow_threshold * 1000,
+    }
+
 # Создание фабрики сессий
 AsyncSessionLocal = async_sessionmaker(
     engine,
@@ -79,10 +190,25 @@ async def create_tables():
         from app.models import WebhookRecord  # noqa
         
         async with engine.begin() as conn:
+            # Сериализуем DDL между воркерами, стартующими одновременно
+            await conn.execute(text("SELECT pg_advisory_xact_lock(hashtext('create_tables'))"))
+            
+            # Сначала переводим уже существующие таблицы, затем создаем недостающие
+            from app.migrations import run_migrations
+            await run_migrations(conn)
+            
             # Создаем все таблицы
             await conn.run_sync(Base.metadata.create_all)
             logger.info("Database tables created successfully")
             
+            # Помесячные секции webhook_records / webhook_payloads
+            from app.services.retention import ensure_partitions
+            await ensure_partitions(conn)
+            
+            for statement in NOTIFY_TRIGGERS_DDL:
+                await conn.execute(text(statement))
+            logger.info("Notification triggers installed")
+            
     except Exception as e:
         logger.error(f"Error creating database tables: {str(e)}")
         raise
@@ -108,8 +234,8 @@ async def check_database_connection():
     """
     try:
         async with AsyncSessionLocal() as session:
-            result = await session.execute("SELECT 1")
-            logger.info("Database connection successful")
+            await session.execute(text("SELECT 1"))
+            logger.debug("Database connection successful")
             return True
             
     except Exception as e:
@@ -0,0 +1,398 @@
+"""
+Настройка логирования: запись в файл и консоль в фоновом потоке.
+
+Корневой логгер пишет только в QueueHandler (постановка в очередь без ввода-вывода),
+а QueueListener в отдельном потоке форматирует записи и пишет их в файл (JSON-строки)
+и в консоль (текст). Контекст обработки webhook (resource_id, company_id, stage)
+привязывается один раз через contextvars и попадает в каждую запись.
+
+Файл ротируется по размеру и по суткам; ротированные копии сжимаются в своем потоке
+и хранятся в количестве LOG_BACKUP_COUNT.
+"""
+import copy
+import gzip
+import json
+import logging
+import os
+import queue
+import random
+import shutil
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime, timedelta
+from logging.handlers import BaseRotatingHandler, QueueHandler, QueueListener
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+from app.logtools import ROTATED_NAME_RE, ROTATED_TIME_FORMAT, line_time, rotated_order
+
+# Поля текущего webhook/этапа - свои у каждой asyncio-задачи
+_log_context: ContextVar[Dict[str, Any]] = ContextVar("log_context", default={})
+
+_listener: Optional[QueueListener] = None
+
+# Крупные данные (payload webhook, запросы и ответы Webkassa) в логах
+PAYLOAD_MAX_CHARS = int(os.getenv("LOG_PAYLOAD_MAX_CHARS", "2000"))
+# Доля записей INFO с payload, которые попадают в лог (по умолчанию все); WARNING и выше пишутся всегда
+PAYLOAD_SAMPLE_RATE = float(os.getenv("LOG_PAYLOAD_SAMPLE_RATE", "1.0"))
+# Сколько секунд ротированная копия должна не меняться перед сжатием
+COMPRESS_SETTLE_SECONDS = float(os.getenv("LOG_COMPRESS_SETTLE_SECONDS", "1"))
+
+
+def get_log_context() -> Dict[str, Any]:
+    return _log_context.get()
+
+
+@contextmanager
+def log_context(**values):
+    """Добавляет поля ко всем записям внутри блока (и во вложенных await)"""
+    token = _log_context.set({**_log_context.get(), **values})
+    try:
+        yield
+    finally:
+        _log_context.reset(token)
+
+
+class LazyJson:
+    """
+    JSON-представление данных, которое строится только при выводе записи
+    и один раз (повторный str() берет готовую строку). limit обрезает результат.
+    """
+
+    def __init__(self, data: Any, limit: Optional[int] = PAYLOAD_MAX_CHARS, indent: Optional[int] = None):
+        self.data = data
+        self.limit = limit
+        self.indent = indent
+        self._text: Optional[str] = None
+
+    def __str__(self) -> str:
+        if self._text is None:
+            try:
+                text = json.dumps(self.data, ensure_ascii=False, indent=self.indent, default=str)
+            except Exception:
+                text = str(self.data)
+            if self.limit and len(text) > self.limit:
+                text = f"{text[:self.limit]}... [{len(text)} chars]"
+            self._text = text
+        return self._text
+
+
+def log_payload(logger: logging.Logger, label: str, data: Any, level: int = logging.INFO):
+    """
+    Пишет крупные данные в лог, только если уровень включен.
+    INFO-записи обрезаются до LOG_PAYLOAD_MAX_CHARS и при LOG_PAYLOAD_SAMPLE_RATE < 1 пишутся выборочно;
+    при LOG_LEVEL=DEBUG данные пишутся всегда, целиком и с отступами.
+    """
+    if not logger.isEnabledFor(level):
+        return
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.log(level, "%s: %s", label, LazyJson(data, limit=None, indent=2))
+        return
+    if level < logging.WARNING and random.random() >= PAYLOAD_SAMPLE_RATE:
+        return
+    logger.log(level, "%s: %s", label, LazyJson(data))
+
+
+class ContextFilter(logging.Filter):
+    """Копирует контекст в запись в потоке, который логирует (до постановки в очередь)"""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.context = _log_context.get()
+        return True
+
+
+class ContextQueueHandler(QueueHandler):
+    """
+    QueueHandler, который не форматирует запись в вызывающем потоке:
+    подставляет аргументы в сообщение и превращает исключение в текст,
+    остальное делают обработчики слушателя.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+class JsonFormatter(logging.Formatter):
+    """Одна JSON-строка на запись"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": datetime.fromtimestamp(record.created).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+            **getattr(record, "context", {}),
+        }
+        if record.exc_text:
+            entry["exception"] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class TextFormatter(logging.Formatter):
+    """Прежний текстовый формат для консоли, с полями контекста в конце"""
+
+    def __init__(self):
+        super().__init__('%(asctime)s - %(name)s - %(levelname)s - %(message)s', datefmt='%Y-%m-%d %H:%M:%S')
+
+    def format(self, record: logging.LogRecord) -> str:
+        formatted = super().format(record)
+        context = getattr(record, "context", None)
+        if context:
+            formatted += " [" + " ".join(f"{key}={value}" for key, value in context.items()) + "]"
+        return formatted
+
+
+class CompressingRotatingFileHandler(BaseRotatingHandler):
+    """
+    Файловый обработчик с ротацией при превышении max_bytes и при смене суток.
+    Текущий файл переименовывается в <имя>.<начало>-<конец>, сжатие в .gz и удаление
+    копий сверх backup_count выполняет отдельный поток, не задерживая запись логов.
+
+    В один файл могут писать несколько процессов (воркеры, скрипт обновления токена):
+    как WatchedFileHandler, обработчик перед каждой записью сверяет inode открытого файла
+    с файлом по пути и переоткрывает его, если файл ротировал другой процесс.
+    """
+
+    def __init__(self, filename: str, max_bytes: int = 0, daily: bool = True, backup_count: int = 14,
+                 compress: bool = True, encoding: str = "utf-8"):
+        # (st_dev, st_ino) открытого файла; заполняет _open
+        self._file_id: Optional[Tuple[int, int]] = None
+        super().__init__(filename, "a", encoding=encoding)
+        self.max_bytes = max_bytes
+        self.daily = daily
+        self.backup_count = backup_count
+        self.compress = compress
+        self._compress_queue: "queue.SimpleQueue[Optional[str]]" = queue.SimpleQueue()
+        self._compressor: Optional[threading.Thread] = None
+        # Уже записанный файл относится к сроку своей первой записи: короткоживущий
+        # процесс (скрипт по cron) тоже ротирует файл, начатый в прошлые сутки
+        self.opened_at = self._first_record_time()
+        self.rollover_at = self._next_midnight(self.opened_at or time.time())
+        # Копии, которые не успели сжать до перезапуска
+        for leftover in self._rotated_files():
+            if compress and leftover.suffix != ".gz":
+                self._schedule(str(leftover))
+
+    def _first_record_time(self) -> Optional[float]:
+        """Время первой записи уже существующего файла (None - файл пуст)"""
+        try:
+            with open(self.baseFilename, "rb") as stream:
+                first_line = stream.readline(4096)
+        except OSError:
+            return None
+        if not first_line:
+            return None
+        first_time = line_time(first_line)
+        return first_time.timestamp() if first_time else os.path.getmtime(self.baseFilename)
+
+    @staticmethod
+    def _next_midnight(moment: float) -> float:
+        day = datetime.fromtimestamp(moment).replace(hour=0, minute=0, second=0, microsecond=0)
+        return (day + timedelta(days=1)).timestamp()
+
+    def shouldRollover(self, record: logging.LogRecord) -> bool:
+        if self.daily and record.created >= self.rollover_at:
+            return True
+        if self.max_bytes > 0:
+            if self.stream is None:
+                self.stream = self._open()
+            message = f"{self.format(record)}\n"
+            if self.stream.tell() + len(message) >= self.max_bytes:
+                return True
+        return False
+
+    def _open(self):
+        stream = super()._open()
+        stat = os.fstat(stream.fileno())
+        self._file_id = (stat.st_dev, stat.st_ino)
+        return stream
+
+    def _moved(self) -> bool:
+        """Открытый файл уже не лежит по пути baseFilename (его ротировал другой процесс)"""
+        try:
+            stat = os.stat(self.baseFilename)
+        except FileNotFoundError:
+            return True
+        return (stat.st_dev, stat.st_ino) != self._file_id
+
+    def _reopen(self):
+        if self.stream:
+            self.stream.close()
+        self.stream = self._open()
+        self.opened_at = self._first_record_time()
+        self.rollover_at = self._next_midnight(self.opened_at or time.time())
+
+    def emit(self, record: logging.LogRecord):
+        if self.stream is not None and self._moved():
+            self._reopen()
+        super().emit(record)
+        # Начало нового файла - время его первой записи (записи приходят из очереди с задержкой)
+        if self.opened_at is None:
+            self.opened_at = record.created
+
+    def doRollover(self):
+        if self.stream:
+            self.stream.close()
+            self.stream = None
+        now = time.time()
+        # Другой процесс уже ротировал наш файл: по пути лежит его новый файл, его не трогаем
+        if not self._moved() and os.path.getsize(self.baseFilename) > 0:
+            rotated = self._rotated_name(self.opened_at or now, now)
+            try:
+                os.rename(self.baseFilename, rotated)
+            except FileNotFoundError:
+                # Файл уже ротировал другой процесс
+                rotated = None
+            if rotated and self.compress:
+                self._schedule(rotated)
+            elif rotated:
+                self._apply_retention()
+        self.opened_at: Optional[float] = None
+        self.rollover_at = self._next_midnight(now)
+        self.stream = self._open()
+
+    def _rotated_name(self, started: float, ended: float) -> str:
+        name = (f"{self.baseFilename}.{datetime.fromtimestamp(started):{ROTATED_TIME_FORMAT}}"
+                f"-{datetime.fromtimestamp(ended):{ROTATED_TIME_FORMAT}}")
+        candidate, index = name, 1
+        while os.path.exists(candidate) or os.path.exists(candidate + ".gz"):
+            candidate = f"{name}.{index}"
+            index += 1
+        return candidate
+
+    def _rotated_files(self) -> List[Path]:
+        base = Path(self.baseFilename)
+        return sorted(
+            (candidate for candidate in base.parent.glob(base.name + ".*")
+             if ROTATED_NAME_RE.search(candidate.name) and not candidate.name.endswith(".tmp")),
+            key=rotated_order,
+        )
+
+    def _schedule(self, path: str):
+        if self._compressor is None:
+            self._compressor = threading.Thread(target=self._compress_loop, name="log-compressor", daemon=True)
+            self._compressor.start()
+        self._compress_queue.put(path)
+
+    def _compress_loop(self):
+        while True:
+            path = self._compress_queue.get()
+            if path is None:
+                break
+            try:
+                self._wait_settled(path)
+                with open(path, "rb") as source, gzip.open(path + ".gz.tmp", "wb", compresslevel=6) as target:
+                    shutil.copyfileobj(source, target, 1024 * 1024)
+                os.replace(path + ".gz.tmp", path + ".gz")
+                os.remove(path)
+            except FileNotFoundError:
+                # Копия уже удалена по количеству хранимых, пока ждала сжатия
+                pass
+            except OSError as e:
+                sys.stderr.write(f"Failed to compress rotated log {path}: {e}\n")
+                if os.path.exists(path + ".gz.tmp"):
+                    os.remove(path + ".gz.tmp")
+            self._apply_retention()
+
+    @staticmethod
+    def _wait_settled(path: str):
+        """Ждет, пока в копию допишут процессы, еще не заметившие ротацию"""
+        while True:
+            age = time.time() - os.path.getmtime(path)
+            if age >= COMPRESS_SETTLE_SECONDS:
+                return
+            time.sleep(COMPRESS_SETTLE_SECONDS - age)
+
+    def _apply_retention(self):
+        if self.backup_count <= 0:
+            return
+        for old in self._rotated_files()[:-self.backup_count]:
+            try:
+                old.unlink()
+            except OSError:
+                pass
+
+    def close(self):
+        """Закрывает файл и дожидается сжатия уже ротированных копий"""
+        super().close()
+        compressor, self._compressor = self._compressor, None
+        if compressor:
+            self._compress_queue.put(None)
+            compressor.join(timeout=30)
+
+
+def rotating_file_handler(log_file: str, max_bytes: Optional[int] = None) -> CompressingRotatingFileHandler:
+    """Обработчик файла лога с параметрами ротации из окружения"""
+    Path(log_file).parent.mkdir(parents=True, exist_ok=True)
+    return CompressingRotatingFileHandler(
+        log_file,
+        max_bytes=int(os.getenv("LOG_MAX_BYTES", str(100 * 1024 * 1024))) if max_bytes is None else max_bytes,
+        daily=os.getenv("LOG_ROTATE_DAILY", "True").lower() == "true",
+        backup_count=int(os.getenv("LOG_BACKUP_COUNT", "14")),
+        compress=os.getenv("LOG_COMPRESS", "True").lower() == "true",
+    )
+
+
+def setup_logging() -> logging.Logger:
+    """Настройка логирования в файл (JSON) и консоль через фоновый поток"""
+    global _listener
+    stop_logging()
+
+    log_level = getattr(logging, os.getenv("LOG_LEVEL", "INFO").upper())
+    log_file = os.getenv("LOG_FILE", "logs/errors.log")
+
+    # Ротация по размеру (LOG_MAX_BYTES) и по суткам, копии сжимаются в фоне
+    file_handler = rotating_file_handler(log_file)
+    file_handler.setFormatter(JsonFormatter())
+    file_handler.setLevel(log_level)
+
+    console_handler = logging.StreamHandler(sys.stdout)
+    if os.getenv("LOG_CONSOLE_FORMAT", "text").lower() == "json":
+        console_handler.setFormatter(JsonFormatter())
+    else:
+        console_handler.setFormatter(TextFormatter())
+    console_handler.setLevel(log_level)
+
+    # Очередь без ограничения: логирование никогда не блокирует цикл событий
+    log_queue: queue.Queue = queue.SimpleQueue()
+    queue_handler = ContextQueueHandler(log_queue)
+    queue_handler.addFilter(ContextFilter())
+
+    # Удаляем старые handlers если есть
+    root_logger = logging.getLogger()
+    for handler in root_logger.handlers[:]:
+        root_logger.removeHandler(handler)
+    root_logger.setLevel(log_level)
+    root_logger.addHandler(queue_handler)
+
+    _listener = QueueListener(log_queue, file_handler, console_handler, respect_handler_level=True)
+    _listener.start()
+
+    # Отключаем слишком подробные логи от сторонних библиотек
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+    logging.getLogger("sqlalchemy.engine").setLevel(logging.WARNING)
+    logging.getLogger("uvicorn.access").setLevel(logging.WARNING)
+
+    # Тестовое сообщение для проверки кодировки
+    root_logger.info("🚀 Логирование настроено. Тест Unicode: фч тест кириллицы")
+
+    return root_logger
+
+
+def stop_logging():
+    """Дописывает очередь и останавливает фоновый поток (при завершении приложения)"""
+    global _listener
+    if _listener:
+        _listener.stop()
+        for handler in _listener.handlers:
+            handler.close()
+        _listener = None
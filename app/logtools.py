@@ -0,0 +1,413 @@
+"""
+Просмотр и поиск по логам без чтения файлов целиком.
+
+Последние строки читаются с конца файла (mmap и поиск перевода строки назад), поэтому
+хвост гигабайтного лога показывается сразу. Поиск идет потоком по строкам: сначала
+ротированные файлы (в том числе сжатые .gz), затем текущий. Понимает оба формата:
+JSON-строки приложения (app/logging_config.py) и прежний текстовый формат
+"дата - логгер - УРОВЕНЬ - сообщение".
+
+    python -m app.logtools tail -n 50 --level ERROR
+    python -m app.logtools search "Webkassa" --since 2h --resource-id 123456
+    python -m app.logtools search --since "2025-03-01 09:00" --until "2025-03-01 10:00" --json
+"""
+import argparse
+import collections
+import gzip
+import json
+import mmap
+import re
+import sys
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+DEFAULT_LOG_FILE = "logs/errors.log"
+
+LEVELS = {"DEBUG": 10, "INFO": 20, "WARNING": 30, "ERROR": 40, "CRITICAL": 50}
+
+TEXT_LINE_RE = re.compile(
+    r"^(\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2})(?:[,.]\d+)? - (?:(\S+) - )?"
+    r"(DEBUG|INFO|WARNING|ERROR|CRITICAL) - (.*)$"
+)
+TEXT_TIME_RE = re.compile(rb"^\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2}")
+JSON_TIME_PREFIX = b'{"time": "'
+RELATIVE_TIME_RE = re.compile(r"^(\d+(?:\.\d+)?)([smhd])$")
+# Ротированная копия: <имя>.<начало>-<конец>[.N][.gz], время локальное, как в записях
+ROTATED_TIME_FORMAT = "%Y%m%dT%H%M%S"
+ROTATED_NAME_RE = re.compile(r"\.(\d{8}T\d{6})-(\d{8}T\d{6})(?:\.(\d+))?(?:\.gz)?$")
+_UNITS = {"s": "seconds", "m": "minutes", "h": "hours", "d": "days"}
+
+
+class LogEntry:
+    """Разобранная строка лога; строки в неизвестном формате - только raw"""
+
+    __slots__ = ("raw", "time", "level", "logger", "message", "context", "exception")
+
+    def __init__(self, raw: str, time: Optional[datetime] = None, level: Optional[str] = None,
+                 logger: Optional[str] = None, message: Optional[str] = None,
+                 context: Optional[Dict[str, Any]] = None, exception: Optional[str] = None):
+        self.raw = raw
+        self.time = time
+        self.level = level
+        self.logger = logger
+        self.message = raw if message is None else message
+        self.context = context or {}
+        self.exception = exception
+
+
+def parse_line(line: bytes) -> LogEntry:
+    raw = line.decode("utf-8", errors="replace").rstrip("\r\n")
+    if raw.startswith("{"):
+        try:
+            data = json.loads(raw)
+        except ValueError:
+            data = None
+        if isinstance(data, dict):
+            time = data.pop("time", None)
+            try:
+                time = datetime.fromisoformat(time) if time else None
+            except (TypeError, ValueError):
+                time = None
+            return LogEntry(
+                raw, time, data.pop("level", None), data.pop("logger", None),
+                str(data.pop("message", "")), exception=data.pop("exception", None), context=data,
+            )
+    match = TEXT_LINE_RE.match(raw)
+    if match:
+        return LogEntry(
+            raw, datetime.strptime(match.group(1), "%Y-%m-%d %H:%M:%S"),
+            match.group(3), match.group(2), match.group(4),
+        )
+    return LogEntry(raw)
+
+
+def line_time(line: bytes) -> Optional[datetime]:
+    """Время записи без разбора всей строки (поле time идет в JSON-строке первым)"""
+    try:
+        if line.startswith(JSON_TIME_PREFIX):
+            end = line.find(b'"', len(JSON_TIME_PREFIX))
+            return datetime.fromisoformat(line[len(JSON_TIME_PREFIX):end].decode())
+        if TEXT_TIME_RE.match(line):
+            return datetime.strptime(line[:19].decode(), "%Y-%m-%d %H:%M:%S")
+    except ValueError:
+        pass
+    return None
+
+
+def parse_time(value: str, now: Optional[datetime] = None) -> datetime:
+    """ISO-дата/время или относительное время назад: 30m, 2h, 1d"""
+    match = RELATIVE_TIME_RE.match(value.strip())
+    if match:
+        return (now or datetime.now()) - timedelta(**{_UNITS[match.group(2)]: float(match.group(1))})
+    return datetime.fromisoformat(value.strip())
+
+
+class LogFilter:
+    """Условия отбора строк; дешевая проверка по байтам идет до разбора JSON"""
+
+    def __init__(self, level: Optional[str] = None, since: Optional[datetime] = None,
+                 until: Optional[datetime] = None, resource_id: Optional[str] = None,
+                 text: Optional[str] = None):
+        self.min_level = LEVELS[level.upper()] if level else None
+        self.since = since
+        self.until = until
+        self.resource_id = str(resource_id) if resource_id is not None else None
+        self.text = text.lower() if text else None
+        self._resource_bytes = self.resource_id.encode() if self.resource_id else None
+        self._text_bytes = self.text.encode() if self.text else None
+
+    def prefilter(self, line: bytes) -> bool:
+        if self._resource_bytes and self._resource_bytes not in line:
+            return False
+        if self._text_bytes and self._text_bytes not in line.lower():
+            return False
+        return True
+
+    def match(self, entry: LogEntry) -> bool:
+        if self.min_level is not None and LEVELS.get(entry.level or "", 0) < self.min_level:
+            return False
+        if self.since or self.until:
+            if entry.time is None:
+                return False
+            if self.since and entry.time < self.since:
+                return False
+            if self.until and entry.time > self.until:
+                return False
+        if self.resource_id is not None:
+            if entry.context:
+                if str(entry.context.get("resource_id")) != self.resource_id:
+                    return False
+            elif not re.search(rf"\b{re.escape(self.resource_id)}\b", entry.raw):
+                return False
+        if self.text and self.text not in entry.raw.lower():
+            return False
+        return True
+
+
+def rotated_time_range(path: Path) -> Optional[Tuple[datetime, datetime]]:
+    """Время первой и последней записи ротированной копии по ее имени"""
+    match = ROTATED_NAME_RE.search(path.name)
+    if not match:
+        return None
+    return datetime.strptime(match.group(1), ROTATED_TIME_FORMAT), datetime.strptime(match.group(2), ROTATED_TIME_FORMAT)
+
+
+def rotated_order(path: Path) -> Tuple[datetime, datetime, int]:
+    """Ключ сортировки копий от старых к новым (.N - копии, ротированные в ту же секунду)"""
+    match = ROTATED_NAME_RE.search(path.name)
+    if not match:
+        modified = datetime.fromtimestamp(path.stat().st_mtime)
+        return modified, modified, 0
+    started, ended = rotated_time_range(path)
+    return started, ended, int(match.group(3) or 0)
+
+
+def log_files(path: str, include_rotated: bool = True) -> List[Path]:
+    """
+    Текущий лог и его ротированные копии (errors.log.<начало>-<конец>.gz, а также
+    прежние errors.log.1, ...), от старых к новым
+    """
+    current = Path(path)
+    files = []
+    if include_rotated:
+        rotated = [
+            candidate for candidate in current.parent.glob(current.name + ".*")
+            if candidate.is_file() and not candidate.name.endswith(".tmp")
+        ]
+        files.extend(sorted(rotated, key=rotated_order))
+    if current.is_file():
+        files.append(current)
+    return files
+
+
+def _timed_line_at(mapped: mmap.mmap, start: int, limit: int) -> Optional[Tuple[int, int, datetime]]:
+    """Первая строка со временем, начинающаяся в [start, limit): (начало, конец, время)"""
+    while start < limit:
+        end = mapped.find(b"\n", start)
+        end = len(mapped) if end < 0 else end
+        time = line_time(mapped[start:end])
+        if time is not None:
+            return start, end, time
+        start = end + 1
+    return None
+
+
+def _offset_for_time(mapped: mmap.mmap, moment: datetime) -> int:
+    """
+    Смещение первой строки со временем не раньше moment - двоичный поиск по файлу,
+    записи в котором идут по времени. Строки без времени (traceback, многострочные
+    сообщения) продолжают предыдущую запись: проба, попавшая на такую строку, сравнивает
+    ближайшую следующую строку со временем, и результат всегда - начало строки со временем.
+    """
+    low, high = 0, len(mapped)
+    while low < high:
+        middle = (low + high) // 2
+        newline = mapped.rfind(b"\n", low, middle)
+        start = newline + 1 if newline >= 0 else low
+        timed = _timed_line_at(mapped, start, high)
+        if timed is None:
+            # От start до high только продолжения записей - граница не дальше start
+            high = start
+            continue
+        start, end, time = timed
+        if time >= moment:
+            high = start
+        else:
+            low = end + 1
+    # Продолжения более ранней записи пропускаем до следующей строки со временем
+    timed = _timed_line_at(mapped, low, len(mapped))
+    return timed[0] if timed else len(mapped)
+
+
+def _lines_containing(mapped: mmap.mmap, position: int, needle: bytes) -> Iterator[bytes]:
+    """Только строки с needle: поиск по отображению переходит от вхождения к вхождению"""
+    while True:
+        hit = mapped.find(needle, position)
+        if hit < 0:
+            return
+        start = mapped.rfind(b"\n", position, hit) + 1 or position
+        end = mapped.find(b"\n", hit)
+        end = len(mapped) if end < 0 else end + 1
+        yield mapped[start:end]
+        position = end
+
+
+def _forward_lines(path: Path, since: Optional[datetime] = None, needle: Optional[bytes] = None) -> Iterator[bytes]:
+    if path.suffix == ".gz":
+        with gzip.open(path, "rb") as stream:
+            yield from stream
+        return
+    with open(path, "rb") as stream:
+        if not path.stat().st_size:
+            return
+        with mmap.mmap(stream.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            position = _offset_for_time(mapped, since) if since else 0
+            if needle:
+                yield from _lines_containing(mapped, position, needle)
+            else:
+                mapped.seek(position)
+                yield from iter(mapped.readline, b"")
+
+
+def _reverse_lines(path: Path, until: Optional[datetime] = None) -> Iterator[bytes]:
+    """Строки файла от последней к первой: поиск перевода строки назад по отображению в память"""
+    with open(path, "rb") as stream:
+        if not path.stat().st_size:
+            return
+        with mmap.mmap(stream.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            # Строки новее until пропускаются сразу, без чтения
+            end = _offset_for_time(mapped, until + timedelta(microseconds=1)) if until else len(mapped)
+            if mapped[end - 1:end] == b"\n":
+                end -= 1
+            while end > 0:
+                start = mapped.rfind(b"\n", 0, end) + 1
+                yield mapped[start:end]
+                end = start - 1
+
+
+def _matching(lines: Iterator[bytes], log_filter: LogFilter) -> Iterator[LogEntry]:
+    for line in lines:
+        if not line.strip():
+            continue
+        if log_filter.since or log_filter.until:
+            time = line_time(line)
+            if time is not None:
+                # Записи идут по времени: после конца окна подходящих строк уже не будет
+                if log_filter.until and time > log_filter.until:
+                    return
+                if log_filter.since and time < log_filter.since:
+                    continue
+        if log_filter.prefilter(line):
+            entry = parse_line(line)
+            if log_filter.match(entry):
+                yield entry
+
+
+def _in_window(file: Path, log_filter: LogFilter) -> bool:
+    time_range = rotated_time_range(file)
+    if time_range:
+        # Диапазон записей копии известен по имени - файл не открывается вовсе
+        started, ended = time_range
+        return not ((log_filter.since and ended < log_filter.since.replace(microsecond=0))
+                    or (log_filter.until and started > log_filter.until))
+    # Файл, последний раз дописанный до начала окна, подходящих записей не содержит
+    return not (log_filter.since and file.stat().st_mtime < log_filter.since.timestamp())
+
+
+def _files_in_window(path: str, log_filter: LogFilter, include_rotated: bool) -> List[Path]:
+    return [file for file in log_files(path, include_rotated) if _in_window(file, log_filter)]
+
+
+def search(path: str = DEFAULT_LOG_FILE, log_filter: Optional[LogFilter] = None,
+           include_rotated: bool = True) -> Iterator[LogEntry]:
+    """Все подходящие строки по порядку, потоком"""
+    log_filter = log_filter or LogFilter()
+    for file in _files_in_window(path, log_filter, include_rotated):
+        lines = _forward_lines(file, log_filter.since, log_filter.resource_id and log_filter.resource_id.encode())
+        yield from _matching(lines, log_filter)
+
+
+def tail(path: str = DEFAULT_LOG_FILE, count: int = 50, log_filter: Optional[LogFilter] = None,
+         include_rotated: bool = True) -> List[LogEntry]:
+    """
+    Последние count подходящих строк (в хронологическом порядке). Файлы читаются с
+    конца; чтение прекращается, как только набрано count строк или встречена
+    строка старше начала окна since.
+    """
+    log_filter = log_filter or LogFilter()
+    found: List[LogEntry] = []
+    for file in reversed(_files_in_window(path, log_filter, include_rotated)):
+        if file.suffix == ".gz":
+            # Сжатый файл читается только вперед: держим в памяти не больше count строк
+            matched = collections.deque(_matching(_forward_lines(file), log_filter), maxlen=count)
+            found.extend(reversed(matched))
+        else:
+            for line in _reverse_lines(file, log_filter.until):
+                if not line.strip():
+                    continue
+                if log_filter.since:
+                    time = line_time(line)
+                    if time is not None and time < log_filter.since:
+                        return list(reversed(found[:count]))
+                if log_filter.prefilter(line):
+                    entry = parse_line(line)
+                    if log_filter.match(entry):
+                        found.append(entry)
+                        if len(found) >= count:
+                            break
+        if len(found) >= count:
+            break
+    return list(reversed(found[:count]))
+
+
+def _pretty_message(message: str) -> str:
+    """Разворачивает JSON, встроенный в сообщение (payload, ответы API), с отступами"""
+    for index, char in enumerate(message):
+        if char in "{[":
+            try:
+                data, end = json.JSONDecoder().raw_decode(message, index)
+            except ValueError:
+                continue
+            pretty = json.dumps(data, indent=2, ensure_ascii=False)
+            return f"{message[:index]}\n{pretty}{message[end:]}"
+    return message
+
+
+def format_entry(entry: LogEntry, pretty: bool = False) -> str:
+    if entry.time is None and entry.level is None:
+        return entry.raw
+    message = _pretty_message(entry.message) if pretty else entry.message
+    line = f"{entry.time:%Y-%m-%d %H:%M:%S} {entry.level or '-':<8} {entry.logger or '-'}: {message}"
+    if entry.context:
+        line += " [" + " ".join(f"{key}={value}" for key, value in entry.context.items()) + "]"
+    if entry.exception:
+        line += "\n" + entry.exception
+    return line
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Просмотр и поиск по логам сервиса")
+    parser.add_argument("-f", "--file", default=DEFAULT_LOG_FILE, help="Файл лога (по умолчанию logs/errors.log)")
+    parser.add_argument("--no-rotated", action="store_true", help="Не читать ротированные файлы")
+    parser.add_argument("--json", action="store_true", help="Выводить исходные строки")
+    parser.add_argument("--pretty", action="store_true", help="Форматировать JSON внутри сообщений")
+    parser.add_argument("--level", choices=list(LEVELS), type=str.upper, help="Минимальный уровень")
+    parser.add_argument("--since", help="Начало окна: ISO-время или 30m, 2h, 1d назад")
+    parser.add_argument("--until", help="Конец окна: ISO-время или 30m, 2h, 1d назад")
+    parser.add_argument("--resource-id", help="Только записи webhook с этим resource_id")
+    commands = parser.add_subparsers(dest="command")
+    tail_parser = commands.add_parser("tail", help="Последние строки (чтение с конца файла)")
+    tail_parser.add_argument("-n", "--lines", type=int, default=50)
+    tail_parser.add_argument("text", nargs="?", help="Подстрока (без учета регистра)")
+    search_parser = commands.add_parser("search", help="Все подходящие строки по порядку")
+    search_parser.add_argument("text", nargs="?", help="Подстрока (без учета регистра)")
+    args = parser.parse_args(argv)
+
+    try:
+        log_filter = LogFilter(
+            level=args.level,
+            since=parse_time(args.since) if args.since else None,
+            until=parse_time(args.until) if args.until else None,
+            resource_id=args.resource_id,
+            text=getattr(args, "text", None),
+        )
+    except ValueError as e:
+        parser.error(f"invalid time: {e}")
+
+    if args.command == "search":
+        entries = search(args.file, log_filter, include_rotated=not args.no_rotated)
+    else:
+        entries = tail(args.file, getattr(args, "lines", 50), log_filter, include_rotated=not args.no_rotated)
+
+    try:
+        for entry in entries:
+            print(entry.raw if args.json else format_entry(entry, pretty=args.pretty))
+    except BrokenPipeError:
+        # Вывод передан в head/less и закрыт
+        sys.stderr.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
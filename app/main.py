@@ -1,80 +1,30 @@
 """
 Основное FastAPI приложение для интеграции Altegio и Webkassa
 """
-import logging
 import os
 from contextlib import asynccontextmanager
-from pathlib import Path
 
 from fastapi import FastAPI
+from fastapi.responses import JSONResponse, PlainTextResponse
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
 
 from app.db import create_tables
+from app.logging_config import setup_logging, stop_logging
+from app.services.token_cache import token_cache
+from app.services.shift_manager import shift_manager
+from app.services.retention import retention_manager
+from app.services.fiscalization_log import fiscalization_log_writer
+from app.services.metrics import render_metrics
+from app.services.tracing import exporter as trace_exporter
+from app.services.loop_monitor import loop_monitor
+from app.services.profiler import slow_webhook_profiler
+from app.services.notifications import telegram_notifier
+from app.services.readiness import readiness_probe
 from app.routes.webhook import router as webhook_router
 from app.routes.acquire import router as acquire_router
-
-
-# Настройка логирования
-def setup_logging():
-    """Настройка логирования в файл и консоль с корректной обработкой Unicode"""
-    log_level = os.getenv("LOG_LEVEL", "INFO")
-    log_file = os.getenv("LOG_FILE", "logs/errors.log")
-    
-    # Создаем директорию для логов если её нет
-    Path(log_file).parent.mkdir(parents=True, exist_ok=True)
-    
-    # Пользовательский форматтер для правильной обработки Unicode
-    class UnicodeFormatter(logging.Formatter):
-        def format(self, record):
-            # Форматируем запись
-            formatted = super().format(record)
-            # Убеждаемся что это строка в правильной кодировке
-            if isinstance(formatted, bytes):
-                formatted = formatted.decode('utf-8', errors='replace')
-            return formatted
-    
-    # Настройка форматирования с правильной кодировкой
-    formatter = UnicodeFormatter(
-        '%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-        datefmt='%Y-%m-%d %H:%M:%S'
-    )
-    
-    # Удаляем старые handlers если есть
-    root_logger = logging.getLogger()
-    for handler in root_logger.handlers[:]:
-        root_logger.removeHandler(handler)
-    
-    # Логирование в файл с правильной кодировкой
-    file_handler = logging.FileHandler(
-        log_file, 
-        encoding='utf-8', 
-        mode='a'  # append mode
-    )
-    file_handler.setFormatter(formatter)
-    file_handler.setLevel(getattr(logging, log_level.upper()))
-    
-    # Логирование в консоль с правильной кодировкой
-    import sys
-    console_handler = logging.StreamHandler(sys.stdout)
-    console_handler.setFormatter(formatter)
-    console_handler.setLevel(getattr(logging, log_level.upper()))
-    
-    # Настройка root logger
-    root_logger.setLevel(getattr(logging, log_level.upper()))
-    root_logger.addHandler(file_handler)
-    root_logger.addHandler(console_handler)
-    
-    # Отключаем слишком подробные логи от сторонних библиотек
-    logging.getLogger("httpx").setLevel(logging.WARNING)
-    logging.getLogger("sqlalchemy.engine").setLevel(logging.WARNING)
-    logging.getLogger("uvicorn.access").setLevel(logging.WARNING)
-    
-    # Тестовое сообщение для проверки кодировки
-    root_logger.info("🚀 Логирование настроено. Тест Unicode: фч тест кириллицы")
-    
-    return root_logger
+from app.routes.admin import router as admin_router
 
 
 @asynccontextmanager
@@ -84,14 +34,44 @@ async def lifespan(app: FastAPI):
     logger = setup_logging()
     logger.info("Starting Altegio-Webkassa Integration Service")
     
+    # Сторож event loop: лаг цикла и стек блокирующего кода
+    await loop_monitor.start()
+    
+    # Автозахват профиля медленных webhook (PROFILE_SLOW_WEBHOOKS)
+    await slow_webhook_profiler.start()
+    
+    # Уведомления в Telegram отправляются в фоне, вне пути обработки webhook
+    await telegram_notifier.start()
+    
     # Создание таблиц в базе данных
     await create_tables()
     logger.info("Database tables created/verified")
     
+    # Журнал попыток фискализации пишется пачками в фоне
+    await fiscalization_log_writer.start()
+    
+    # Подписка на ротацию токенов Webkassa от других воркеров
+    await token_cache.start()
+    
+    # Плановое закрытие смен Webkassa вместо закрытия посреди чека клиента
+    await shift_manager.start()
+    
+    # Помесячные секции webhook_records: создание будущих и архивация старых
+    await retention_manager.start()
+    
     yield
     
     # Shutdown
     logger.info("Shutting down Altegio-Webkassa Integration Service")
+    await retention_manager.stop()
+    await shift_manager.stop()
+    await token_cache.stop()
+    await fiscalization_log_writer.stop()
+    await telegram_notifier.stop()
+    await slow_webhook_profiler.stop()
+    await loop_monitor.stop()
+    trace_exporter.shutdown()
+    stop_logging()
 
 
 # Создание FastAPI приложения
@@ -120,6 +100,7 @@ templates = Jinja2Templates(directory="app/templates")
 # Подключение маршрутов
 app.include_router(webhook_router, prefix="/api", tags=["webhook"])
 app.include_router(acquire_router, tags=["frontend"])
+app.include_router(admin_router, prefix="/api/admin", tags=["admin"])
 
 
 @app.get("/")
@@ -134,13 +115,30 @@ async def root():
 
 @app.get("/health")
 async def health_check():
-    """Эндпоинт для проверки здоровья сервиса"""
+    """Проверка, что процесс жив (liveness); состояние зависимостей - в /ready"""
     return {
         "status": "healthy",
         "service": "altegio-webkassa-integration"
     }
 
 
+@app.get("/ready")
+async def readiness_check():
+    """
+    Готовность сервиса: БД, пул соединений, токены Webkassa, очередь журнала,
+    выключатели внешних API и лаг event loop. 503, если webhook обработать нельзя.
+    Результат кэшируется на READY_CACHE_SECONDS секунд.
+    """
+    result = await readiness_probe.check()
+    return JSONResponse(result, status_code=503 if result["status"] == "fail" else 200)
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def metrics():
+    """Метрики процесса в формате Prometheus: длительность этапов, исходы webhook, ошибки Webkassa"""
+    return PlainTextResponse(render_metrics(), media_type="text/plain; version=0.0.4")
+
+
 if __name__ == "__main__":
     import uvicorn
     
@@ -0,0 +1,312 @@
+"""
+Миграции схемы базы данных
+
+create_all создает только отсутствующие таблицы и не меняет существующие, поэтому
+изменения уже развернутых таблиц описываются здесь упорядоченным списком именованных
+идемпотентных миграций: SQL-операторов или async-функций от соединения (для шагов,
+которым нужна логика). Примененные миграции записываются в schema_migrations.
+
+Миграции выполняются до create_all: на новой базе таблиц еще нет, и каждая миграция
+сама проверяет, есть ли что переводить.
+"""
+import logging
+import os
+from typing import Awaitable, Callable, List, Tuple, Union
+
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncConnection
+
+logger = logging.getLogger(__name__)
+
+MigrationStep = Union[str, Callable[[AsyncConnection], Awaitable[None]]]
+
+
+async def partition_webhook_records(conn: AsyncConnection):
+    """
+    Переводит webhook_records и webhook_payloads на помесячное секционирование.
+
+    Старые таблицы переименовываются в *_legacy вместе с индексами и sequence,
+    новые создаются из моделей, данные копируются в секции, ключи уникальности
+    переносятся в webhook_record_keys.
+    """
+    from app.db import Base
+    from app.models import WebhookPayload, WebhookRecord, WebhookRecordKey
+    from app.services.retention import ensure_partitions
+
+    relkind = await conn.scalar(text("SELECT relkind::text FROM pg_class WHERE relname = 'webhook_records'"))
+    if relkind != "r":
+        # Новая база (таблицы создаст create_all) или уже переведенная
+        return
+
+    for table in ("webhook_payloads", "webhook_records"):
+        result = await conn.execute(
+            text("SELECT indexname FROM pg_indexes WHERE schemaname = current_schema() AND tablename = :table"),
+            {"table": table},
+        )
+        for (index_name,) in result.all():
+            await conn.execute(text(f'ALTER INDEX "{index_name}" RENAME TO "{index_name[:55]}_legacy"'))
+        await conn.execute(text(f"ALTER TABLE {table} RENAME TO {table}_legacy"))
+    await conn.execute(text("ALTER SEQUENCE webhook_records_id_seq RENAME TO webhook_records_legacy_id_seq"))
+
+    await conn.run_sync(
+        Base.metadata.create_all,
+        tables=[WebhookRecord.__table__, WebhookPayload.__table__, WebhookRecordKey.__table__],
+    )
+    oldest = await conn.scalar(text("SELECT min(created_at) FROM webhook_records_legacy"))
+    await ensure_partitions(conn, start=oldest)
+
+    await conn.execute(text(
+        """
+        INSERT INTO webhook_records (
+            id, company_id, resource, resource_id, status, client_phone, client_name, record_date,
+            comment, processed, processing_error, webkassa_request_id, webkassa_status,
+            created_at, updated_at, processed_at
+        )
+        SELECT
+            id, company_id, resource, resource_id, status, client_phone, client_name, record_date,
+            comment, processed, processing_error, webkassa_request_id, webkassa_status,
+            created_at, updated_at, processed_at
+        FROM webhook_records_legacy
+        """
+    ))
+    await conn.execute(text(
+        """
+        INSERT INTO webhook_payloads (record_id, created_at, raw_data, services_data, webkassa_response, updated_at)
+        SELECT p.record_id, r.created_at, p.raw_data, p.services_data, p.webkassa_response, p.updated_at
+        FROM webhook_payloads_legacy p JOIN webhook_records_legacy r ON r.id = p.record_id
+        """
+    ))
+    await conn.execute(text(
+        """
+        INSERT INTO webhook_record_keys (company_id, resource_id, record_id, created_at)
+        SELECT company_id, resource_id, id, created_at FROM webhook_records_legacy
+        ON CONFLICT DO NOTHING
+        """
+    ))
+    await conn.execute(text(
+        "SELECT setval(pg_get_serial_sequence('webhook_records', 'id'), "
+        "(SELECT COALESCE(max(id), 0) + 1 FROM webhook_records_legacy), false)"
+    ))
+    await conn.execute(text("DROP TABLE webhook_payloads_legacy"))
+    await conn.execute(text("DROP TABLE webhook_records_legacy"))
+
+
+async def move_tenant_passwords_to_env(conn: AsyncConnection):
+    """
+    Убирает пароли Webkassa арендаторов из БД: в webkassa_tenants остается имя переменной
+    окружения с паролем. Пароль в открытом виде стирается только у арендаторов, чья переменная
+    уже задана, иначе он остается до переноса, чтобы не потерять доступ к Webkassa.
+    """
+    if await conn.scalar(text("SELECT to_regclass('webkassa_tenants')")) is None:
+        return
+
+    await conn.execute(text(
+        """
+        ALTER TABLE webkassa_tenants
+            ADD COLUMN IF NOT EXISTS webkassa_password_env VARCHAR(100),
+            ALTER COLUMN webkassa_password DROP NOT NULL
+        """
+    ))
+    await conn.execute(text(
+        """
+        UPDATE webkassa_tenants SET webkassa_password_env = 'WEBKASSA_PASSWORD_' || company_id
+        WHERE webkassa_password_env IS NULL
+        """
+    ))
+    result = await conn.execute(text(
+        "SELECT company_id, webkassa_password_env FROM webkassa_tenants WHERE webkassa_password IS NOT NULL"
+    ))
+    for company_id, env_name in result.all():
+        if os.getenv(env_name):
+            await conn.execute(
+                text("UPDATE webkassa_tenants SET webkassa_password = NULL WHERE company_id = :company_id"),
+                {"company_id": company_id},
+            )
+        else:
+            logger.warning(f"⚠️ Пароль Webkassa компании {company_id} остается в БД до переноса в {env_name}")
+
+
+# (имя, шаги) - порядок важен, имена не меняются после выката
+MIGRATIONS: List[Tuple[str, List[MigrationStep]]] = [
+    (
+        "0001_webhook_records_unique_company_resource",
+        [
+            # Дубли могли появиться при одновременной доставке одного webhook:
+            # оставляем обработанную запись, а среди равных - самую свежую.
+            # На новой базе таблица сразу секционирована (см. 0003) - там шаг не нужен.
+            """
+            DO $$
+            BEGIN
+                IF (SELECT relkind FROM pg_class WHERE relname = 'webhook_records') = 'r' THEN
+                    DELETE FROM webhook_records
+                    WHERE id IN (
+                        SELECT id FROM (
+                            SELECT id, row_number() OVER (
+                                PARTITION BY company_id, resource_id
+                                ORDER BY processed DESC, id DESC
+                            ) AS position
+                            FROM webhook_records
+                        ) ranked
+                        WHERE ranked.position > 1
+                    );
+                    CREATE UNIQUE INDEX IF NOT EXISTS uq_webhook_records_company_resource
+                    ON webhook_records (company_id, resource_id);
+                END IF;
+            END
+            $$
+            """,
+        ],
+    ),
+    (
+        "0002_webhook_payloads_cold_storage",
+        [
+            # Переносим тяжелые колонки в webhook_payloads. services_data и webkassa_response
+            # раньше записывались строкой json.dumps внутри JSON (двойное кодирование) -
+            # раскодируем при переносе.
+            """
+            DO $$
+            BEGIN
+                IF EXISTS (
+                    SELECT 1 FROM information_schema.columns
+                    WHERE table_name = 'webhook_records' AND column_name = 'raw_data'
+                ) THEN
+                    CREATE TABLE IF NOT EXISTS webhook_payloads (
+                        record_id INTEGER PRIMARY KEY REFERENCES webhook_records (id) ON DELETE CASCADE,
+                        raw_data JSONB NOT NULL,
+                        services_data JSONB NOT NULL,
+                        webkassa_response JSONB,
+                        updated_at TIMESTAMP NOT NULL DEFAULT now()
+                    );
+                    INSERT INTO webhook_payloads (record_id, raw_data, services_data, webkassa_response, updated_at)
+                    SELECT
+                        id,
+                        COALESCE(raw_data::jsonb, '{}'::jsonb),
+                        CASE json_typeof(services_data)
+                            WHEN 'string' THEN (services_data #>> '{}')::jsonb
+                            WHEN 'null' THEN '[]'::jsonb
+                            ELSE COALESCE(services_data::jsonb, '[]'::jsonb)
+                        END,
+                        CASE json_typeof(webkassa_response)
+                            WHEN 'string' THEN (webkassa_response #>> '{}')::jsonb
+                            WHEN 'null' THEN NULL
+                            ELSE webkassa_response::jsonb
+                        END,
+                        updated_at
+                    FROM webhook_records
+                    ON CONFLICT (record_id) DO NOTHING;
+                END IF;
+            END
+            $$
+            """,
+            """
+            ALTER TABLE IF EXISTS webhook_records
+                DROP COLUMN IF EXISTS raw_data,
+                DROP COLUMN IF EXISTS services_data,
+                DROP COLUMN IF EXISTS webkassa_response
+            """,
+        ],
+    ),
+    (
+        "0003_partition_webhook_records",
+        [partition_webhook_records],
+    ),
+    (
+        "0004_fiscalization_logs_duration",
+        [
+            # Журнал пишет каждую попытку отправки, в том числе без записи webhook
+            """
+            ALTER TABLE IF EXISTS fiscalization_logs
+                ADD COLUMN IF NOT EXISTS duration_ms INTEGER,
+                ALTER COLUMN webhook_record_id DROP NOT NULL
+            """,
+        ],
+    ),
+    (
+        "0005_webhook_records_query_indexes",
+        [
+            # Одиночные индексы почти на каждой колонке не совпадали ни с одним запросом
+            # и замедляли вставку; id ищется по первичному ключу (id, created_at)
+            """
+            DROP INDEX IF EXISTS
+                ix_webhook_records_id,
+                ix_webhook_records_company_id,
+                ix_webhook_records_resource,
+                ix_webhook_records_resource_id,
+                ix_webhook_records_status,
+                ix_webhook_records_client_phone,
+                ix_webhook_records_record_date,
+                ix_webhook_records_processed,
+                ix_webhook_records_webkassa_request_id,
+                ix_webhook_records_webkassa_status,
+                ix_webhook_records_created_at,
+                ix_webhook_records_company_resource
+            """,
+            # На новой базе индексы создаст create_all
+            """
+            DO $$
+            BEGIN
+                IF to_regclass('webhook_records') IS NOT NULL THEN
+                    CREATE INDEX IF NOT EXISTS ix_webhook_records_resource_company
+                        ON webhook_records (resource_id, company_id);
+                    CREATE INDEX IF NOT EXISTS ix_webhook_records_created_at_id
+                        ON webhook_records (created_at, id);
+                    CREATE INDEX IF NOT EXISTS ix_webhook_records_unprocessed
+                        ON webhook_records (created_at, id) WHERE processed = false;
+                    CREATE INDEX IF NOT EXISTS ix_webhook_records_failed
+                        ON webhook_records (created_at, id) WHERE webkassa_status = 'failed';
+                END IF;
+            END
+            $$
+            """,
+        ],
+    ),
+    (
+        "0006_fiscalization_logs_correlation_id",
+        [
+            "ALTER TABLE IF EXISTS fiscalization_logs ADD COLUMN IF NOT EXISTS correlation_id VARCHAR(32)",
+            """
+            DO $$
+            BEGIN
+                IF to_regclass('fiscalization_logs') IS NOT NULL THEN
+                    CREATE INDEX IF NOT EXISTS ix_fiscalization_logs_correlation_id
+                        ON fiscalization_logs (correlation_id);
+                END IF;
+            END
+            $$
+            """,
+        ],
+    ),
+    (
+        "0007_webkassa_tenants_password_env",
+        [move_tenant_passwords_to_env],
+    ),
+]
+
+
+async def run_migrations(conn: AsyncConnection):
+    """
+    Применяет неприменённые миграции в транзакции conn.
+    Вызывается из create_tables под advisory-блокировкой, поэтому воркеры не гоняются.
+    """
+    await conn.execute(text(
+        """
+        CREATE TABLE IF NOT EXISTS schema_migrations (
+            name VARCHAR(255) PRIMARY KEY,
+            applied_at TIMESTAMP NOT NULL DEFAULT now()
+        )
+        """
+    ))
+    result = await conn.execute(text("SELECT name FROM schema_migrations"))
+    applied = {row[0] for row in result}
+
+    for name, statements in MIGRATIONS:
+        if name in applied:
+            continue
+        logger.info(f"🛠️ Applying migration {name}")
+        for step in statements:
+            if callable(step):
+                await step(conn)
+            else:
+                await conn.execute(text(step))
+        await conn.execute(text("INSERT INTO schema_migrations (name) VALUES (:name)"), {"name": name})
+        logger.info(f"✅ Migration {name} applied")
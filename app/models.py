@@ -1,11 +1,13 @@
 """
 Модели SQLAlchemy для базы данных
 """
+import os
 from datetime import datetime
 from typing import List, Dict, Any, Optional
 
-from sqlalchemy import Column, Integer, String, DateTime, Boolean, Text, JSON, Numeric
-from sqlalchemy.sql import func
+from sqlalchemy import Column, Integer, String, DateTime, Boolean, Text, JSON, Numeric, Index, ForeignKeyConstraint
+from sqlalchemy.dialects.postgresql import JSONB
+from sqlalchemy.sql import func, text
 
 from app.db import Base
 
@@ -15,41 +17,49 @@ class WebhookRecord(Base):
     Модель для хранения webhook запросов от Altegio
     """
     __tablename__ = "webhook_records"
+    __table_args__ = (
+        # Индексы повторяют реальные запросы (см. миграцию 0005); поиск по id идет по первичному ключу.
+        # Уникальность (company_id, resource_id) обеспечивает webhook_record_keys:
+        # уникальный индекс секционированной таблицы обязан включать created_at.
+        # Удаление и поиск по resource_id, с company_id или без него
+        Index("ix_webhook_records_resource_company", "resource_id", "company_id"),
+        # Список записей: keyset-пагинация по (created_at, id)
+        Index("ix_webhook_records_created_at_id", "created_at", "id"),
+        # Необработанные записи (повторы, очистка, фильтр списка) - малая доля таблицы
+        Index("ix_webhook_records_unprocessed", "created_at", "id", postgresql_where=text("processed = false")),
+        # Неуспешная фискализация по времени
+        Index("ix_webhook_records_failed", "created_at", "id", postgresql_where=text("webkassa_status = 'failed'")),
+        # Помесячные секции создает и архивирует app/services/retention.py
+        {"postgresql_partition_by": "RANGE (created_at)"},
+    )
     
-    # Основные поля
-    id = Column(Integer, primary_key=True, index=True, autoincrement=True)
+    # Основные поля (первичный ключ секционированной таблицы включает ключ секционирования)
+    id = Column(Integer, primary_key=True, autoincrement=True)
     
     # Данные из webhook
-    company_id = Column(Integer, nullable=False, index=True, comment="ID компании в Altegio")
-    resource = Column(String(50), nullable=False, index=True, comment="Тип ресурса (record, client, etc.)")
-    resource_id = Column(Integer, nullable=False, index=True, comment="ID ресурса в Altegio")
-    status = Column(String(20), nullable=False, index=True, comment="Статус операции (create, update, delete)")
+    company_id = Column(Integer, nullable=False, comment="ID компании в Altegio")
+    resource = Column(String(50), nullable=False, comment="Тип ресурса (record, client, etc.)")
+    resource_id = Column(Integer, nullable=False, comment="ID ресурса в Altegio")
+    status = Column(String(20), nullable=False, comment="Статус операции (create, update, delete)")
     
     # Данные клиента
-    client_phone = Column(String(20), nullable=False, index=True, comment="Телефон клиента")
+    client_phone = Column(String(20), nullable=False, comment="Телефон клиента")
     client_name = Column(String(255), nullable=False, comment="Имя клиента")
     
     # Данные записи
-    record_date = Column(DateTime, nullable=False, index=True, comment="Дата и время записи")
+    record_date = Column(DateTime, nullable=False, comment="Дата и время записи")
     comment = Column(Text, nullable=True, comment="Комментарий к записи")
     
-    # Данные об услугах (JSON)
-    services_data = Column(JSON, nullable=False, comment="Список услуг в формате JSON")
-    
-    # Полные данные webhook (для отладки и восстановления)
-    raw_data = Column(JSON, nullable=False, comment="Полные данные webhook в формате JSON")
-    
     # Статус обработки
-    processed = Column(Boolean, default=False, nullable=False, index=True, comment="Флаг обработки webhook")
+    processed = Column(Boolean, default=False, nullable=False, comment="Флаг обработки webhook")
     processing_error = Column(Text, nullable=True, comment="Ошибка при обработке")
     
     # Данные фискализации Webkassa
-    webkassa_request_id = Column(String(255), nullable=True, index=True, comment="ID запроса в Webkassa")
-    webkassa_response = Column(JSON, nullable=True, comment="Ответ от Webkassa API")
-    webkassa_status = Column(String(50), nullable=True, index=True, comment="Статус фискализации")
+    webkassa_request_id = Column(String(255), nullable=True, comment="ID запроса в Webkassa")
+    webkassa_status = Column(String(50), nullable=True, comment="Статус фискализации")
     
     # Временные метки
-    created_at = Column(DateTime, default=func.now(), nullable=False, index=True, comment="Время создания записи")
+    created_at = Column(DateTime, default=func.now(), primary_key=True, nullable=False, comment="Время создания записи (ключ секционирования)")
     updated_at = Column(DateTime, default=func.now(), onupdate=func.now(), nullable=False, comment="Время последнего обновления")
     processed_at = Column(DateTime, nullable=True, comment="Время обработки")
     
@@ -57,6 +67,39 @@ class WebhookRecord(Base):
         return (f"<WebhookRecord(id={self.id}, company_id={self.company_id}, "
                 f"resource_id={self.resource_id}, client_phone=\'{self.client_phone}\', "
                 f"processed={self.processed})>")
+
+
+class WebhookPayload(Base):
+    """
+    Холодные данные webhook: полный payload, услуги и ответ Webkassa.
+    Читаются только по запросу, поэтому не раздувают webhook_records
+    (сканирование, vacuum и бэкапы горячей таблицы).
+    """
+    __tablename__ = "webhook_payloads"
+    __table_args__ = (
+        ForeignKeyConstraint(
+            ["record_id", "created_at"], ["webhook_records.id", "webhook_records.created_at"], ondelete="CASCADE"
+        ),
+        # Секции совпадают с секциями webhook_records и архивируются вместе с ними
+        {"postgresql_partition_by": "RANGE (created_at)"},
+    )
+    
+    record_id = Column(Integer, primary_key=True, comment="ID записи webhook_records")
+    created_at = Column(DateTime, primary_key=True, comment="created_at записи webhook_records (ключ секционирования)")
+    
+    # Полные данные webhook (для отладки и восстановления)
+    raw_data = Column(JSONB, nullable=False, comment="Полные данные webhook")
+    
+    # Данные об услугах
+    services_data = Column(JSONB, nullable=False, comment="Список услуг")
+    
+    # Ответ Webkassa
+    webkassa_response = Column(JSONB, nullable=True, comment="Ответ от Webkassa API")
+    
+    updated_at = Column(DateTime, default=func.now(), onupdate=func.now(), nullable=False, comment="Время последнего обновления")
+    
+    def __repr__(self):
+        return f"<WebhookPayload(record_id={self.record_id})>"
     
     @property
     def total_amount(self) -> float:
@@ -85,6 +128,29 @@ class WebhookRecord(Base):
         return services
 
 
+class WebhookRecordKey(Base):
+    """
+    Уникальный ключ webhook (company_id, resource_id) -> запись в секционированной webhook_records.
+    Узкая несекционированная таблица: цель ON CONFLICT при upsert записи.
+    Удаление записи удаляет и ключ (ON DELETE CASCADE).
+    """
+    __tablename__ = "webhook_record_keys"
+    __table_args__ = (
+        ForeignKeyConstraint(
+            ["record_id", "created_at"], ["webhook_records.id", "webhook_records.created_at"], ondelete="CASCADE"
+        ),
+    )
+    
+    company_id = Column(Integer, primary_key=True, comment="ID компании в Altegio")
+    resource_id = Column(Integer, primary_key=True, comment="ID ресурса в Altegio")
+    record_id = Column(Integer, nullable=False, comment="ID записи webhook_records")
+    created_at = Column(DateTime, nullable=False, index=True, comment="created_at записи webhook_records")
+    
+    def __repr__(self):
+        return (f"<WebhookRecordKey(company_id={self.company_id}, resource_id={self.resource_id}, "
+                f"record_id={self.record_id})>")
+
+
 class PaymentRecord(Base):
     """
     Модель для хранения информации о платежах
@@ -131,7 +197,7 @@ class FiscalizationLog(Base):
     id = Column(Integer, primary_key=True, index=True, autoincrement=True)
     
     # Связи
-    webhook_record_id = Column(Integer, nullable=False, index=True, comment="ID webhook записи")
+    webhook_record_id = Column(Integer, nullable=True, index=True, comment="ID webhook записи")
     payment_record_id = Column(Integer, nullable=True, index=True, comment="ID платежа")
     
     # Данные фискализации
@@ -142,6 +208,8 @@ class FiscalizationLog(Base):
     status = Column(String(20), nullable=False, index=True, comment="Статус фискализации")
     error_message = Column(Text, nullable=True, comment="Сообщение об ошибке")
     retry_count = Column(Integer, default=0, nullable=False, comment="Количество попыток")
+    duration_ms = Column(Integer, nullable=True, comment="Длительность запроса к Webkassa, мс")
+    correlation_id = Column(String(32), nullable=True, index=True, comment="ID трассы обработки webhook")
     
     # Временные метки
     created_at = Column(DateTime, default=func.now(), nullable=False, index=True)
@@ -169,3 +237,59 @@ class ApiKey(Base):
         return f"<ApiKey(service_name=\'{self.service_name}\')>"
 
 
+class WebkassaTenant(Base):
+    """
+    Реестр арендаторов: компания Altegio -> учетная запись и касса Webkassa
+    Компании без записи в реестре обслуживаются учетной записью и кассой из переменных окружения
+    """
+    __tablename__ = "webkassa_tenants"
+
+    id = Column(Integer, primary_key=True, index=True, autoincrement=True)
+    company_id = Column(Integer, unique=True, nullable=False, comment="ID компании в Altegio")
+    webkassa_login = Column(String(255), nullable=False, comment="Логин Webkassa")
+    webkassa_password_env = Column(String(100), nullable=True, comment="Имя переменной окружения с паролем Webkassa")
+    webkassa_password = Column(String(255), nullable=True, comment="Устаревший пароль в открытом виде (до переноса в окружение)")
+    cashbox_id = Column(String(100), nullable=False, comment="Уникальный номер кассы Webkassa")
+    is_active = Column(Boolean, default=True, nullable=False, comment="Флаг активности арендатора")
+    created_at = Column(DateTime, default=func.now(), nullable=False)
+    updated_at = Column(DateTime, default=func.now(), onupdate=func.now(), nullable=False)
+
+    @property
+    def service_name(self) -> str:
+        """Имя записи токена арендатора в таблице api_keys"""
+        return f"Webkassa:{self.company_id}"
+
+    @property
+    def password_env(self) -> str:
+        """Переменная окружения с паролем арендатора (по умолчанию WEBKASSA_PASSWORD_<company_id>)"""
+        return self.webkassa_password_env or f"WEBKASSA_PASSWORD_{self.company_id}"
+
+    @property
+    def password(self) -> Optional[str]:
+        """
+        Пароль Webkassa из переменной окружения password_env.
+        Пароль в открытом виде из webkassa_password читается, только пока его не перенесли в окружение.
+        """
+        return os.getenv(self.password_env) or self.webkassa_password
+
+    def __repr__(self):
+        return f"<WebkassaTenant(company_id={self.company_id}, cashbox_id=\'{self.cashbox_id}\')>"
+
+
+class CashboxShift(Base):
+    """
+    Состояние текущей смены кассы Webkassa (для планового закрытия смен)
+    """
+    __tablename__ = "cashbox_shifts"
+
+    cashbox_id = Column(String(100), primary_key=True, comment="Уникальный номер кассы Webkassa")
+    service_name = Column(String(50), nullable=False, comment="Запись api_keys с токеном для этой кассы")
+    shift_number = Column(Integer, nullable=True, comment="Номер открытой смены (NULL - смена закрыта)")
+    opened_at = Column(DateTime, nullable=True, comment="Время первого чека смены (открытие смены)")
+    closed_at = Column(DateTime, nullable=True, comment="Время последнего закрытия смены")
+    updated_at = Column(DateTime, default=func.now(), onupdate=func.now(), nullable=False)
+
+    def __repr__(self):
+        return (f"<CashboxShift(cashbox_id=\'{self.cashbox_id}\', shift_number={self.shift_number}, "
+                f"opened_at={self.opened_at})>")
+
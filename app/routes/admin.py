@@ -0,0 +1,94 @@
+"""
+Служебные маршруты для диагностики живого процесса (профилирование, пул соединений с БД).
+Доступны только с токеном ADMIN_TOKEN в заголовке X-Admin-Token или Authorization: Bearer.
+"""
+import logging
+import os
+import secrets
+from typing import Optional
+
+from fastapi import APIRouter, Depends, Header, HTTPException, Query
+from fastapi.responses import FileResponse, JSONResponse, PlainTextResponse
+
+from app.db import get_pool_stats
+from app.services.profiler import (
+    PROFILER_DEFAULT_INTERVAL, PROFILER_MAX_SECONDS,
+    capture_in_progress, capture_profile, slow_webhook_profiler,
+)
+
+router = APIRouter()
+logger = logging.getLogger(__name__)
+
+
+async def require_admin_token(
+    x_admin_token: Optional[str] = Header(None),
+    authorization: Optional[str] = Header(None),
+):
+    """Проверка токена администратора; без ADMIN_TOKEN служебные маршруты выключены"""
+    expected = os.getenv("ADMIN_TOKEN", "")
+    if not expected:
+        raise HTTPException(status_code=403, detail="Admin endpoints are disabled (ADMIN_TOKEN is not set)")
+    token = x_admin_token
+    if not token and authorization and authorization.lower().startswith("bearer "):
+        token = authorization[7:].strip()
+    if not token or not secrets.compare_digest(token.encode(), expected.encode()):
+        raise HTTPException(status_code=401, detail="Invalid admin token")
+
+
+@router.get("/profile", dependencies=[Depends(require_admin_token)])
+async def profile_process(
+    seconds: float = Query(10, gt=0, le=PROFILER_MAX_SECONDS, description="Длительность захвата"),
+    format: str = Query("collapsed", pattern="^(collapsed|speedscope)$"),
+    interval: float = Query(PROFILER_DEFAULT_INTERVAL, ge=0.001, le=1, description="Период выборки, с"),
+    all_threads: bool = Query(False, description="Все потоки процесса, а не только event loop"),
+):
+    """
+    Статистический профиль процесса за seconds секунд.
+    collapsed - для flamegraph.pl/speedscope/inferno, speedscope - JSON для speedscope.app.
+    """
+    if capture_in_progress():
+        raise HTTPException(status_code=409, detail="Another profile capture is in progress")
+
+    logger.info(f"🔬 Profiling for {seconds}s (interval {interval}s, all_threads={all_threads})")
+    profile = await capture_profile(seconds, interval=interval, all_threads=all_threads)
+    logger.info(f"🔬 Profile captured: {len(profile.samples)} samples in {profile.duration:.2f}s")
+
+    filename = f"profile_{int(profile.started_at)}"
+    if format == "speedscope":
+        return JSONResponse(
+            profile.to_speedscope(),
+            headers={"Content-Disposition": f'attachment; filename="{filename}.speedscope.json"'},
+        )
+    return PlainTextResponse(
+        profile.to_collapsed(),
+        headers={"Content-Disposition": f'attachment; filename="{filename}.collapsed"'},
+    )
+
+
+@router.get("/profiles", dependencies=[Depends(require_admin_token)])
+async def list_slow_webhook_profiles():
+    """Профили медленных webhook, сохраненные автозахватом (PROFILE_SLOW_WEBHOOKS)"""
+    return {
+        "success": True,
+        "enabled": slow_webhook_profiler.enabled,
+        "threshold_seconds": slow_webhook_profiler.threshold,
+        "profiles": slow_webhook_profiler.list_profiles(),
+    }
+
+
+@router.get("/profiles/{name}", dependencies=[Depends(require_admin_token)])
+async def get_slow_webhook_profile(name: str):
+    """Файл collapsed-стеков медленного webhook"""
+    path = slow_webhook_profiler.profile_path(name)
+    if path is None:
+        raise HTTPException(status_code=404, detail="Profile not found")
+    return FileResponse(path, media_type="text/plain", filename=name)
+
+
+@router.get("/db-pool", dependencies=[Depends(require_admin_token)])
+async def db_pool_stats():
+    """Состояние пула соединений с БД: занятые, свободные, overflow и время ожидания"""
+    return {
+        "status": "ok",
+        "pool": get_pool_stats()
+    }
@@ -1,6 +1,7 @@
 """
 Маршруты для обработки webhook от Altegio
 """
+import base64
 import logging
 import json
 import os
@@ -8,64 +9,38 @@ import re
 import sys
 import subprocess
 import asyncio
+import time
 from datetime import datetime
 from typing import Dict, Any, Optional, Union, List, Tuple
 import uuid
 
 import httpx
 from fastapi import APIRouter, HTTPException, Depends, Request
+from fastapi.responses import StreamingResponse
 from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy import Date, bindparam, cast, delete, false, func, text, true, tuple_, update
+from sqlalchemy.dialects.postgresql import JSONB
 from sqlalchemy.future import select
 
-from app.db import get_db_session
-from app.models import WebhookRecord, ApiKey
+from app.db import AsyncSessionLocal, get_db_session
+from app.logging_config import LazyJson, log_context, log_payload
+from app.models import WebhookRecord, WebhookPayload, ApiKey
 from app.schemas.altegio import AltegioWebhookPayload, WebhookResponse
+from app.services.token_cache import token_cache, WEBKASSA_SERVICE_NAME
+from app.services.tenants import tenant_registry, default_tenant, TenantConfig
+from app.services.shift_manager import shift_manager
+from app.services.fiscalization_log import fiscalization_log_writer
+from app.services.metrics import stage_seconds, track_stage, webhook_outcomes, webhook_skips, webkassa_errors
+from app.services.tracing import current_trace_id, start_span
+from app.services.profiler import slow_webhook_profiler
+from app.services.circuit_breaker import altegio_breaker, webkassa_breaker
+from app.services.notifications import telegram_notifier
+from app.services.receipt_builder import ReceiptMismatchError, build_receipt, get_client_data
 
 router = APIRouter()
 logger = logging.getLogger(__name__)
 
-# Константа для исключения платежей с комиссией эквайринга
-ACQUIRING_COMMISSION_COMMENT = "Автоматически созданная операция списания комиссии за эквайринг."
-
-def should_skip_transaction(transaction_comment: str) -> bool:
-    """
-    Проверяет, нужно ли пропустить транзакцию на основе комментария
-    """
-    return transaction_comment == ACQUIRING_COMMISSION_COMMENT
-
-def get_client_data(client) -> Tuple[str, str]:
-    """
-    Безопасно извлекает телефон и имя клиента из разных форматов данных
-    Returns: (client_phone, client_name)
-    """
-    client_phone = ""
-    client_name = ""
-    
-    if client:
-        if isinstance(client, dict):
-            client_phone = client.get('phone', '')
-            client_name = client.get('name', '')
-        elif isinstance(client, list) and client:
-            first_client = client[0]
-            if isinstance(first_client, dict):
-                client_phone = first_client.get('phone', '')
-                client_name = first_client.get('name', '')
-        elif hasattr(client, 'phone'):
-            client_phone = client.phone
-            client_name = client.name
-    
-    return client_phone, client_name
-
-async def send_telegram_notification(message: str, error_details: dict = None) -> bool:
-    """
-    Отправляет уведомление в Telegram о критических ошибках
-    """
-    logger.info(f"📱 Telegram notification: {message}")
-    if error_details:
-        logger.info(f"📋 Error details: {error_details}")
-    return True
-
-async def close_webkassa_shift(db: AsyncSession, api_token: str, webhook_info: dict = None) -> dict:
+async def close_webkassa_shift(api_token: str, webhook_info: dict = None, cashbox_id: str = None) -> dict:
     """
     Закрывает смену в Webkassa API
     """
@@ -79,14 +54,15 @@ async def close_webkassa_shift(db: AsyncSession, api_token: str, webhook_info: d
     
     request_data = {
         "Token": api_token,
-        "CashboxUniqueNumber": os.getenv("WEBKASSA_CASHBOX_ID")
+        "CashboxUniqueNumber": cashbox_id or os.getenv("WEBKASSA_CASHBOX_ID")
     }
     
     logger.info(f"🔒 Attempting to close Webkassa shift at {endpoint_url}")
     
     try:
         async with httpx.AsyncClient() as client:
-            response = await client.post(endpoint_url, json=request_data, headers=headers, timeout=30)
+            with track_stage("shift_close"):
+                response = await client.post(endpoint_url, json=request_data, headers=headers, timeout=30)
             response_data = response.json()
             
             if "Errors" in response_data and response_data["Errors"]:
@@ -117,14 +93,42 @@ webhook_processing_semaphore = asyncio.Semaphore(1)  # Только один web
 webhook_processing_queue = asyncio.Queue()
 
 class WebhookTask:
-    def __init__(self, payload, request, db_session):
+    def __init__(self, payload, request):
         self.payload = payload
         self.request = request
-        self.db_session = db_session
         self.task_id = getattr(payload, "resource_id", None)
 
     async def run(self):
-        return await process_webhook_internal(self.payload, self.request, self.db_session)
+        resource = getattr(self.payload, "resource", "unknown")
+        company_id = getattr(self.payload, "company_id", None)
+        started = time.monotonic()
+        try:
+            # Корневой span трассы (его trace_id - correlation_id в логах и журнале фискализации);
+            # все записи лога обработки получают поля webhook
+            with start_span(
+                "webhook",
+                traceparent=self.request.headers.get("traceparent") if self.request else None,
+                resource=resource,
+                resource_id=self.task_id,
+                company_id=company_id,
+            ) as span, log_context(resource=resource, resource_id=self.task_id, company_id=company_id):
+                result = await process_webhook_internal(self.payload, self.request)
+                span.set_attribute("processed_count", result.get("processed_count", 0))
+                if not result.get("success"):
+                    span.set_error(result.get("message", "failed"))
+        except Exception:
+            webhook_outcomes.inc(resource=resource, outcome="error")
+            raise
+        finally:
+            await slow_webhook_profiler.webhook_finished(started, f"{resource}_{self.task_id}")
+        if not result.get("success"):
+            outcome = "failed"
+        elif result.get("processed_count"):
+            outcome = "fiscalized"
+        else:
+            outcome = "skipped"
+        webhook_outcomes.inc(resource=resource, outcome=outcome)
+        return result
 
 
 def decode_unicode_escapes(text: str) -> str:
@@ -152,23 +156,6 @@ def decode_unicode_escapes(text: str) -> str:
         return text
 
 
-def format_api_response(response_data: dict) -> str:
-    """
-    Форматирует ответ от API для логов с декодированием Unicode
-    """
-    try:
-        # Преобразуем в JSON строку
-        response_str = json.dumps(response_data, ensure_ascii=False, indent=2)
-        
-        # Декодируем Unicode escape-последовательности
-        decoded_str = decode_unicode_escapes(response_str)
-        
-        return decoded_str
-    except Exception as e:
-        logger.warning(f"Failed to format API response: {e}")
-        return str(response_data)
-
-
 async def verify_webhook_signature(request: Request) -> bool:
     """
     Проверка подписи webhook от Altegio
@@ -198,6 +185,10 @@ async def get_altegio_document(company_id: int, document_id: int) -> Dict[str, A
         logger.error("Altegio API credentials not configured in .env")
         raise HTTPException(status_code=500, detail="Altegio API credentials not configured")
 
+    if not altegio_breaker.allow():
+        logger.error(f"⛔ Altegio API call skipped: circuit breaker open (retry in {altegio_breaker.retry_in():.0f}s)")
+        raise HTTPException(status_code=503, detail="Altegio API unavailable: circuit breaker open")
+
     url = f"{altegio_api_url}/transactions/{company_id}/?document_id={document_id}"
     
     # Попробуем разные варианты заголовков
@@ -217,6 +208,10 @@ async def get_altegio_document(company_id: int, document_id: int) -> Dict[str, A
             
             async with httpx.AsyncClient() as client:
                 response = await client.get(url, headers=headers, timeout=30)
+                if response.status_code >= 500:
+                    altegio_breaker.record_failure(f"HTTP {response.status_code}")
+                else:
+                    altegio_breaker.record_success()
                 response.raise_for_status()
                 logger.info(f"Success with header variant {i+1}")
                 return response.json()
@@ -228,6 +223,7 @@ async def get_altegio_document(company_id: int, document_id: int) -> Dict[str, A
                 raise HTTPException(status_code=e.response.status_code, detail=f"Altegio API error: {e.response.text}")
             continue
         except httpx.RequestError as e:
+            altegio_breaker.record_failure(f"network: {type(e).__name__}")
             logger.error(f"Altegio API request failed: {e}")
             raise HTTPException(status_code=500, detail=f"Altegio API request failed: {e}")
         except Exception as e:
@@ -250,6 +246,10 @@ async def get_altegio_sale_document(company_id: int, document_id: int) -> Dict[s
         logger.error("Altegio API credentials not configured in .env")
         raise HTTPException(status_code=500, detail="Altegio API credentials not configured")
 
+    if not altegio_breaker.allow():
+        logger.error(f"⛔ Altegio API call skipped: circuit breaker open (retry in {altegio_breaker.retry_in():.0f}s)")
+        raise HTTPException(status_code=503, detail="Altegio API unavailable: circuit breaker open")
+
     url = f"{altegio_api_url}/company/{company_id}/sale/{document_id}"
     
     # Попробуем разные варианты заголовков
@@ -269,6 +269,10 @@ async def get_altegio_sale_document(company_id: int, document_id: int) -> Dict[s
             
             async with httpx.AsyncClient() as client:
                 response = await client.get(url, headers=headers, timeout=30)
+                if response.status_code >= 500:
+                    altegio_breaker.record_failure(f"HTTP {response.status_code}")
+                else:
+                    altegio_breaker.record_success()
                 response.raise_for_status()
                 logger.info(f"Success with header variant {i+1}")
                 return response.json()
@@ -280,6 +284,7 @@ async def get_altegio_sale_document(company_id: int, document_id: int) -> Dict[s
                 raise HTTPException(status_code=e.response.status_code, detail=f"Altegio API error: {e.response.text}")
             continue
         except httpx.RequestError as e:
+            altegio_breaker.record_failure(f"network: {type(e).__name__}")
             logger.error(f"Altegio API request failed: {e}")
             raise HTTPException(status_code=500, detail=f"Altegio API request failed: {e}")
         except Exception as e:
@@ -291,58 +296,78 @@ async def get_altegio_sale_document(company_id: int, document_id: int) -> Dict[s
 
 
 
-async def refresh_webkassa_api_key(db: AsyncSession) -> Optional[ApiKey]:
+async def refresh_webkassa_api_key(stale_token: Optional[str] = None, tenant: TenantConfig = None) -> Optional[ApiKey]:
     """
     Обновляет API ключ Webkassa, если он устарел или отсутствует.
+    
+    Обновление координируется между воркерами: если токен уже сменил другой
+    процесс (или он обновляет его прямо сейчас), скрипт повторно не запускается.
     """
-    logger.info("🔄 Attempting to refresh Webkassa API key...")
+    tenant = tenant or default_tenant()
+    logger.info(f"🔄 Attempting to refresh Webkassa API key ({tenant.service_name})...")
+    with track_stage("key_refresh"):
+        return await token_cache.refresh_once(
+            stale_token,
+            lambda: run_webkassa_key_update_script(tenant),
+            service_name=tenant.service_name,
+        )
+
+
+async def run_webkassa_key_update_script(tenant: TenantConfig = None) -> Optional[ApiKey]:
+    """
+    Запускает скрипт получения нового токена Webkassa и возвращает свежий ключ из БД.
+    """
+    tenant = tenant or default_tenant()
+    script_path = "/app/scripts/update_webkassa_key.py"
+    script_args = [] if tenant.is_default else ["--company-id", str(tenant.company_id)]
     
     try:
-        # Запускаем скрипт обновления ключа
-        import subprocess
-        import sys
-        
         logger.info("📞 Calling update script...")
         
         # Проверяем существование скрипта
-        script_path = "/app/scripts/update_webkassa_key.py"
         if not os.path.exists(script_path):
             logger.error(f"❌ Update script not found at {script_path}")
             return None
         
-        result = subprocess.run([
-            sys.executable, script_path
-        ], capture_output=True, text=True, cwd="/app", timeout=60)  # Добавляем timeout
+        # Асинхронный subprocess не блокирует event loop (и слушатель NOTIFY) на время авторизации
+        process = await asyncio.create_subprocess_exec(
+            sys.executable, script_path, *script_args,
+            cwd="/app",
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+        )
+        try:
+            stdout_bytes, stderr_bytes = await asyncio.wait_for(process.communicate(), timeout=60)
+        except asyncio.TimeoutError:
+            process.kill()
+            await process.wait()
+            raise subprocess.TimeoutExpired(script_path, 60)
         
-        logger.info(f"📝 Script return code: {result.returncode}")
-        logger.info(f"📝 Script stdout: {result.stdout[-500:]}")  # Последние 500 символов
-        if result.stderr:
-            logger.warning(f"📝 Script stderr: {result.stderr[-500:]}")
+        stdout = stdout_bytes.decode("utf-8", errors="replace")
+        stderr = stderr_bytes.decode("utf-8", errors="replace")
         
-        if result.returncode == 0:
+        logger.info(f"📝 Script return code: {process.returncode}")
+        logger.info(f"📝 Script stdout: {stdout[-500:]}")  # Последние 500 символов
+        if stderr:
+            logger.warning(f"📝 Script stderr: {stderr[-500:]}")
+        
+        if process.returncode == 0:
             logger.info("✅ API key update script completed successfully")
             
-            # Ждем немного чтобы изменения применились
-            import asyncio
-            await asyncio.sleep(1)
-            
-            # Обновляем сессию и получаем ключ
-            await db.commit()
-            # НЕ используем rollback() - это отменяет изменения!
-            # Вместо этого создаем новый запрос для получения свежих данных
-            
-            return await get_webkassa_api_key(db)
+            # Читаем ключ напрямую из БД в новой сессии (видит запись скрипта):
+            # NOTIFY мог еще не дойти до кэша
+            return await get_webkassa_api_key(use_cache=False, service_name=tenant.service_name)
         else:
-            logger.error(f"❌ API key update script failed with code {result.returncode}")
-            logger.error(f"❌ Script error: {result.stderr}")
+            logger.error(f"❌ API key update script failed with code {process.returncode}")
+            logger.error(f"❌ Script error: {stderr}")
             
             # Отправляем уведомление о неудаче скрипта
-            await send_telegram_notification(
+            telegram_notifier.notify(
                 "Ошибка выполнения скрипта обновления API ключа Webkassa",
                 {
-                    "Код ошибки": str(result.returncode),
-                    "STDOUT": result.stdout[-300:] if result.stdout else "Пусто",
-                    "STDERR": result.stderr[-300:] if result.stderr else "Пусто",
+                    "Код ошибки": str(process.returncode),
+                    "STDOUT": stdout[-300:] if stdout else "Пусто",
+                    "STDERR": stderr[-300:] if stderr else "Пусто",
                     "Путь скрипта": script_path,
                     "Рабочая директория": "/app"
                 }
@@ -352,7 +377,7 @@ async def refresh_webkassa_api_key(db: AsyncSession) -> Optional[ApiKey]:
             
     except subprocess.TimeoutExpired:
         logger.error("❌ API key update script timed out after 60 seconds")
-        await send_telegram_notification(
+        telegram_notifier.notify(
             "Таймаут скрипта обновления API ключа Webкassa",
             {
                 "Проблема": "Скрипт не завершился за 60 секунд",
@@ -362,7 +387,7 @@ async def refresh_webkassa_api_key(db: AsyncSession) -> Optional[ApiKey]:
         return None
     except Exception as e:
         logger.error(f"❌ Error refreshing API key: {e}", exc_info=True)
-        await send_telegram_notification(
+        telegram_notifier.notify(
             "Исключение при обновлении API ключа Webкassa",
             {
                 "Ошибка": str(e),
@@ -373,17 +398,30 @@ async def refresh_webkassa_api_key(db: AsyncSession) -> Optional[ApiKey]:
         return None
 
 
-async def get_webkassa_api_key(db: AsyncSession) -> Optional[ApiKey]:
+async def get_webkassa_api_key(db: Optional[AsyncSession] = None, use_cache: bool = True, service_name: str = WEBKASSA_SERVICE_NAME) -> Optional[ApiKey]:
     """
-    Получает API ключ Webкassa из базы данных с подробным логированием.
+    Получает API ключ Webкassa из кэша воркера или из базы данных с подробным логированием.
+    
+    Без db ключ читается в собственной короткой сессии, которая сразу возвращает соединение в пул.
     """
+    if use_cache:
+        cached_key = token_cache.get(service_name)
+        if cached_key:
+            logger.info(f"🔑 Using cached Webkassa API key (updated {cached_key.updated_at})")
+            return cached_key
+    
+    if db is None:
+        async with AsyncSessionLocal() as session:
+            return await get_webkassa_api_key(session, use_cache=False, service_name=service_name)
+    
     logger.info("🔍 Searching for Webkassa API key in database...")
     
     try:
-        result = await db.execute(select(ApiKey).filter(ApiKey.service_name == "Webkassa"))
+        result = await db.execute(select(ApiKey).filter(ApiKey.service_name == service_name))
         api_key_obj = result.scalars().first()
         
         if api_key_obj:
+            token_cache.put(api_key_obj)
             logger.info(f"✅ Found Webkassa API key in database:")
             logger.info(f"   🔑 Key ID: {api_key_obj.id}")
             logger.info(f"   🏷️ Service: {api_key_obj.service_name}")
@@ -404,7 +442,7 @@ async def get_webkassa_api_key(db: AsyncSession) -> Optional[ApiKey]:
             
             return api_key_obj
         else:
-            logger.error("❌ No Webkassa API key found in database!")
+            logger.error(f"❌ No Webkassa API key '{service_name}' found in database!")
             
             # Проверяем все ключи в БД для отладки
             all_keys_result = await db.execute(select(ApiKey))
@@ -424,373 +462,31 @@ async def get_webkassa_api_key(db: AsyncSession) -> Optional[ApiKey]:
         return None
 
 
-async def prepare_webkassa_data(payload: AltegioWebhookPayload, altegio_document: Dict[str, Any], db: AsyncSession, webkassa_token: str = None) -> Dict[str, Any]:
-    """
-    Преобразует данные из Altegio webhook и документа в формат, ожидаемый Webkassa.
-    """
-    # Получаем токен из базы данных, если не передан
-    if not webkassa_token:
-        api_key_record = await get_webkassa_api_key(db)
-        if not api_key_record:
-            logger.warning("⚠️ No Webkassa API key found, attempting to get fresh key...")
-            
-            # Пытаемся получить новый ключ
-            refreshed_key = await refresh_webkassa_api_key(db)
-            if refreshed_key:
-                api_key_record = refreshed_key
-                logger.info("✅ Successfully obtained fresh API key for data preparation")
-            else:
-                error_msg = "Webkassa API key not found in database and unable to refresh"
-                logger.error(f"❌ {error_msg}")
-                
-                # Отправляем уведомление в Telegram о критической ошибке
-                client_phone, client_name = get_client_data(payload.data.client)
-                await send_telegram_notification(
-                    "КРИТИЧЕСКАЯ ОШИБКА: Невозможно получить API ключ Webкassa для обработки данных",
-                    {
-                        "Проблема": "API ключ не найден в базе данных и не удалось получить новый",
-                        "Webhook ID": str(payload.resource_id),
-                        "Company ID": str(payload.company_id),
-                        "Клиент": client_name if client_name else "Неизвестен",
-                        "Телефон": client_phone if client_phone else "Неизвестен",
-                        "Влияние": "Обработка webhook остановлена",
-                        "Требуется": "Проверка настроек Webkassa API и перезапуск скрипта обновления ключей"
-                    }
-                )
-                
-                raise ValueError(error_msg)
-        
-        webkassa_token = api_key_record.api_key
-        logger.info(f"🔑 Using webkassa token from database: {webkassa_token}")
-    
-    logger.info(f"🔄 Starting data transformation for Webkassa")
-    client_phone, client_name = get_client_data(payload.data.client)
-    
-    logger.info(f"📥 Input webhook data: client_phone={client_phone}, resource_id={payload.resource_id}")
-    logger.info(f"📥 Input services count: {len(payload.data.services)}")
-    logger.info(f"📥 Input altegio_document type: {type(altegio_document)}")
-    if isinstance(altegio_document, dict):
-        logger.info(f"📥 Input altegio_document transactions count: {len(altegio_document.get('data', []))}")
-    elif isinstance(altegio_document, list):
-        logger.info(f"📥 Input altegio_document transactions count: {len(altegio_document)}")
-    else:
-        logger.info(f"📥 Input altegio_document has unknown format: {altegio_document}")
-
-    # Извлечение данных из Altegio webhook
-    # resource_id = payload.resource_id
-    services = payload.data.services
-    goods = payload.data.goods_transactions
-
-    # Извлечение данных из Altegio document
-    # Поддерживаем два формата: обычный транзакции и goods sale document
-    transactions = []
-    
-    # Проверяем тип и формат документа
-    if isinstance(altegio_document, dict):
-        # Проверяем, есть ли структура goods sale document
-        if altegio_document.get('data', {}) and isinstance(altegio_document.get('data', {}), dict) and altegio_document.get('data', {}).get('state'):
-            # Новый формат для goods_operations_sale
-            logger.info(f"📦 Processing goods sale document format")
-            sale_transactions = altegio_document.get('data', {}).get('state', {}).get('payment_transactions', [])
-            transactions = sale_transactions
-            logger.info(f"📥 Found {len(transactions)} payment transactions in goods sale document")
-        else:
-            # Словарь, но стандартный формат
-            logger.info(f"📋 Processing standard transactions document format (dict)")
-            transactions = altegio_document.get('data', [])
-            logger.info(f"📥 Found {len(transactions)} transactions in standard document (dict)")
-    elif isinstance(altegio_document, list):
-        # Список транзакций
-        logger.info(f"📋 Processing standard transactions document format (list)")
-        transactions = altegio_document
-        logger.info(f"📥 Found {len(transactions)} transactions in standard document (list)")
-    else:
-        # Неизвестный формат документа
-        logger.warning(f"Unknown altegio_document format: {type(altegio_document)}")
-        transactions = []
-        logger.info(f"📥 Found {len(transactions)} transactions (unknown format)")
-
-    positions = []
-    payments = []
-
-    logger.info(f"🛍️ Processing {len(services)} services from webhook:")
-
-    total_sum_for_webkassa = 0
-
-    # Обработка позиций (услуг) из webhook
-    for i, service in enumerate(services):
-        # Используем оригинальную цену и рассчитываем скидку отдельно
-        original_price_per_unit = round(float(service.cost_per_unit), 2)
-        discount_amount = round(float((service.cost_per_unit * service.amount) - service.cost_to_pay), 2)
-        service_total = round(float(service.cost_to_pay), 2)  # Используем реальную сумму к оплате
-        
-        position = {
-            "Count": service.amount,
-            "Price": original_price_per_unit,  # Оригинальная цена за единицу
-            "PositionName": service.title,
-            "Discount": discount_amount,  # Скидка в тенге
-            "Tax": "0",
-            "TaxType": "0", 
-            "TaxPercent": "0"
-        }
-        positions.append(position)
-        total_sum_for_webkassa += service_total
-        
-        logger.info(f"  📦 Service {i+1}: {service.title}")
-        logger.info(f"     💵 Original cost: {service.cost_per_unit} тенге x {service.amount} = {(service.cost_per_unit * service.amount)} тенге")
-        logger.info(f"     🎫 Discount: {service.discount}% = {discount_amount} тенге")
-        logger.info(f"     💰 Original price per unit: {original_price_per_unit} тенге")
-        logger.info(f"     💰 Total to pay: {service_total} тенге")
-
-    # Обработка товаров из webhook (goods_transactions)
-    for i, good in enumerate(goods):
-        # Используем оригинальную цену и рассчитываем скидку отдельно
-        original_price_per_unit = round(float(good["cost_per_unit"]), 2)
-        original_total = original_price_per_unit * abs(good["amount"])
-        good_total = round(float(good.get("cost_to_pay", original_total * (1 - good["discount"] / 100))), 2)
-        discount_amount = round(float(original_total - good_total), 2)
-        
-        position = {
-            "Count": abs(good["amount"]),
-            "Price": original_price_per_unit,  # Оригинальная цена за единицу
-            "PositionName": good["title"],
-            "Discount": discount_amount,  # Скидка в тенге
-            "Tax": "0",
-            "TaxType": "0", 
-            "TaxPercent": "0"
-        }
-        positions.append(position)
-        total_sum_for_webkassa += good_total
-        
-        logger.info(f"  📦 Good {i+1}: {good['title']}")
-        logger.info(f"     💵 Original cost: {good['cost_per_unit']} тенге x {abs(good['amount'])} = {original_total} тенге")
-        logger.info(f"     🎫 Discount: {good['discount']}% = {discount_amount} тенге")
-        logger.info(f"     💰 Total to pay: {good_total} тенге")
-
-    # Обработка платежей из transactions (уже извлеченных выше)
-    logger.info(f"💳 Processing {len(transactions)} transactions from Altegio document:")
-    
-    # Обработка платежей из Altegio document (стандартный формат)
-    for i, transaction in enumerate(transactions):
-        amount = transaction.get('amount', 0)
-        transaction_comment = transaction.get('comment', '')
-        
-        # Проверяем комментарий для исключения комиссии эквайринга
-        if should_skip_transaction(transaction_comment):
-            logger.info(f"  🚫 Skipping transaction {i+1}: acquiring commission fee (amount: {amount}, comment: '{transaction_comment}')")
-            continue
-            
-        if amount > 0:
-            account_info = transaction.get('account', {})
-            is_cash = account_info.get('is_cash', True)
-            account_title = account_info.get('title', 'Unknown')
-            
-            # Определяем тип платежа на основе is_cash
-            payment_type = 0 if is_cash else 1  # 0 = наличные, 1 = безналичный
-
-            payment = {
-                "Sum": float(amount),
-                "PaymentType": payment_type
-            }
-            payments.append(payment)
-            
-            payment_type_name = "Наличные" if payment_type == 0 else "Безналичный"
-            logger.info(f"  💳 Payment {i+1}: {amount} тенге ({payment_type_name})")
-            logger.info(f"     🏦 Account: {account_title}")
-            if transaction_comment:
-                logger.info(f"     💬 Comment: {transaction_comment}")
-
-    # Если платежи не были найдены в документе, используем общую сумму из webhook
-    if not payments:
-        default_payment = {
-            "Sum": round(float(total_sum_for_webkassa), 2),
-            "PaymentType": 1 # По умолчанию банковская карта
-        }
-        payments.append(default_payment)
-        logger.warning(f"⚠️ No payments found in Altegio document, using default payment: {round(total_sum_for_webkassa, 2)} тенге (Безналичный)")
-
-    webkassa_data = {
-        "CashboxUniqueNumber": os.getenv("WEBKASSA_CASHBOX_ID"),
-        "OperationType": 2,  # Продажа
-        "Positions": positions,
-        "TicketModifiers": [],
-        "Payments": payments,   
-        "Change": 0.0,
-        "RoundType": 2,
-        "ExternalCheckNumber": payload.data.id,#str(uuid.uuid4()),  # Генерируем уникальный ID для идемпотентности
-        "CustomerPhone": client_phone
-    }
-
-    logger.info(f"✅ Data transformation completed: check number {webkassa_data['ExternalCheckNumber']}")
-    logger.info(f"   📞 Customer phone: {client_phone}")
-    logger.info(f"   📦 Positions count: {len(positions)}")
-    logger.info(f"   💳 Payments count: {len(payments)}")
-    logger.info(f"   💰 Total amount: {total_sum_for_webkassa} тенге")
-    logger.info(f"   🔑 Token will be sent in Authorization header")
-    
-    return webkassa_data
-
-
-
-async def prepare_webkassa_data_for_goods_sale(payload: AltegioWebhookPayload, altegio_document: Dict[str, Any], db: AsyncSession, webkassa_token: str = None) -> Dict[str, Any]:
-    """
-    Преобразует данные из Altegio goods_operations_sale webhook в формат, ожидаемый Webкassa.
-    Специальная обработка для продаж товаров - данные берутся из документа продажи.
-    """
-    # Получаем токен из базы данных, если не передан
-    if not webkassa_token:
-        api_key_record = await get_webkassa_api_key(db)
-        if not api_key_record:
-            logger.warning("⚠️ No Webkassa API key found, attempting to get fresh key...")
-            
-            # Пытаемся получить новый ключ
-            refreshed_key = await refresh_webkassa_api_key(db)
-            if refreshed_key:
-                api_key_record = refreshed_key
-                logger.info("✅ Successfully obtained fresh API key for goods sale data preparation")
-            else:
-                error_msg = "Webkassa API key not found in database and unable to refresh"
-                logger.error(f"❌ {error_msg}")
-                
-                # Отправляем уведомление в Telegram о критической ошибке
-                await send_telegram_notification(
-                    "КРИТИЧЕСКАЯ ОШИБКА: Невозможно получить API ключ Webкassa для обработки продажи товаров",
-                    {
-                        "Проблема": "API ключ не найден в базе данных и не удалось получить новый",
-                        "Webhook ID": str(payload.resource_id),
-                        "Company ID": str(payload.company_id),
-                        "Тип": "goods_operations_sale",
-                        "Влияние": "Обработка webhook остановлена",
-                        "Требуется": "Проверка настроек Webkassa API и перезапуск скрипта обновления ключей"
-                    }
-                )
-                
-                raise ValueError(error_msg)
-        
-        webkassa_token = api_key_record.api_key
-        logger.info(f"🔑 Using webkassa token from database: {webkassa_token}")
-    
-    logger.info(f"🛒 Starting goods sale data transformation for Webkassa")
-    client_phone, client_name = get_client_data(payload.data.client)
-    logger.info(f"📥 Input goods sale webhook data: client_phone={client_phone}, resource_id={payload.resource_id}")
-    
-    positions = []
-    payments = []
-    total_sum_for_webkassa = 0
-
-    # Обработка товаров из документа продажи
-    if isinstance(altegio_document, dict) and altegio_document.get('data', {}).get('state', {}).get('items'):
-        sale_items = altegio_document.get('data', {}).get('state', {}).get('items', [])
-        logger.info(f"🛒 Processing {len(sale_items)} items from goods sale document:")
-        
-        for i, item in enumerate(sale_items):
-            # Извлекаем данные из формата goods sale document
-            item_count = abs(item.get('amount', 1))  # Используем абсолютное значение
-            item_price = round(float(item.get('default_cost_per_unit', 0)), 2)
-            item_discount_percent = item.get('client_discount_percent', 0)
-            item_total = round(float(item.get('cost_to_pay_total', 0)), 2)
-            
-            position = {
-                "Count": item_count,
-                "Price": item_price,
-                "PositionName": item.get('title', 'Unknown Item'),
-                "Discount": round(float((item_price * item_count) - item_total), 2),  # Рассчитываем скидку в тенге
-                "Tax": "0",
-                "TaxType": "0", 
-                "TaxPercent": "0"
-            }
-            positions.append(position)
-            total_sum_for_webkassa += item_total
-            
-            logger.info(f"  🛒 Sale Item {i+1}: {item.get('title', 'Unknown')}")
-            logger.info(f"     💵 Price: {item_price} тенге x {item_count} = {item_price * item_count} тенге")
-            logger.info(f"     🎫 Discount: {item_discount_percent}% = {(item_price * item_count) - item_total} тенге")
-            logger.info(f"     💰 Total to pay: {item_total} тенге")
-
-    # Обработка платежей из документа продажи
-    if isinstance(altegio_document, dict) and altegio_document.get('data', {}).get('state', {}).get('payment_transactions'):
-        sale_transactions = altegio_document.get('data', {}).get('state', {}).get('payment_transactions', [])
-        logger.info(f"💳 Processing {len(sale_transactions)} payment transactions from goods sale document:")
-        
-        for i, transaction in enumerate(sale_transactions):
-            amount = transaction.get('amount', 0)
-            transaction_comment = transaction.get('comment', '')
-            
-            # Проверяем комментарий для исключения комиссии эквайринга
-            if should_skip_transaction(transaction_comment):
-                logger.info(f"  🚫 Skipping payment transaction {i+1}: acquiring commission fee (amount: {amount}, comment: '{transaction_comment}')")
-                continue
-                
-            if amount > 0:
-                account_info = transaction.get('account', {})
-                is_cash = account_info.get('is_cash', True)
-                account_title = account_info.get('title', 'Unknown')
-                
-                # Определяем тип платежа на основе is_cash
-                payment_type = 0 if is_cash else 1  # 0 = наличные, 1 = безналичный
-
-                payment = {
-                    "Sum": round(float(amount), 2),
-                    "PaymentType": payment_type
-                }
-                payments.append(payment)
-                
-                payment_type_name = "Наличные" if payment_type == 0 else "Безналичный"
-                logger.info(f"  💳 Payment {i+1}: {amount} тенге ({payment_type_name})")
-                logger.info(f"     🏦 Account: {account_title}")
-                if transaction_comment:
-                    logger.info(f"     💬 Comment: {transaction_comment}")
-
-    # Если платежи не были найдены в документе, используем общую сумму
-    if not payments:
-        default_payment = {
-            "Sum": round(float(total_sum_for_webkassa), 2),
-            "PaymentType": 1  # По умолчанию безналичный
-        }
-        payments.append(default_payment)
-        logger.warning(f"⚠️ No payments found in goods sale document, using default payment: {round(total_sum_for_webkassa, 2)} тенге (Безналичный)")
-
-    webkassa_data = {
-        "CashboxUniqueNumber": os.getenv("WEBKASSA_CASHBOX_ID"),
-        "OperationType": 2,  # Продажа
-        "Positions": positions,
-        "TicketModifiers": [],
-        "Payments": payments,   
-        "Change": 0.0,
-        "RoundType": 2,
-        "ExternalCheckNumber": payload.data.id,
-        "CustomerPhone": client_phone
-    }
-
-    logger.info(f"✅ Goods sale data transformation completed: check number {webkassa_data['ExternalCheckNumber']}")
-    logger.info(f"   📞 Customer phone: {client_phone}")
-    logger.info(f"   📦 Positions count: {len(positions)}")
-    logger.info(f"   💳 Payments count: {len(payments)}")
-    logger.info(f"   💰 Total amount: {total_sum_for_webkassa} тенге")
-    logger.info(f"   🔑 Token will be sent in Authorization header")
-    
-    return webkassa_data
-
-
-
-async def send_to_webkassa_with_auto_refresh(db: AsyncSession, webkassa_data: dict, webhook_info: dict = None) -> dict:
+async def send_to_webkassa_with_auto_refresh(webkassa_data: dict, webhook_info: dict = None, tenant: TenantConfig = None) -> dict:
     """
     Отправляет данные в Webkassa API с автоматическим обновлением ключа при ошибке авторизации.
     
+    Соединение с БД берется только на время чтения ключа и не удерживается во время HTTP-запросов.
+    
     Args:
-        db: сессия базы данных
         webkassa_data: данные для отправки в Webkassa
         webhook_info: информация о webhook для улучшенного логирования
+        tenant: учетная запись и касса Webkassa компании (по умолчанию из окружения)
     """
+    tenant = tenant or default_tenant()
+    # Превью запроса для уведомлений: сериализуется не больше одного раза и только при ошибке
+    request_preview = LazyJson(webkassa_data, limit=500, indent=2)
+    
     # Получаем API ключ
-    api_key_record = await get_webkassa_api_key(db)
+    with start_span("db.api_key"):
+        api_key_record = await get_webkassa_api_key(service_name=tenant.service_name)
 
     if not api_key_record:
         error_message = "❌ No Webkassa API key found in database"
         logger.error(error_message)
         
         # Отправляем уведомление в Telegram
-        await send_telegram_notification(
+        telegram_notifier.notify(
             "Отсутствует API ключ Webкassa",
             {
                 "Ошибка": "API ключ не найден в базе данных",
@@ -800,7 +496,7 @@ async def send_to_webkassa_with_auto_refresh(db: AsyncSession, webkassa_data: di
         
         # Пытаемся обновить ключ
         logger.info("🔄 Attempting to get fresh API key...")
-        refreshed_key = await refresh_webkassa_api_key(db)
+        refreshed_key = await refresh_webkassa_api_key(tenant=tenant)
         if refreshed_key:
             api_key_record = refreshed_key
             logger.info("✅ Successfully obtained fresh API key")
@@ -809,7 +505,7 @@ async def send_to_webkassa_with_auto_refresh(db: AsyncSession, webkassa_data: di
             logger.error(final_error)
             
             # Критическое уведомление в Telegram
-            await send_telegram_notification(
+            telegram_notifier.notify(
                 "КРИТИЧЕСКАЯ ОШИБКА: Невозможно получить API ключ Webкassa",
                 {
                     "Проблема": "Не удалось получить API ключ из базы данных и обновить его",
@@ -847,24 +543,25 @@ async def send_to_webkassa_with_auto_refresh(db: AsyncSession, webkassa_data: di
             logger.error(f"   🔑 Current token (first 20): {api_token[:20]}...")
             
             # Уведомление в Telegram об ошибке авторизации
-            await send_telegram_notification(
+            telegram_notifier.notify(
                 "Ошибка авторизации Webкassa - истек срок действия токена",
                 {
                     "Тип ошибки": "Срок действия сессии истек (Code 2)",
                     "Текущий токен": f"{api_token[:20]}...{api_token[-10:]}",
                     "Ошибки API": "; ".join(result.get('errors', [])),
-                    "Касса": os.getenv('WEBKASSA_CASHBOX_ID'),
-                    "Данные запроса": json.dumps(webkassa_data, ensure_ascii=False, indent=2)[:400] + "..." if len(json.dumps(webkassa_data, ensure_ascii=False)) > 400 else json.dumps(webkassa_data, ensure_ascii=False, indent=2),
+                    "Касса": tenant.cashbox_id,
+                    "Данные запроса": str(request_preview),
                     "Позиции": f"{len(webkassa_data.get('Positions', []))} шт.",
                     "Платежи": f"{len(webkassa_data.get('Payments', []))} шт.",
                     "Телефон клиента": webkassa_data.get('CustomerPhone', 'Не указан'),
                     "Номер чека": webkassa_data.get('ExternalCheckNumber', 'Не указан'),
                     "Действие": "Попытка обновления API ключа"
-                }
+                },
+                dedup_key=f"token_expired:{tenant.cashbox_id}",
             )
             
-            # Пытаемся обновить ключ
-            refreshed_key = await refresh_webkassa_api_key(db)
+            # Пытаемся обновить ключ (другой воркер мог уже это сделать)
+            refreshed_key = await refresh_webkassa_api_key(stale_token=api_token, tenant=tenant)
             
             if refreshed_key:
                 logger.info("✅ Successfully refreshed API key, retrying request...")
@@ -874,7 +571,7 @@ async def send_to_webkassa_with_auto_refresh(db: AsyncSession, webkassa_data: di
                 logger.info(f"🔄 Token changed: {refreshed_key.api_key != api_token}")
                 
                 # Повторяем запрос с обновленным ключом (может быть тот же самый)
-                retry_result = await send_to_webkassa(webkassa_data, refreshed_key.api_key, webhook_info)
+                retry_result = await send_to_webkassa(webkassa_data, refreshed_key.api_key, webhook_info, attempt=1)
                 if retry_result["success"]:
                     logger.info("✅ Request succeeded after key refresh")
                     
@@ -882,7 +579,7 @@ async def send_to_webkassa_with_auto_refresh(db: AsyncSession, webkassa_data: di
                     token_changed = refreshed_key.api_key != api_token
                     status_message = "API ключ успешно обновлен" if token_changed else "API ключ актуален, повторный запрос успешен"
                     
-                    await send_telegram_notification(
+                    telegram_notifier.notify(
                         "✅ Проблема с авторизацией Webкassa решена",
                         {
                             "Результат": status_message,
@@ -896,7 +593,7 @@ async def send_to_webkassa_with_auto_refresh(db: AsyncSession, webkassa_data: di
                     logger.error(f"🔍 Retry failure details: {retry_result}")
                     
                     # Критическое уведомление о неудаче после обновления
-                    await send_telegram_notification(
+                    telegram_notifier.notify(
                         "🚨 КРИТИЧЕСКАЯ ОШИБКА: Webкassa не работает даже после обновления токена",
                         {
                             "Проблема": "Запрос не прошел даже с обновленным API ключом",
@@ -911,7 +608,7 @@ async def send_to_webkassa_with_auto_refresh(db: AsyncSession, webkassa_data: di
                 logger.error(f"🔍 Refresh failure details: refreshed_key={refreshed_key}")
                 
                 # Критическое уведомление о неудаче обновления
-                await send_telegram_notification(
+                telegram_notifier.notify(
                     "🚨 КРИТИЧЕСКАЯ ОШИБКА: Не удалось обновить API ключ Webкassa",
                     {
                         "Проблема": "Скрипт обновления API ключа не сработал",
@@ -933,48 +630,51 @@ async def send_to_webkassa_with_auto_refresh(db: AsyncSession, webkassa_data: di
                 break
         
         if shift_error_found:
-            logger.warning("⚠️ Shift close error detected - attempting to close shift...")
+            # Запасной путь: обычно смену заранее закрывает shift_manager
+            logger.warning("⚠️ Shift close error detected (scheduled close missed) - attempting to close shift...")
             
             # Детальное логирование ошибки смены
             logger.error(f"🔍 Shift close error details:")
             logger.error(f"   📋 Error messages: {result.get('errors', [])}")
             logger.error(f"   📋 Raw response: {result.get('raw_response', {})}")
-            logger.error(f"   📦 Cashbox ID: {os.getenv('WEBKASSA_CASHBOX_ID')}")
+            logger.error(f"   📦 Cashbox ID: {tenant.cashbox_id}")
             
             # Уведомление в Telegram об ошибке смены
-            await send_telegram_notification(
+            telegram_notifier.notify(
                 "Ошибка смены Webкassa - требуется закрытие смены",
                 {
                     "Тип ошибки": "Необходимо закрыть смену (Code 11)",
-                    "Касса": os.getenv('WEBKASSA_CASHBOX_ID'),
+                    "Касса": tenant.cashbox_id,
                     "Ошибки API": "; ".join(result.get('errors', [])),
-                    "Данные запроса": json.dumps(webkassa_data, ensure_ascii=False, indent=2)[:400] + "..." if len(json.dumps(webkassa_data, ensure_ascii=False)) > 400 else json.dumps(webkassa_data, ensure_ascii=False, indent=2),
+                    "Данные запроса": str(request_preview),
                     "Позиции": f"{len(webkassa_data.get('Positions', []))} шт.",
                     "Платежи": f"{len(webkassa_data.get('Payments', []))} шт.",
                     "Телефон клиента": webkassa_data.get('CustomerPhone', 'Не указан'),
                     "Номер чека": webkassa_data.get('ExternalCheckNumber', 'Не указан'),
                     "Токен": f"{api_token[:20]}...{api_token[-10:]}",
                     "Действие": "Попытка автоматического закрытия смены"
-                }
+                },
+                dedup_key=f"shift_close_required:{tenant.cashbox_id}",
             )
             
             # Пытаемся закрыть смену
-            closed_shift = await close_webkassa_shift(db, api_token, webhook_info)
+            closed_shift = await close_webkassa_shift(api_token, webhook_info, cashbox_id=tenant.cashbox_id)
             
             if closed_shift["success"]:
                 logger.info("✅ Successfully closed shift, retrying original request...")
+                await shift_manager.record_closed(tenant.cashbox_id)
                 
                 # Повторяем запрос после закрытия смены
-                retry_result = await send_to_webkassa(webkassa_data, api_token, webhook_info)
+                retry_result = await send_to_webkassa(webkassa_data, api_token, webhook_info, attempt=1)
                 if retry_result["success"]:
                     logger.info("✅ Request succeeded after shift close")
                     
                     # Успешное уведомление
-                    await send_telegram_notification(
+                    telegram_notifier.notify(
                         "✅ Проблема со сменой Webкassa решена",
                         {
                             "Результат": "Смена успешно закрыта",
-                            "Касса": os.getenv('WEBKASSA_CASHBOX_ID'),
+                            "Касса": tenant.cashbox_id,
                             "Статус": "Запрос успешно выполнен после закрытия смены"
                         }
                     )
@@ -983,11 +683,11 @@ async def send_to_webkassa_with_auto_refresh(db: AsyncSession, webkassa_data: di
                     logger.error(f"🔍 Retry after shift close failure: {retry_result}")
                     
                     # Критическое уведомление о неудаче после закрытия смены
-                    await send_telegram_notification(
+                    telegram_notifier.notify(
                         "🚨 КРИТИЧЕСКАЯ ОШИБКА: Webкassa не работает даже после закрытия смены",
                         {
                             "Проблема": "Запрос не прошел даже после закрытия смены",
-                            "Касса": os.getenv('WEBKASSA_CASHBOX_ID'),
+                            "Касса": tenant.cashbox_id,
                             "Ошибки": "; ".join(retry_result.get('errors', [])),
                             "Требуется": "Немедленная проверка состояния кассы"
                         }
@@ -998,11 +698,11 @@ async def send_to_webkassa_with_auto_refresh(db: AsyncSession, webkassa_data: di
                 logger.error(f"🔍 Shift close failure details: {closed_shift}")
                 
                 # Критическое уведомление о неудаче закрытия смены
-                await send_telegram_notification(
+                telegram_notifier.notify(
                     "🚨 КРИТИЧЕСКАЯ ОШИБКА: Не удалось закрыть смену Webкassa",
                     {
                         "Проблема": "Автоматическое закрытие смены не сработало",
-                        "Касса": os.getenv('WEBKASSA_CASHBOX_ID'),
+                        "Касса": tenant.cashbox_id,
                         "Ошибки закрытия": "; ".join(closed_shift.get('errors', [])),
                         "Требуется": "Ручное закрытие смены через веб-интерфейс Webкassa"
                     }
@@ -1018,27 +718,63 @@ async def send_to_webkassa_with_auto_refresh(db: AsyncSession, webkassa_data: di
         logger.error(f"   📋 Raw response: {result.get('raw_response', {})}")
         
         # Уведомление в Telegram о неопознанной ошибке
-        await send_telegram_notification(
+        telegram_notifier.notify(
             "Неопознанная ошибка Webкassa API",
             {
                 "Тип": "Общая ошибка API",
                 "Ошибка": result.get('error', 'Unknown'),
                 "Ошибки API": "; ".join(result.get('errors', [])),
-                "Касса": os.getenv('WEBKASSA_CASHBOX_ID'),
+                "Касса": tenant.cashbox_id,
                 "Токен": f"{api_token[:20]}...{api_token[-10:]}",
-                "Данные запроса": json.dumps(webkassa_data, ensure_ascii=False, indent=2)[:500] + "..." if len(json.dumps(webkassa_data, ensure_ascii=False)) > 500 else json.dumps(webkassa_data, ensure_ascii=False, indent=2),
+                "Данные запроса": str(request_preview),
                 "Позиции": f"{len(webkassa_data.get('Positions', []))} шт.",
                 "Платежи": f"{len(webkassa_data.get('Payments', []))} шт.",
                 "Телефон клиента": webkassa_data.get('CustomerPhone', 'Не указан'),
                 "Номер чека": webkassa_data.get('ExternalCheckNumber', 'Не указан'),
                 "Требуется": "Проверка логов и состояния API"
-            }
+            },
+            dedup_key=f"unknown_error:{tenant.cashbox_id}:{result.get('error')}:{result.get('errors')}",
         )
     
     return result
 
 
-async def send_to_webkassa(data: dict, api_token: str, webhook_info: dict = None) -> dict:
+async def send_to_webkassa(data: dict, api_token: str, webhook_info: dict = None, attempt: int = 0) -> dict:
+    """
+    Отправляет чек в Webkassa и ставит попытку в журнал fiscalization_logs.
+
+    Запись журнала уходит в фоновый буфер и не добавляет обращения к базе
+    на пути фискализации. attempt - номер повтора (0 для первой попытки).
+    """
+    started_at = datetime.utcnow()
+    started = time.monotonic()
+    with track_stage("webkassa_send", attempt=attempt, check_number=str(data.get("ExternalCheckNumber"))) as span:
+        result = await post_webkassa_check(data, api_token, webhook_info)
+        if not result.get("success"):
+            span.set_error(str(result.get("errors") or result.get("error")))
+    duration_ms = int((time.monotonic() - started) * 1000)
+
+    if result.get("success"):
+        status, error_message = "success", None
+    else:
+        status = "failed"
+        error_message = "; ".join(result["errors"]) if result.get("errors") else result.get("error")
+    fiscalization_log_writer.record(
+        webhook_record_id=(webhook_info or {}).get("record_id"),
+        request=data,  # без Token
+        response=result.get("data") or result.get("raw_response"),
+        status=status,
+        error_message=error_message,
+        retry_count=attempt,
+        created_at=started_at,
+        completed_at=datetime.utcnow(),
+        duration_ms=duration_ms,
+        correlation_id=current_trace_id(),
+    )
+    return result
+
+
+async def post_webkassa_check(data: dict, api_token: str, webhook_info: dict = None) -> dict:
     """
     Отправляет подготовленные данные в API Webkassa.
     
@@ -1071,17 +807,25 @@ async def send_to_webkassa(data: dict, api_token: str, webhook_info: dict = None
     logger.info(f"🌐 Sending to Webkassa API: {endpoint_url}")
     logger.info(f"🔑 Using API token in body: {api_token[:20]}...")
     logger.info(f"📋 Request headers: {headers}")
-    logger.info(f"📋 Request data: {json.dumps(request_data, ensure_ascii=False, indent=2)}")
+    log_payload(logger, "📋 Request data", data)
+
+    if not webkassa_breaker.allow():
+        retry_in = webkassa_breaker.retry_in()
+        logger.error(f"⛔ Webkassa API call skipped: circuit breaker open (retry in {retry_in:.0f}s)")
+        webkassa_errors.inc(code="circuit_open")
+        return {"success": False, "error": f"Webkassa API unavailable: circuit breaker open, retry in {retry_in:.0f}s"}
 
     try:
         async with httpx.AsyncClient() as client:
             response = await client.post(endpoint_url, json=request_data, headers=headers, timeout=30)
+            if response.status_code >= 500:
+                webkassa_breaker.record_failure(f"HTTP {response.status_code}")
+            else:
+                webkassa_breaker.record_success()
             response_data = response.json()
             
-            # Логируем ответ с декодированием Unicode
-            formatted_response = format_api_response(response_data)
-            logger.info(f"📤 Webkassa API response received:")
-            logger.info(f"🎯 Response: {formatted_response}")
+            logger.info(f"📤 Webkassa API response received (HTTP {response.status_code})")
+            log_payload(logger, "🎯 Response", response_data)
             
             # Если есть ошибки в ответе, извлекаем и декодируем их
             if "Errors" in response_data and response_data["Errors"]:
@@ -1091,13 +835,14 @@ async def send_to_webkassa(data: dict, api_token: str, webhook_info: dict = None
                     decoded_error = decode_unicode_escapes(error_text)
                     error_code = error.get("Code", "")
                     error_messages.append(f"Code {error_code}: {decoded_error}")
+                    webkassa_errors.inc(code=error_code)
                 
                 # Формируем детальное сообщение об ошибке с информацией о webhook
                 error_log_message = f"❌ Webkassa API errors: {'; '.join(error_messages)}"
                 if webhook_info:
                     error_log_message += f" | Webhook Details: resource_id={webhook_info.get('resource_id')}, company_id={webhook_info.get('company_id')}, client={webhook_info.get('client_name', 'Unknown')}, phone={webhook_info.get('client_phone', 'Unknown')}, comment='{webhook_info.get('comment', '')}'"
                     # Также логируем полный webhook для детального анализа
-                    logger.error(f"🔍 Full webhook data for error analysis: {json.dumps(webhook_info.get('full_webhook', {}), ensure_ascii=False, indent=2)}")
+                    log_payload(logger, "🔍 Full webhook data for error analysis", webhook_info.get('full_webhook', {}), level=logging.ERROR)
                 
                 logger.error(error_log_message)
                 return {"success": False, "errors": error_messages, "raw_response": response_data}
@@ -1109,8 +854,10 @@ async def send_to_webkassa(data: dict, api_token: str, webhook_info: dict = None
         error_message = f"Webkassa API request failed: {e}"
         if webhook_info:
             error_message += f" | Webhook Details: resource_id={webhook_info.get('resource_id')}, company_id={webhook_info.get('company_id')}, client={webhook_info.get('client_name', 'Unknown')}, phone={webhook_info.get('client_phone', 'Unknown')}"
-            logger.error(f"🔍 Full webhook data for network error: {json.dumps(webhook_info.get('full_webhook', {}), ensure_ascii=False, indent=2)}")
+            log_payload(logger, "🔍 Full webhook data for network error", webhook_info.get('full_webhook', {}), level=logging.ERROR)
         logger.error(error_message)
+        webkassa_breaker.record_failure(f"network: {type(e).__name__}")
+        webkassa_errors.inc(code="network")
         return {"success": False, "error": f"Network error: {e}"}
     except httpx.HTTPStatusError as e:
         error_text = e.response.text
@@ -1118,28 +865,31 @@ async def send_to_webkassa(data: dict, api_token: str, webhook_info: dict = None
         error_message = f"Webkassa API returned error status {e.response.status_code}: {decoded_error}"
         if webhook_info:
             error_message += f" | Webhook Details: resource_id={webhook_info.get('resource_id')}, company_id={webhook_info.get('company_id')}, client={webhook_info.get('client_name', 'Unknown')}, phone={webhook_info.get('client_phone', 'Unknown')}"
-            logger.error(f"🔍 Full webhook data for HTTP error: {json.dumps(webhook_info.get('full_webhook', {}), ensure_ascii=False, indent=2)}")
+            log_payload(logger, "🔍 Full webhook data for HTTP error", webhook_info.get('full_webhook', {}), level=logging.ERROR)
         logger.error(error_message)
+        webkassa_errors.inc(code=f"http_{e.response.status_code}")
         return {"success": False, "error": f"API error: {decoded_error}"}
     except Exception as e:
         error_message = f"Unexpected error during Webkassa API call: {e}"
         if webhook_info:
             error_message += f" | Webhook Details: resource_id={webhook_info.get('resource_id')}, company_id={webhook_info.get('company_id')}, client={webhook_info.get('client_name', 'Unknown')}, phone={webhook_info.get('client_phone', 'Unknown')}"
-            logger.error(f"🔍 Full webhook data for unexpected error: {json.dumps(webhook_info.get('full_webhook', {}), ensure_ascii=False, indent=2)}")
+            log_payload(logger, "🔍 Full webhook data for unexpected error", webhook_info.get('full_webhook', {}), level=logging.ERROR)
         logger.error(error_message)
+        webkassa_errors.inc(code="unexpected")
         return {"success": False, "error": f"Unexpected error: {e}"}
 
 
 @router.post("/webhook", response_model=WebhookResponse)
-async def handle_altegio_webhook(
-    request: Request,
-    db: AsyncSession = Depends(get_db_session)
-):
+async def handle_altegio_webhook(request: Request):
     """
     Обработка webhook от Altegio с универсальной обработкой ошибок валидации
+    
+    Сессия БД на весь запрос не берется: обработка открывает короткие транзакции
+    между обращениями к Altegio и Webkassa.
     """
     try:
         # Получаем сырые данные
+        parse_started = time.perf_counter()
         body = await request.body()
         body_text = body.decode('utf-8') if body else ""
         
@@ -1150,13 +900,17 @@ async def handle_altegio_webhook(
             raw_data = json.loads(body_text) if body_text else {}
         except json.JSONDecodeError as e:
             logger.error(f"❌ Invalid JSON received: {e}")
+            webhook_skips.inc(resource="unknown", reason="invalid_json")
             return WebhookResponse(
                 success=False,
                 message="Invalid JSON format",
                 processed_count=0
             )
         
+        stage_seconds.observe(time.perf_counter() - parse_started, stage="body_parse")
+        
         # Пытаемся валидировать с помощью Pydantic
+        validation_started = time.perf_counter()
         try:
             # Проверяем, является ли это списком или одиночным webhook
             if isinstance(raw_data, list):
@@ -1205,6 +959,8 @@ async def handle_altegio_webhook(
                     processed_count=0
                 )
         
+        stage_seconds.observe(time.perf_counter() - validation_started, stage="validation")
+        
         # Запускаем worker если он не запущен
         # ensure_queue_worker_running()
         
@@ -1214,7 +970,7 @@ async def handle_altegio_webhook(
         tasks = []
         results = []
         for single_payload in webhook_list:
-            task = WebhookTask(single_payload, request, db)
+            task = WebhookTask(single_payload, request)
             tasks.append(task)
             result = await task.run()
             logger.info(f"📤 Webhook {task.task_id} processed immediately")
@@ -1307,13 +1063,141 @@ def create_flexible_webhook(raw_data: dict) -> Optional[AltegioWebhookPayload]:
         return None
 
 
+def parse_record_date(payload: AltegioWebhookPayload) -> datetime:
+    """Дата записи из webhook (datetime или create_date), иначе текущее время"""
+    for field_name in ("datetime", "create_date"):
+        value = getattr(payload.data, field_name)
+        if not value:
+            continue
+        try:
+            return datetime.fromisoformat(value.replace(" ", "T").split("+")[0])
+        except (ValueError, AttributeError) as e:
+            logger.warning(f"Failed to parse {field_name} '{value}': {e}, using current time")
+            break
+    return datetime.utcnow()
+
+
+# Ключ (company_id, resource_id) уникален в webhook_record_keys; сама запись живет
+# в секционированной webhook_records, payload - в webhook_payloads. Все три таблицы
+# пишутся одним запросом (data-modifying CTE), внешние ключи проверяются в конце запроса.
+UPSERT_WEBHOOK_RECORD_SQL = text("""
+    WITH record_key AS (
+        INSERT INTO webhook_record_keys (company_id, resource_id, record_id, created_at)
+        VALUES (:company_id, :resource_id, nextval(pg_get_serial_sequence('webhook_records', 'id')), :now)
+        ON CONFLICT (company_id, resource_id) DO UPDATE SET company_id = EXCLUDED.company_id
+        RETURNING record_id, created_at, (xmax = 0) AS inserted
+    ),
+    inserted_record AS (
+        INSERT INTO webhook_records (
+            id, created_at, updated_at, company_id, resource, resource_id, status,
+            client_phone, client_name, record_date, comment, processed
+        )
+        SELECT record_id, created_at, :now, :company_id, :resource, :resource_id, :status,
+            :client_phone, :client_name, :record_date, :comment, false
+        FROM record_key WHERE inserted
+        RETURNING id, created_at
+    ),
+    reset_record AS (
+        UPDATE webhook_records SET
+            status = :status,
+            client_phone = :client_phone,
+            client_name = :client_name,
+            record_date = :record_date,
+            comment = :comment,
+            updated_at = :now,
+            processing_error = NULL,
+            webkassa_status = NULL,
+            webkassa_request_id = NULL
+        FROM record_key
+        WHERE NOT record_key.inserted
+            AND webhook_records.id = record_key.record_id
+            AND webhook_records.created_at = record_key.created_at
+            AND NOT webhook_records.processed
+        RETURNING webhook_records.id, webhook_records.created_at
+    ),
+    record AS (
+        SELECT id, created_at, true AS inserted FROM inserted_record
+        UNION ALL
+        SELECT id, created_at, false AS inserted FROM reset_record
+    ),
+    payload AS (
+        INSERT INTO webhook_payloads (record_id, created_at, raw_data, services_data, webkassa_response, updated_at)
+        SELECT id, created_at, :raw_data, :services_data, NULL, :now FROM record
+        ON CONFLICT (record_id, created_at) DO UPDATE SET
+            raw_data = EXCLUDED.raw_data,
+            services_data = EXCLUDED.services_data,
+            webkassa_response = NULL,
+            updated_at = EXCLUDED.updated_at
+    )
+    SELECT id, created_at, inserted FROM record
+""").bindparams(bindparam("raw_data", type_=JSONB), bindparam("services_data", type_=JSONB))
+
+
+async def upsert_webhook_record(payload: AltegioWebhookPayload) -> Tuple[Optional[int], Optional[datetime], bool]:
+    """
+    Вставляет запись webhook или сбрасывает существующую необработанную для повтора
+    одним запросом и одним commit (см. UPSERT_WEBHOOK_RECORD_SQL).
+
+    Returns: (id записи, ее created_at - ключ секции, вставлена ли новая);
+    (None, None, False), если webhook уже обработан
+    (или его прямо сейчас вставляет параллельная доставка того же webhook)
+    """
+    client_phone, client_name = get_client_data(payload.data.client)
+    params = {
+        "company_id": payload.company_id,
+        "resource": payload.resource,
+        "resource_id": payload.resource_id,
+        "status": payload.status,
+        "client_phone": client_phone,
+        "client_name": client_name,
+        "record_date": parse_record_date(payload),
+        "comment": payload.data.comment,
+        "raw_data": payload.model_dump(),
+        "services_data": [s.model_dump() for s in payload.data.services],
+        "now": datetime.utcnow(),
+    }
+
+    async with AsyncSessionLocal() as db:
+        result = await db.execute(UPSERT_WEBHOOK_RECORD_SQL, params)
+        row = result.first()
+        await db.commit()
+    if row is None:
+        return None, None, False
+    return row.id, row.created_at, row.inserted
+
+
+async def finish_webhook_record(record_id: int, created_at: datetime, processed: bool = False,
+                                webkassa_response: Optional[dict] = None, **values):
+    """
+    Записывает итог обработки webhook в короткой транзакции: статус в webhook_records,
+    ответ Webkassa (если есть) - в webhook_payloads. created_at входит в условия, чтобы
+    Postgres обновлял одну секцию, а не проверял индексы всех месяцев.
+    """
+    with start_span("db.finish_record", record_id=record_id):
+        async with AsyncSessionLocal() as db:
+            await db.execute(
+                update(WebhookRecord)
+                .where(WebhookRecord.id == record_id, WebhookRecord.created_at == created_at)
+                .values(processed=processed, updated_at=datetime.utcnow(), **values)
+            )
+            if webkassa_response is not None:
+                await db.execute(
+                    update(WebhookPayload)
+                    .where(WebhookPayload.record_id == record_id, WebhookPayload.created_at == created_at)
+                    .values(webkassa_response=webkassa_response, updated_at=datetime.utcnow())
+                )
+            await db.commit()
+
+
 async def process_webhook_internal(
     payload: AltegioWebhookPayload,
-    request: Request,
-    db: AsyncSession
+    request: Request
 ) -> dict:
     """
     Внутренняя функция обработки одного webhook
+    
+    Каждое обращение к БД - отдельная короткая транзакция: во время запросов к Altegio,
+    Webkassa и скрипта обновления ключа соединение из пула не удерживается.
     """
     try:
         logger.info(f"Processing webhook: company_id={payload.company_id}, "
@@ -1325,6 +1209,7 @@ async def process_webhook_internal(
             raise HTTPException(status_code=401, detail="Invalid webhook signature")
         
         # Проверяем условия для обработки
+        eligibility_started = time.perf_counter()
         comment_text = payload.data.comment or ""
         has_fch = 'фч' in comment_text.lower() if comment_text else False
         
@@ -1344,6 +1229,7 @@ async def process_webhook_internal(
         else:
             # Неподдерживаемый тип webhook - игнорируем
             logger.info(f"🚫 Unsupported resource type '{payload.resource}' for webhook {payload.resource_id}, ignoring...")
+            webhook_skips.inc(resource=payload.resource, reason="unsupported_resource")
             return {
                 "success": True,
                 "message": f"Webhook {payload.resource_id} ignored - unsupported resource type '{payload.resource}'",
@@ -1361,98 +1247,38 @@ async def process_webhook_internal(
             logger.info(f"   �️ Goods sale: requires 'фч' comment {'✅' if has_fch else '❌'}")
         
         logger.info(f"   🎯 Overall result: {'✅ PROCESSING' if conditions_met else '❌ SKIPPING'}")
+        stage_seconds.observe(time.perf_counter() - eligibility_started, stage="eligibility")
         
         if not conditions_met:
             logger.info(f"Webhook {payload.resource_id} does not meet the required conditions for processing.")
+            if not has_fch:
+                webhook_skips.inc(resource=payload.resource, reason="no_fch_comment")
+            else:
+                webhook_skips.inc(resource=payload.resource, reason="not_paid_full")
             return {
                 "success": True,
                 "message": f"Webhook {payload.resource_id} skipped due to conditions",
                 "processed_count": 0
             }
 
-        # Проверяем, не был ли уже обработан
-        existing_record = await db.execute(
-            select(WebhookRecord).filter(
-                WebhookRecord.resource_id == payload.resource_id,
-                WebhookRecord.company_id == payload.company_id,
-                WebhookRecord.processed == True
-            )
-        )
-        if existing_record.scalars().first():
+        # Один запрос: вставляем запись или сбрасываем необработанную для повтора.
+        # Уже обработанная запись не меняется, и RETURNING ничего не вернет.
+        with track_stage("db_upsert"):
+            record_id, record_created_at, inserted = await upsert_webhook_record(payload)
+        if record_id is None:
             logger.info(f"✅ Webhook with resource_id {payload.resource_id} already successfully processed, skipping.")
+            webhook_skips.inc(resource=payload.resource, reason="already_processed")
             return {
                 "success": True,
                 "message": f"Webhook {payload.resource_id} already processed",
                 "processed_count": 0
             }
 
-        # Остальная логика обработки webhook
-        # Ищем существующую запись или создаем новую
-        webhook_record = await db.execute(
-            select(WebhookRecord).filter(
-                WebhookRecord.resource_id == payload.resource_id,
-                WebhookRecord.company_id == payload.company_id
-            )
-        )
-        webhook_record = webhook_record.scalars().first()
-
-        if webhook_record:
-            # Обновляем существующую запись
-            logger.info(f"🔄 Found existing webhook record (ID: {webhook_record.id}), updating for retry...")
-            webhook_record.status = payload.status
-            client_phone, client_name = get_client_data(payload.data.client)
-            webhook_record.client_phone = client_phone
-            webhook_record.client_name = client_name
-            # Обрабатываем datetime
-            if payload.data.datetime:
-                webhook_record.record_date = datetime.fromisoformat(payload.data.datetime.replace(" ", "T").split("+")[0])
-            elif payload.data.create_date:
-                webhook_record.record_date = datetime.fromisoformat(payload.data.create_date.replace(" ", "T").split("+")[0])
-            else:
-                webhook_record.record_date = datetime.utcnow()
-            webhook_record.services_data = json.dumps([s.model_dump() for s in payload.data.services])
-            webhook_record.comment = payload.data.comment
-            webhook_record.raw_data = payload.model_dump()
-            webhook_record.updated_at = datetime.utcnow()
-            webhook_record.processed = False
-            webhook_record.processing_error = None
-            webhook_record.webkassa_status = None
-            webhook_record.webkassa_response = None
-            webhook_record.webkassa_request_id = None
+        if inserted:
+            logger.info(f"📝 Created new webhook record for resource_id {payload.resource_id}")
         else:
-            # Создаем новую запись
-            logger.info(f"📝 Creating new webhook record for resource_id {payload.resource_id}")
-            record_date = datetime.utcnow()
-            if payload.data.datetime:
-                try:
-                    record_date = datetime.fromisoformat(payload.data.datetime.replace(" ", "T").split("+")[0])
-                except (ValueError, AttributeError) as e:
-                    logger.warning(f"Failed to parse datetime '{payload.data.datetime}': {e}, using current time")
-            elif payload.data.create_date:
-                try:
-                    record_date = datetime.fromisoformat(payload.data.create_date.replace(" ", "T").split("+")[0])
-                except (ValueError, AttributeError) as e:
-                    logger.warning(f"Failed to parse create_date '{payload.data.create_date}': {e}, using current time")
-            
-            client_phone, client_name = get_client_data(payload.data.client)
-            webhook_record = WebhookRecord(
-                company_id=payload.company_id,
-                resource=payload.resource,
-                resource_id=payload.resource_id,
-                status=payload.status,
-                client_phone=client_phone,
-                client_name=client_name,
-                record_date=record_date,
-                services_data=json.dumps([s.model_dump() for s in payload.data.services]),
-                comment=payload.data.comment,
-                raw_data=payload.model_dump()
-            )
-            db.add(webhook_record)
-        
-        await db.commit()
-        await db.refresh(webhook_record)
-        
-        logger.info(f"Webhook saved/updated in database with ID: {webhook_record.id}")
+            logger.info(f"🔄 Found existing webhook record (ID: {record_id}), updating for retry...")
+        logger.info(f"Webhook saved/updated in database with ID: {record_id}")
         
         # Теперь обрабатываем фискализацию
         try:
@@ -1466,9 +1292,8 @@ async def process_webhook_internal(
             
             if not altegio_document_id:
                 logger.warning(f"No document ID found in webhook for resource_id {payload.resource_id}")
-                webhook_record.processing_error = "No document ID found in webhook"
-                webhook_record.processed = False
-                await db.commit()
+                webhook_skips.inc(resource=payload.resource, reason="no_document_id")
+                await finish_webhook_record(record_id, record_created_at, processing_error="No document ID found in webhook")
                 return {
                     "success": False,
                     "message": f"No document ID found for webhook {payload.resource_id}",
@@ -1480,12 +1305,13 @@ async def process_webhook_internal(
             try:
                 logger.info(f"Requesting Altegio document: company_id={payload.company_id}, document_id={altegio_document_id}, resource={payload.resource}")
                 
-                if payload.resource == "goods_operations_sale":
-                    logger.info(f"🛍️ Using goods sale document API for resource_id {payload.resource_id}")
-                    altegio_document = await get_altegio_sale_document(payload.company_id, altegio_document_id)
-                else:
-                    logger.info(f"📋 Using transactions document API for resource_id {payload.resource_id}")
-                    altegio_document = await get_altegio_document(payload.company_id, altegio_document_id)
+                with track_stage("altegio_fetch"):
+                    if payload.resource == "goods_operations_sale":
+                        logger.info(f"🛍️ Using goods sale document API for resource_id {payload.resource_id}")
+                        altegio_document = await get_altegio_sale_document(payload.company_id, altegio_document_id)
+                    else:
+                        logger.info(f"📋 Using transactions document API for resource_id {payload.resource_id}")
+                        altegio_document = await get_altegio_document(payload.company_id, altegio_document_id)
                 
                 logger.info(f"✅ Successfully fetched Altegio document for resource_id {payload.resource_id}")
             except HTTPException as altegio_error:
@@ -1503,26 +1329,43 @@ async def process_webhook_internal(
                 
             if not has_data:
                 logger.warning(f"No data found in Altegio document for resource_id {payload.resource_id}")
-                webhook_record.processing_error = "No data found in Altegio document"
-                webhook_record.processed = False
-                await db.commit()
+                webhook_skips.inc(resource=payload.resource, reason="empty_altegio_document")
+                await finish_webhook_record(record_id, record_created_at, processing_error="No data found in Altegio document")
                 return {
                     "success": False,
                     "message": f"No data in Altegio document for webhook {payload.resource_id}",
                     "processed_count": 0
                 }
 
-            # Подготавливаем данные для Webkassa
-            if payload.resource == "goods_operations_sale":
-                webkassa_data = await prepare_webkassa_data_for_goods_sale(payload, altegio_document, db)
-            else:
-                webkassa_data = await prepare_webkassa_data(payload, altegio_document, db)
+            # Учетная запись и касса Webkassa этой компании
+            with start_span("db.tenant_lookup"):
+                async with AsyncSessionLocal() as db:
+                    tenant = await tenant_registry.get(db, payload.company_id)
             
-            logger.info(f"💰 Prepared Webkassa fiscalization data for {payload.resource_id}")
+            # Подготавливаем данные для Webkassa (без обращений к БД и сети)
+            try:
+                with track_stage("receipt_build"):
+                    webkassa_data = build_receipt(payload, altegio_document, tenant.cashbox_id)
+            except ReceiptMismatchError as mismatch:
+                # Несходящийся чек Webkassa все равно отклонит - не тратим на него запрос
+                logger.error(f"❌ {mismatch} for resource_id {payload.resource_id}")
+                webhook_skips.inc(resource=payload.resource, reason="receipt_mismatch")
+                await finish_webhook_record(record_id, record_created_at, processing_error=str(mismatch))
+                return {
+                    "success": False,
+                    "message": f"Receipt totals mismatch for webhook {payload.resource_id}",
+                    "processed_count": 0
+                }
+            
+            logger.info(f"💰 Prepared Webkassa fiscalization data for {payload.resource_id}: "
+                        f"check number {webkassa_data['ExternalCheckNumber']}, "
+                        f"{len(webkassa_data['Positions'])} position(s), {len(webkassa_data['Payments'])} payment(s), "
+                        f"total {sum(p['Sum'] for p in webkassa_data['Payments'])} тенге")
 
             # Подготавливаем информацию о webhook для логирования
             client_phone, client_name = get_client_data(payload.data.client)
             webhook_info = {
+                "record_id": record_id,
                 "resource_id": payload.resource_id,
                 "company_id": payload.company_id,
                 "client_name": client_name if client_name else "Unknown",
@@ -1534,48 +1377,54 @@ async def process_webhook_internal(
                 "full_webhook": payload.model_dump()
             }
 
-            webkassa_response = await send_to_webkassa_with_auto_refresh(db, webkassa_data, webhook_info)
+            async with shift_manager.check_in_flight(tenant.cashbox_id, tenant.service_name):
+                webkassa_response = await send_to_webkassa_with_auto_refresh(webkassa_data, webhook_info, tenant=tenant)
+            
+            if webkassa_response.get("success"):
+                await shift_manager.record_check(tenant.cashbox_id, tenant.service_name, webkassa_response.get("data"))
             
             is_success = webkassa_response.get("success", False)
+            external_check_number = webkassa_data.get("ExternalCheckNumber")
+            result_values = {
+                "webkassa_response": webkassa_response,
+                "webkassa_request_id": str(external_check_number) if external_check_number is not None else None,
+            }
             if is_success:
                 logger.info(f"✅ SUCCESS: Webkassa fiscalization completed for {payload.resource_id}")
-                webhook_record.processed = True
-                webhook_record.processed_at = datetime.utcnow()
-                webhook_record.webkassa_status = "success"
-                webhook_record.processing_error = None
+                result_values.update(
+                    processed=True,
+                    processed_at=datetime.utcnow(),
+                    webkassa_status="success",
+                    processing_error=None,
+                )
                 processed_count = 1
             else:
                 logger.info(f"❌ FAILED: Webkassa fiscalization failed for {payload.resource_id}")
-                webhook_record.processed = False
-                webhook_record.processed_at = None
-                webhook_record.webkassa_status = "failed"
-                
                 error_details = []
                 if "errors" in webkassa_response:
                     error_details.extend(webkassa_response["errors"])
                 if "error" in webkassa_response:
                     error_details.append(webkassa_response["error"])
-                webhook_record.processing_error = "; ".join(error_details) if error_details else "Unknown Webkassa error"
+                result_values.update(
+                    processed_at=None,
+                    webkassa_status="failed",
+                    processing_error="; ".join(error_details) if error_details else "Unknown Webkassa error",
+                )
                 processed_count = 0
 
             # Сохраняем результат
-            webhook_record.webkassa_response = json.dumps(webkassa_response)
-            external_check_number = webkassa_data.get("ExternalCheckNumber")
-            webhook_record.webkassa_request_id = str(external_check_number) if external_check_number is not None else None
-            await db.commit()
+            await finish_webhook_record(record_id, record_created_at, **result_values)
             
             return {
                 "success": is_success,
                 "message": f"Webhook {payload.resource_id} processed {'successfully' if is_success else 'with errors'}",
                 "processed_count": processed_count,
-                "record_id": webhook_record.id
+                "record_id": record_id
             }
             
         except Exception as e:
             logger.error(f"Error processing webhook {payload.resource_id}: {str(e)}", exc_info=True)
-            webhook_record.processing_error = str(e)
-            webhook_record.processed = False
-            await db.commit()
+            await finish_webhook_record(record_id, record_created_at, processing_error=str(e))
             return {
                 "success": False,
                 "message": f"Processing error for webhook {payload.resource_id}: {str(e)}",
@@ -1593,55 +1442,6 @@ async def process_webhook_internal(
         }
 
 
-# Вспомогательные функции
-async def send_telegram_notification(message: str, error_details: dict = None) -> bool:
-    """
-    Отправляет уведомление в Telegram о критических ошибках
-    """
-    bot_token = "7922422379:AAEjk9PZuF8HgHNK3UoVDn-RIMXZhCfKewk"
-    chat_id = os.getenv("TELEGRAM_CHAT_ID", "1125559425")  # ID чата для уведомлений
-    
-    # Формируем сообщение
-    telegram_message = f"🚨 ОШИБКА WEBKASSA\n\n"
-    telegram_message += f"📅 Время: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n"
-    telegram_message += f"💬 Сообщение: {message}\n\n"
-    
-    if error_details:
-        telegram_message += "📋 Детали ошибки:\n"
-        for key, value in error_details.items():
-            # Обрезаем длинные значения для читаемости
-            if isinstance(value, str) and len(value) > 400:
-                value = value[:400] + "..."
-            telegram_message += f"• {key}: {value}\n"
-    
-    # Ограничиваем длину сообщения (Telegram лимит 4096 символов)
-    if len(telegram_message) > 4000:
-        telegram_message = telegram_message[:4000] + "\n\n[Сообщение обрезано]"
-    
-    try:
-        telegram_api_url = f"https://api.telegram.org/bot{bot_token}/sendMessage"
-        
-        payload = {
-            "chat_id": chat_id,
-            "text": telegram_message,
-            "parse_mode": "HTML"
-        }
-        
-        async with httpx.AsyncClient() as client:
-            response = await client.post(telegram_api_url, json=payload, timeout=10)
-            
-            if response.status_code == 200:
-                logger.info("✅ Telegram notification sent successfully")
-                return True
-            else:
-                logger.error(f"❌ Failed to send Telegram notification: {response.status_code} - {response.text}")
-                return False
-                
-    except Exception as e:
-        logger.error(f"❌ Error sending Telegram notification: {e}")
-        return False
-
-
 @router.post("/webhook/test")
 async def test_webhook_endpoint(request: Request):
     """
@@ -1679,12 +1479,12 @@ async def test_webhook_endpoint(request: Request):
                 import json
                 parsed_json = json.loads(body_text)
                 logger.info(f"✅ JSON parsed successfully:")
-                logger.info(f"📋 JSON content: {json.dumps(parsed_json, ensure_ascii=False, indent=2)}")
+                log_payload(logger, "📋 JSON content", parsed_json)
         except json.JSONDecodeError:
             logger.info("⚠️ Body is not valid JSON")
         
         # Отправляем уведомление в Telegram
-        await send_telegram_notification(
+        telegram_notifier.notify(
             "🧪 Тестовый webhook получен",
             {
                 "URL": str(request.url),
@@ -1717,28 +1517,36 @@ async def test_webhook_endpoint(request: Request):
 
 
 @router.post("/webhook/refresh-api-key")
-async def manual_refresh_api_key(db: AsyncSession = Depends(get_db_session)):
+async def manual_refresh_api_key(company_id: Optional[int] = None):
     """
     Ручное обновление API ключа Webkassa через эндпоинт
+    
+    Параметры:
+    - company_id: компания Altegio, чей токен нужно обновить (по умолчанию - основная учетная запись)
     """
     try:
-        logger.info("🔄 Manual API key refresh requested")
+        logger.info(f"🔄 Manual API key refresh requested (company_id={company_id})")
+        
+        tenant = default_tenant()
+        if company_id:
+            async with AsyncSessionLocal() as db:
+                tenant = await tenant_registry.get(db, company_id)
         
-        # Проверяем текущий ключ
-        current_key = await get_webkassa_api_key(db)
+        # Проверяем текущий ключ (короткая сессия: скрипт обновления может идти до 60 секунд)
+        current_key = await get_webkassa_api_key(use_cache=False, service_name=tenant.service_name)
         if current_key:
             logger.info(f"📋 Current key found: ID {current_key.id}, updated {current_key.updated_at}")
         else:
             logger.info("📋 No current key found in database")
         
         # Обновляем ключ
-        refreshed_key = await refresh_webkassa_api_key(db)
+        refreshed_key = await refresh_webkassa_api_key(stale_token=current_key.api_key if current_key else None, tenant=tenant)
         
         if refreshed_key:
             logger.info("✅ Manual API key refresh successful")
             
             # Отправляем уведомление об успехе
-            await send_telegram_notification(
+            telegram_notifier.notify(
                 "✅ Ручное обновление API ключа Webkassa выполнено успешно",
                 {
                     "Результат": "Успех",
@@ -1764,7 +1572,7 @@ async def manual_refresh_api_key(db: AsyncSession = Depends(get_db_session)):
             logger.error("❌ Manual API key refresh failed")
             
             # Отправляем уведомление о неудаче
-            await send_telegram_notification(
+            telegram_notifier.notify(
                 "❌ Ручное обновление API ключа Webkassa не удалось",
                 {
 
@@ -1782,7 +1590,7 @@ async def manual_refresh_api_key(db: AsyncSession = Depends(get_db_session)):
     except Exception as e:
         logger.error(f"❌ Error in manual API key refresh: {e}", exc_info=True)
         
-        await send_telegram_notification(
+        telegram_notifier.notify(
             "🚨 Ошибка при ручном обновлении API ключа Webкassa",
             {
                 "Ошибка": str(e),
@@ -1798,6 +1606,47 @@ async def manual_refresh_api_key(db: AsyncSession = Depends(get_db_session)):
         }
 
 
+@router.get("/webhook/record/{record_id}/payload")
+async def get_webhook_payload(
+    record_id: int,
+    db: AsyncSession = Depends(get_db_session)
+):
+    """
+    Возвращает холодные данные webhook записи: полный payload, услуги и ответ Webkassa
+    """
+    try:
+        # По created_at записи Postgres читает одну секцию webhook_payloads, а не все
+        created_at = await db.scalar(select(WebhookRecord.created_at).filter(WebhookRecord.id == record_id))
+        webhook_payload = None
+        if created_at is not None:
+            result = await db.execute(
+                select(WebhookPayload).filter(
+                    WebhookPayload.record_id == record_id,
+                    WebhookPayload.created_at == created_at,
+                )
+            )
+            webhook_payload = result.scalars().first()
+        if not webhook_payload:
+            raise HTTPException(status_code=404, detail="Webhook payload not found")
+
+        return {
+            "success": True,
+            "record_id": record_id,
+            "services": webhook_payload.services_list,
+            "total_amount": webhook_payload.total_amount,
+            "raw_data": webhook_payload.raw_data,
+            "services_data": webhook_payload.services_data,
+            "webkassa_response": webhook_payload.webkassa_response,
+            "updated_at": webhook_payload.updated_at.isoformat() if webhook_payload.updated_at else None
+        }
+
+    except HTTPException as e:
+        raise e
+    except Exception as e:
+        logger.error(f"Error loading webhook payload {record_id}: {str(e)}")
+        raise HTTPException(status_code=500, detail="Internal server error")
+
+
 @router.delete("/webhook/record/{record_id}")
 async def delete_webhook_record(
     record_id: int,
@@ -1845,45 +1694,116 @@ async def delete_webhook_record(
         raise HTTPException(status_code=500, detail="Internal server error")
 
 
+# Размер порции удаления: каждая порция - отдельная короткая транзакция
+DELETE_CHUNK_SIZE = int(os.getenv("WEBHOOK_DELETE_CHUNK_SIZE", "1000"))
+
+# Колонки удаленных записей в ответе (RETURNING)
+DELETED_RECORD_COLUMNS = (
+    WebhookRecord.id,
+    WebhookRecord.resource_id,
+    WebhookRecord.company_id,
+    WebhookRecord.processed,
+    WebhookRecord.webkassa_status,
+    WebhookRecord.processing_error,
+)
+
+
+async def count_webhook_records(filters: list) -> int:
+    """Число записей под фильтром (для dry_run)"""
+    async with AsyncSessionLocal() as db:
+        return await db.scalar(select(func.count()).select_from(WebhookRecord).where(*filters))
+
+
+async def iter_deleted_records(filters: list, chunk_size: int = None):
+    """
+    Удаляет записи под фильтром порциями DELETE ... RETURNING и отдает удаленные строки.
+    Payload и ключ уникальности удаляются каскадом.
+    """
+    chunk_size = chunk_size or DELETE_CHUNK_SIZE
+    while True:
+        chunk = (
+            select(WebhookRecord.id, WebhookRecord.created_at)
+            .where(*filters)
+            .order_by(WebhookRecord.created_at, WebhookRecord.id)
+            .limit(chunk_size)
+        )
+        statement = (
+            delete(WebhookRecord)
+            .where(tuple_(WebhookRecord.id, WebhookRecord.created_at).in_(chunk))
+            .returning(*DELETED_RECORD_COLUMNS)
+        )
+        async with AsyncSessionLocal() as db:
+            rows = (await db.execute(statement)).mappings().all()
+            await db.commit()
+        if rows:
+            logger.info(f"🗑️ Deleted chunk of {len(rows)} webhook record(s)")
+        for row in rows:
+            yield dict(row)
+        if len(rows) < chunk_size:
+            break
+
+
+def stream_deleted_records(filters: list, summary: Dict[str, Any]) -> StreamingResponse:
+    """NDJSON-ответ: строка на удаленную запись и итоговая строка с deleted_count"""
+    async def lines():
+        deleted_count = 0
+        async for record in iter_deleted_records(filters):
+            deleted_count += 1
+            yield json.dumps(record, ensure_ascii=False) + "\n"
+        logger.info(f"🗑️ Deleted {deleted_count} webhook records ({summary.get('message', '')})")
+        yield json.dumps({**summary, "success": True, "deleted_count": deleted_count}, ensure_ascii=False) + "\n"
+
+    return StreamingResponse(lines(), media_type="application/x-ndjson")
+
+
 @router.delete("/webhook/resource/{resource_id}")
 async def delete_webhook_by_resource_id(
     resource_id: int,
     company_id: Optional[int] = None,
-    db: AsyncSession = Depends(get_db_session)
+    dry_run: bool = False,
+    stream: bool = False
 ):
     """
     Удаляет все webhook записи для конкретного resource_id
     Опционально можно указать company_id для более точного поиска
+    
+    Параметры:
+    - dry_run: только посчитать записи, которые будут удалены
+    - stream: вернуть удаленные записи потоком NDJSON
     """
     try:
-        # Строим запрос
-        query = select(WebhookRecord).filter(WebhookRecord.resource_id == resource_id)
+        filters = [WebhookRecord.resource_id == resource_id]
         if company_id:
-            query = query.filter(WebhookRecord.company_id == company_id)
+            filters.append(WebhookRecord.company_id == company_id)
+        
+        if dry_run:
+            return {
+                "success": True,
+                "dry_run": True,
+                "matched_count": await count_webhook_records(filters)
+            }
         
-        # Получаем все записи для удаления
-        result = await db.execute(query)
-        records_to_delete = result.scalars().all()
+        if stream:
+            return stream_deleted_records(filters, {"message": f"resource_id {resource_id}"})
         
-        if not records_to_delete:
+        # После уникального ключа (company_id, resource_id) записей немного - список отдаем целиком
+        deleted_info = [
+            {
+                "id": record["id"],
+                "resource_id": record["resource_id"],
+                "company_id": record["company_id"],
+                "was_processed": record["processed"],
+                "webkassa_status": record["webkassa_status"]
+            }
+            async for record in iter_deleted_records(filters)
+        ]
+        
+        if not deleted_info:
             message = f"No webhook records found for resource_id {resource_id}"
             if company_id:
                 message += f" and company_id {company_id}"
             raise HTTPException(status_code=404, detail=message)
         
-        deleted_info = []
-        for record in records_to_delete:
-            deleted_info.append({
-                "id": record.id,
-                "resource_id": record.resource_id,
-                "company_id": record.company_id,
-                "was_processed": record.processed,
-                "webkassa_status": record.webkassa_status
-            })
-            await db.delete(record)
-        
-        await db.commit()
-        
         logger.info(f"🗑️ Deleted {len(deleted_info)} webhook records for resource_id {resource_id}")
         for info in deleted_info:
             logger.info(f"   - ID: {info['id']}, processed: {info['was_processed']}, status: {info['webkassa_status']}")
@@ -1905,58 +1825,64 @@ async def delete_webhook_by_resource_id(
 @router.delete("/webhook/failed")
 async def delete_failed_webhook_records(
     confirm: bool = False,
-    db: AsyncSession = Depends(get_db_session)
+    dry_run: bool = False,
+    stream: bool = False
 ):
     """
     Удаляет все неуспешно обработанные webhook записи (processed=False)
     
     Параметры:
     - confirm: Обязательный параметр для подтверждения операции (должен быть True)
+    - dry_run: только посчитать записи, которые будут удалены (confirm не нужен)
+    - stream: вернуть удаленные записи потоком NDJSON; без него возвращается только количество
     """
+    filters = [WebhookRecord.processed == false()]
+    
+    try:
+        if dry_run:
+            return {
+                "success": True,
+                "dry_run": True,
+                "matched_count": await count_webhook_records(filters)
+            }
+    except Exception as e:
+        logger.error(f"Error counting failed webhook records: {str(e)}")
+        raise HTTPException(status_code=500, detail="Internal server error")
+    
     if not confirm:
         raise HTTPException(
             status_code=400, 
             detail="This operation requires confirmation. Add ?confirm=true to the request"
         )
     
+    if stream:
+        return stream_deleted_records(filters, {"message": "failed webhook records"})
+    
     try:
-        # Получаем все неуспешные записи
-        result = await db.execute(
-            select(WebhookRecord).filter(WebhookRecord.processed == False)
-        )
-        failed_records = result.scalars().all()
-        
-        if not failed_records:
+        deleted_count = 0
+        examples = []
+        async for record in iter_deleted_records(filters):
+            deleted_count += 1
+            if len(examples) < 5:  # Показываем только первые 5 для логов
+                examples.append(record)
+        
+        if not deleted_count:
             return {
                 "success": True,
                 "message": "No failed webhook records found to delete",
                 "deleted_count": 0
             }
         
-        deleted_info = []
-        for record in failed_records:
-            deleted_info.append({
-                "id": record.id,
-                "resource_id": record.resource_id,
-                "company_id": record.company_id,
-                "webkassa_status": record.webkassa_status,
-                "processing_error": record.processing_error
-            })
-            await db.delete(record)
-        
-        await db.commit()
-        
-        logger.info(f"🗑️ Deleted {len(deleted_info)} failed webhook records")
-        for info in deleted_info[:5]:  # Показываем только первые 5 для логов
+        logger.info(f"🗑️ Deleted {deleted_count} failed webhook records")
+        for info in examples:
             logger.info(f"   - ID: {info['id']}, resource_id: {info['resource_id']}, error: {info['processing_error'][:100] if info['processing_error'] else 'None'}")
-        if len(deleted_info) > 5:
-            logger.info(f"   ... и еще {len(deleted_info) - 5} записей")
+        if deleted_count > len(examples):
+            logger.info(f"   ... и еще {deleted_count - len(examples)} записей")
         
         return {
             "success": True,
-            "message": f"Deleted {len(deleted_info)} failed webhook records",
-            "deleted_count": len(deleted_info),
-            "deleted_records": deleted_info
+            "message": f"Deleted {deleted_count} failed webhook records",
+            "deleted_count": deleted_count
         }
         
     except Exception as e:
@@ -1964,83 +1890,133 @@ async def delete_failed_webhook_records(
         raise HTTPException(status_code=500, detail="Internal server error")
 
 
+# Колонки списка записей: выбираем только их, без загрузки ORM-объектов
+RECORD_LIST_COLUMNS = (
+    WebhookRecord.id,
+    WebhookRecord.resource_id,
+    WebhookRecord.company_id,
+    WebhookRecord.resource,
+    WebhookRecord.status,
+    WebhookRecord.client_phone,
+    WebhookRecord.client_name,
+    WebhookRecord.processed,
+    WebhookRecord.webkassa_status,
+    WebhookRecord.processing_error,
+    WebhookRecord.created_at,
+    WebhookRecord.processed_at,
+    WebhookRecord.comment,
+)
+MAX_RECORDS_PAGE = 500
+
+
+def encode_records_cursor(created_at: datetime, record_id: int) -> str:
+    """Непрозрачный курсор страницы: позиция последней выданной записи"""
+    raw = json.dumps([created_at.isoformat(), record_id]).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_records_cursor(cursor: str) -> Tuple[datetime, int]:
+    """Разбирает курсор; ValueError, если он поврежден"""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        created_at, record_id = json.loads(raw)
+        return datetime.fromisoformat(created_at), int(record_id)
+    except Exception as e:
+        raise ValueError(f"Invalid cursor: {cursor}") from e
+
+
+async def estimate_row_count(db: AsyncSession, query) -> int:
+    """Оценка числа строк запроса по плану Postgres (без обхода таблицы)"""
+    sql = query.compile(dialect=db.bind.dialect, compile_kwargs={"literal_binds": True})
+    plan = (await db.execute(text(f"EXPLAIN (FORMAT JSON) {sql}"))).scalar()
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return int(plan[0]["Plan"]["Plan Rows"])
+
+
 @router.get("/webhook/records")
 async def list_webhook_records(
     limit: int = 50,
     offset: int = 0,
+    cursor: Optional[str] = None,
+    count: str = "none",
     processed: Optional[bool] = None,
     webkassa_status: Optional[str] = None,
     resource_id: Optional[int] = None,
     db: AsyncSession = Depends(get_db_session)
 ):
     """
-    Получает список webhook записей с фильтрацией
+    Получает список webhook записей с фильтрацией (новые сначала)
     
     Параметры:
-    - limit: максимальное количество записей (по умолчанию 50)
-    - offset: смещение для пагинации (по умолчанию 0)
+    - limit: максимальное количество записей (по умолчанию 50, не больше 500)
+    - cursor: next_cursor из предыдущего ответа - следующая страница по (created_at, id)
+    - offset: смещение для пагинации (устаревшее, используется только без cursor)
+    - count: подсчет total_count - none (по умолчанию, total_count = null), estimate (по плану запроса)
+      или exact (count(*) по всем секциям - дорого, запрашивайте только когда нужно точное число)
     - processed: фильтр по статусу обработки (True/False)
     - webkassa_status: фильтр по статусу Webkassa (success/failed)
     - resource_id: фильтр по конкретному resource_id
     """
     try:
-        # Строим запрос с фильтрами
-        query = select(WebhookRecord)
-        
-        if processed is not None:
-            query = query.filter(WebhookRecord.processed == processed)
-        
-        if webkassa_status:
-            query = query.filter(WebhookRecord.webkassa_status == webkassa_status)
-            
-        if resource_id:
-            query = query.filter(WebhookRecord.resource_id == resource_id)
-        
-        # Добавляем сортировку и пагинацию
-        query = query.order_by(WebhookRecord.created_at.desc()).offset(offset).limit(limit)
-        
-        # Выполняем запрос
-        result = await db.execute(query)
-        records = result.scalars().all()
-        
-        # Получаем общее количество записей для статистики
-        count_query = select(WebhookRecord)
+        if count not in ("exact", "estimate", "none"):
+            raise HTTPException(status_code=400, detail="count must be one of: exact, estimate, none")
+        limit = max(1, min(limit, MAX_RECORDS_PAGE))
+
+        filters = []
         if processed is not None:
-            count_query = count_query.filter(WebhookRecord.processed == processed)
+            # Литерал, а не параметр: так планировщик выбирает частичный индекс
+            filters.append(WebhookRecord.processed == (true() if processed else false()))
         if webkassa_status:
-            count_query = count_query.filter(WebhookRecord.webkassa_status == webkassa_status)
+            filters.append(WebhookRecord.webkassa_status == webkassa_status)
         if resource_id:
-            count_query = count_query.filter(WebhookRecord.resource_id == resource_id)
-            
-        count_result = await db.execute(count_query)
-        total_count = len(count_result.scalars().all())
+            filters.append(WebhookRecord.resource_id == resource_id)
+
+        query = select(*RECORD_LIST_COLUMNS).where(*filters)
+        if cursor:
+            try:
+                cursor_created_at, cursor_id = decode_records_cursor(cursor)
+            except ValueError:
+                raise HTTPException(status_code=400, detail="Invalid cursor")
+            query = query.where(
+                tuple_(WebhookRecord.created_at, WebhookRecord.id) < tuple_(cursor_created_at, cursor_id)
+            )
+        elif offset:
+            query = query.offset(offset)
+
+        # Берем на одну запись больше, чтобы узнать, есть ли следующая страница
+        query = query.order_by(WebhookRecord.created_at.desc(), WebhookRecord.id.desc()).limit(limit + 1)
+        rows = (await db.execute(query)).mappings().all()
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+
+        total_count = None
+        if count == "exact":
+            total_count = await db.scalar(select(func.count()).select_from(WebhookRecord).where(*filters))
+        elif count == "estimate":
+            total_count = await estimate_row_count(db, select(WebhookRecord.id).where(*filters))
         
         # Формируем ответ
         records_data = []
-        for record in records:
-            records_data.append({
-                "id": record.id,
-                "resource_id": record.resource_id,
-                "company_id": record.company_id,
-                "resource": record.resource,
-                "status": record.status,
-                "client_phone": record.client_phone,
-                "client_name": record.client_name,
-                "processed": record.processed,
-                "webkassa_status": record.webkassa_status,
-                "processing_error": record.processing_error,
-                "created_at": record.created_at.isoformat() if record.created_at else None,
-                "processed_at": record.processed_at.isoformat() if record.processed_at else None,
-                "comment": record.comment
-            })
+        for row in rows:
+            record_data = dict(row)
+            record_data["created_at"] = row["created_at"].isoformat() if row["created_at"] else None
+            record_data["processed_at"] = row["processed_at"].isoformat() if row["processed_at"] else None
+            records_data.append(record_data)
+        
+        next_cursor = encode_records_cursor(rows[-1]["created_at"], rows[-1]["id"]) if has_more else None
         
         return {
             "success": True,
             "records": records_data,
             "pagination": {
                 "limit": limit,
-                "offset": offset,
+                "offset": None if cursor else offset,
+                "cursor": cursor,
+                "next_cursor": next_cursor,
+                "has_more": has_more,
                 "total_count": total_count,
+                "total_count_mode": count,
                 "returned_count": len(records_data)
             },
             "filters": {
@@ -2050,50 +2026,95 @@ async def list_webhook_records(
             }
         }
         
+    except HTTPException as e:
+        raise e
     except Exception as e:
         logger.error(f"Error listing webhook records: {str(e)}")
         raise HTTPException(status_code=500, detail="Internal server error")
 
 
+# Разрезы статистики: имя параметра group_by -> выражение группировки
+STATS_GROUP_COLUMNS = {
+    "company": WebhookRecord.company_id.label("company_id"),
+    "resource": WebhookRecord.resource.label("resource"),
+    "day": cast(WebhookRecord.created_at, Date).label("day"),
+}
+
+# Счетчики статистики одним проходом: count(*) FILTER (WHERE ...)
+STATS_COUNTERS = (
+    func.count().label("total_records"),
+    func.count().filter(WebhookRecord.processed == true()).label("processed_records"),
+    func.count().filter(WebhookRecord.processed == false()).label("unprocessed_records"),
+    func.count().filter(WebhookRecord.webkassa_status == "success").label("webkassa_success"),
+    func.count().filter(WebhookRecord.webkassa_status == "failed").label("webkassa_failed"),
+)
+
+
+def build_stats(counts: Dict[str, int]) -> Dict[str, Any]:
+    """Добавляет к счетчикам доли обработанных и успешных записей"""
+    total_count = counts["total_records"]
+    return {
+        **counts,
+        "processing_rate": round((counts["processed_records"] / total_count * 100), 2) if total_count > 0 else 0,
+        "success_rate": round((counts["webkassa_success"] / total_count * 100), 2) if total_count > 0 else 0
+    }
+
+
 @router.get("/webhook/stats")
-async def get_webhook_stats(db: AsyncSession = Depends(get_db_session)):
+async def get_webhook_stats(
+    group_by: Optional[str] = None,
+    date_from: Optional[datetime] = None,
+    date_to: Optional[datetime] = None,
+    db: AsyncSession = Depends(get_db_session)
+):
     """
-    Получает статистику по webhook записям
+    Получает статистику по webhook записям одним агрегатным запросом
+    
+    Параметры:
+    - group_by: разрезы через запятую - company, resource, day (например company,day)
+    - date_from / date_to: период по created_at (ограничивает и число просматриваемых секций)
     """
     try:
-        # Общее количество записей
-        total_result = await db.execute(select(WebhookRecord))
-        total_count = len(total_result.scalars().all())
-        
-        # Количество обработанных
-        processed_result = await db.execute(select(WebhookRecord).filter(WebhookRecord.processed == True))
-        processed_count = len(processed_result.scalars().all())
+        group_names = [name.strip() for name in group_by.split(",") if name.strip()] if group_by else []
+        unknown = [name for name in group_names if name not in STATS_GROUP_COLUMNS]
+        if unknown:
+            raise HTTPException(
+                status_code=400,
+                detail=f"Unknown group_by: {', '.join(unknown)}. Allowed: {', '.join(STATS_GROUP_COLUMNS)}"
+            )
+        group_columns = [STATS_GROUP_COLUMNS[name] for name in dict.fromkeys(group_names)]
         
-        # Количество неоработанных
-        unprocessed_result = await db.execute(select(WebhookRecord).filter(WebhookRecord.processed == False))
-        unprocessed_count = len(unprocessed_result.scalars().all())
+        query = select(*group_columns, *STATS_COUNTERS)
+        if date_from:
+            query = query.where(WebhookRecord.created_at >= date_from)
+        if date_to:
+            query = query.where(WebhookRecord.created_at < date_to)
+        if group_columns:
+            query = query.group_by(*group_columns).order_by(*group_columns)
         
-        # Количество успешных в Webkassa
-        success_result = await db.execute(select(WebhookRecord).filter(WebhookRecord.webkassa_status == "success"))
-        success_count = len(success_result.scalars().all())
+        rows = (await db.execute(query)).mappings().all()
+        counter_names = [counter.name for counter in STATS_COUNTERS]
         
-        # Количество неуспешных в Webkassa
-        failed_result = await db.execute(select(WebhookRecord).filter(WebhookRecord.webkassa_status == "failed"))
-        failed_count = len(failed_result.scalars().all())
+        # Счетчики аддитивны: итог по разрезам - их сумма, второй запрос не нужен
+        totals = {name: sum(row[name] for row in rows) for name in counter_names}
         
-        return {
+        response = {
             "success": True,
-            "stats": {
-                "total_records": total_count,
-                "processed_records": processed_count,
-                "unprocessed_records": unprocessed_count,
-                "webkassa_success": success_count,
-                "webkassa_failed": failed_count,
-                "processing_rate": round((processed_count / total_count * 100), 2) if total_count > 0 else 0,
-                "success_rate": round((success_count / total_count * 100), 2) if total_count > 0 else 0
-            }
+            "stats": build_stats(totals)
         }
+        if group_columns:
+            breakdown = []
+            for row in rows:
+                group = {column.name: row[column.name] for column in group_columns}
+                if group.get("day") is not None:
+                    group["day"] = group["day"].isoformat()
+                breakdown.append({**group, **build_stats({name: row[name] for name in counter_names})})
+            response["group_by"] = [column.name for column in group_columns]
+            response["breakdown"] = breakdown
+        return response
         
+    except HTTPException as e:
+        raise e
     except Exception as e:
         logger.error(f"Error getting webhook stats: {str(e)}")
         raise HTTPException(status_code=500, detail="Internal server error")
@@ -2114,7 +2135,7 @@ async def webhook_queue_worker():
             try:
                 # Обрабатываем webhook с семафором для гарантии последовательности
                 async with webhook_processing_semaphore:
-                    result = await process_webhook_internal(task.payload, task.request, task.db_session)
+                    result = await process_webhook_internal(task.payload, task.request)
                     task.result_future.set_result(result)
                     logger.info(f"✅ Completed webhook task: {task.task_id}")
             except Exception as e:
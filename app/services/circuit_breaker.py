@@ -0,0 +1,96 @@
+"""
+Автоматические выключатели (circuit breaker) для внешних API - Altegio и Webkassa.
+
+После CIRCUIT_FAILURE_THRESHOLD подряд сетевых ошибок или ответов 5xx выключатель
+размыкается: запросы к API не отправляются CIRCUIT_RESET_TIMEOUT секунд и сразу
+завершаются ошибкой, вместо того чтобы каждый webhook ждал таймаута 30 секунд.
+Затем пропускается один пробный запрос: успех замыкает выключатель, ошибка снова
+размыкает. Ответы API с ошибками бизнес-логики (Errors в теле, 4xx) считаются
+успехом - сервис доступен.
+"""
+import logging
+import os
+import time
+from typing import Any, Dict, Optional
+
+from app.services.metrics import Counter, registry
+
+logger = logging.getLogger(__name__)
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+circuit_transitions = registry.register(Counter(
+    "circuit_breaker_transitions_total", "Circuit breaker state changes by upstream and new state",
+    ("upstream", "state"),
+))
+
+
+class CircuitBreaker:
+    """Счетчик подряд идущих ошибок внешнего API с состояниями closed/open/half_open"""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.failure_threshold = int(os.getenv("CIRCUIT_FAILURE_THRESHOLD", "5"))
+        self.reset_timeout = float(os.getenv("CIRCUIT_RESET_TIMEOUT", "30"))
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self.last_failure: Optional[str] = None
+        self._trial_started: Optional[float] = None
+
+    def allow(self) -> bool:
+        """Можно ли отправить запрос сейчас"""
+        if self.state == CLOSED:
+            return True
+        now = time.monotonic()
+        if self.state == OPEN:
+            if now - self.opened_at < self.reset_timeout:
+                return False
+            self._set_state(HALF_OPEN)
+        # В полуоткрытом состоянии - один пробный запрос (или новый, если прежний так и не завершился)
+        if self._trial_started is None or now - self._trial_started >= self.reset_timeout:
+            self._trial_started = now
+            return True
+        return False
+
+    def record_success(self):
+        self.failures = 0
+        self._trial_started = None
+        if self.state != CLOSED:
+            self._set_state(CLOSED)
+            logger.info(f"🟢 {self.name} circuit breaker closed: API is responding again")
+
+    def record_failure(self, reason: str):
+        self.failures += 1
+        self.last_failure = reason
+        self._trial_started = None
+        if self.state == HALF_OPEN or (self.state == CLOSED and self.failures >= self.failure_threshold):
+            self.opened_at = time.monotonic()
+            self._set_state(OPEN)
+            logger.error(
+                f"🔴 {self.name} circuit breaker opened after {self.failures} consecutive failures "
+                f"(last: {reason}); requests fail fast for {self.reset_timeout:.0f}s"
+            )
+
+    def retry_in(self) -> float:
+        if self.state != OPEN:
+            return 0.0
+        return max(self.reset_timeout - (time.monotonic() - self.opened_at), 0.0)
+
+    def _set_state(self, state: str):
+        self.state = state
+        circuit_transitions.inc(upstream=self.name, state=state)
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "state": self.state,
+            "consecutive_failures": self.failures,
+            "retry_in_seconds": round(self.retry_in(), 1),
+            "last_failure": self.last_failure,
+        }
+
+
+altegio_breaker = CircuitBreaker("altegio")
+webkassa_breaker = CircuitBreaker("webkassa")
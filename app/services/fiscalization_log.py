@@ -0,0 +1,149 @@
+"""
+Буферизованная запись попыток фискализации в fiscalization_logs.
+
+Каждая попытка отправки чека в Webkassa ставится в очередь в памяти без обращения
+к базе; фоновая задача сбрасывает очередь многострочным INSERT, когда набирается
+FISCAL_LOG_BATCH_SIZE записей или проходит FISCAL_LOG_FLUSH_INTERVAL секунд.
+Путь фискализации не ждет записи лога, а при переполнении очереди запись
+отбрасывается с предупреждением.
+"""
+import asyncio
+import logging
+import os
+from datetime import datetime
+from typing import Any, Dict, List, Optional
+
+from sqlalchemy import insert
+
+from app.db import AsyncSessionLocal
+from app.models import FiscalizationLog
+
+logger = logging.getLogger(__name__)
+
+
+class FiscalizationLogWriter:
+    """Фоновый писатель fiscalization_logs пачками"""
+
+    def __init__(self):
+        self.enabled = os.getenv("FISCAL_LOG_ENABLED", "True").lower() == "true"
+        self.batch_size = int(os.getenv("FISCAL_LOG_BATCH_SIZE", "100"))
+        self.flush_interval = float(os.getenv("FISCAL_LOG_FLUSH_INTERVAL", "2"))
+        self._queue: asyncio.Queue = asyncio.Queue(maxsize=int(os.getenv("FISCAL_LOG_QUEUE_SIZE", "10000")))
+        self._task: Optional[asyncio.Task] = None
+        self.dropped = 0
+
+    async def start(self):
+        if not self.enabled:
+            logger.info("⏸️ Fiscalization log writer disabled (FISCAL_LOG_ENABLED=False)")
+            return
+        self._task = asyncio.create_task(self._run())
+        logger.info(f"🧾 Fiscalization log writer started (batch {self.batch_size}, every {self.flush_interval}s)")
+
+    async def stop(self):
+        """Останавливает фоновую задачу и записывает то, что осталось в очереди"""
+        if self._task:
+            self._task.cancel()
+            # Задача сама дописывает взятые из очереди строки - ждем ее до сброса остатка
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+
+    @property
+    def queue_depth(self) -> int:
+        return self._queue.qsize()
+
+    @property
+    def queue_capacity(self) -> int:
+        return self._queue.maxsize
+
+    def record(
+        self,
+        webhook_record_id: Optional[int],
+        request: Dict[str, Any],
+        response: Optional[Dict[str, Any]],
+        status: str,
+        error_message: Optional[str] = None,
+        retry_count: int = 0,
+        created_at: Optional[datetime] = None,
+        completed_at: Optional[datetime] = None,
+        duration_ms: Optional[int] = None,
+        correlation_id: Optional[str] = None,
+    ):
+        """Ставит попытку в очередь; никогда не ждет и не обращается к базе"""
+        if not self.enabled:
+            return
+        row = {
+            "webhook_record_id": webhook_record_id,
+            "webkassa_request": request,
+            "webkassa_response": response,
+            "status": status,
+            "error_message": error_message,
+            "retry_count": retry_count,
+            "created_at": created_at or datetime.utcnow(),
+            "completed_at": completed_at,
+            "duration_ms": duration_ms,
+            "correlation_id": correlation_id,
+        }
+        try:
+            self._queue.put_nowait(row)
+        except asyncio.QueueFull:
+            self.dropped += 1
+            logger.warning(f"⚠️ Fiscalization log queue is full, attempt dropped (total dropped: {self.dropped})")
+
+    def _drain(self, rows: List[Dict[str, Any]]):
+        while len(rows) < self.batch_size:
+            try:
+                rows.append(self._queue.get_nowait())
+            except asyncio.QueueEmpty:
+                break
+
+    async def flush(self):
+        """Записывает все накопленные попытки"""
+        while not self._queue.empty():
+            rows: List[Dict[str, Any]] = []
+            self._drain(rows)
+            await self._write(rows)
+
+    async def _write(self, rows: List[Dict[str, Any]]):
+        if not rows:
+            return
+        try:
+            async with AsyncSessionLocal() as db:
+                # Один многострочный INSERT ... VALUES (...), (...), ...
+                await db.execute(insert(FiscalizationLog).values(rows))
+                await db.commit()
+        except Exception as e:
+            logger.error(f"❌ Failed to write {len(rows)} fiscalization log row(s): {e}")
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            rows: List[Dict[str, Any]] = []
+            try:
+                rows.append(await self._queue.get())
+                deadline = loop.time() + self.flush_interval
+                while len(rows) < self.batch_size:
+                    self._drain(rows)
+                    timeout = deadline - loop.time()
+                    if len(rows) >= self.batch_size or timeout <= 0:
+                        break
+                    try:
+                        rows.append(await asyncio.wait_for(self._queue.get(), timeout))
+                    except asyncio.TimeoutError:
+                        break
+                await self._write(rows)
+                rows = []
+            except asyncio.CancelledError:
+                # Взятые из очереди, но еще не записанные строки дописываем при остановке
+                if rows:
+                    await self._write(rows)
+                raise
+            except Exception as e:
+                logger.error(f"❌ Error in fiscalization log writer: {e}", exc_info=True)
+
+
+# Единственный экземпляр на процесс
+fiscalization_log_writer = FiscalizationLogWriter()
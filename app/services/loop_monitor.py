@@ -0,0 +1,111 @@
+"""
+Сторож event loop: задержка цикла и блокирующий код.
+
+Задача в цикле раз в LOOP_MONITOR_INTERVAL секунд отмечает пульс и измеряет, насколько
+позже запланированного она проснулась (лаг цикла, гистограмма event_loop_lag_seconds).
+Отдельный поток следит за пульсом: если цикл не отвечает дольше LOOP_BLOCK_THRESHOLD,
+он снимает стек потока цикла (тот код, который держит цикл) и пишет его в лог
+app.loop_monitor, а в метриках увеличивает event_loop_stalls_total.
+
+Накладные расходы - одно пробуждение задачи и потока за интервал, стек снимается
+только во время зависания, поэтому сторож можно держать включенным в проде.
+"""
+import asyncio
+import logging
+import os
+import sys
+import threading
+import time
+import traceback
+from typing import Optional
+
+from app.services.metrics import Counter, Histogram, registry
+
+logger = logging.getLogger("app.loop_monitor")
+
+loop_lag_seconds = registry.register(Histogram(
+    "event_loop_lag_seconds", "Event loop scheduling lag",
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0),
+))
+loop_stalls = registry.register(Counter(
+    "event_loop_stalls_total", "Times the event loop was blocked longer than the threshold"
+))
+loop_stall_seconds = registry.register(Counter(
+    "event_loop_stall_seconds_total", "Total duration of event loop stalls longer than the threshold"
+))
+# Серии создаются заранее: поток-сторож только увеличивает уже существующие значения
+loop_stalls.inc(0)
+loop_stall_seconds.inc(0)
+
+
+class LoopMonitor:
+    """Измерение лага event loop и снимки стека при его блокировке"""
+
+    def __init__(self):
+        self.enabled = os.getenv("LOOP_MONITOR_ENABLED", "True").lower() == "true"
+        self.interval = float(os.getenv("LOOP_MONITOR_INTERVAL", "0.5"))
+        self.threshold = float(os.getenv("LOOP_BLOCK_THRESHOLD", "0.5"))
+        self.stack_limit = int(os.getenv("LOOP_BLOCK_STACK_DEPTH", "25"))
+        self._task: Optional[asyncio.Task] = None
+        self._thread: Optional[threading.Thread] = None
+        self._stopped = threading.Event()
+        self._loop_thread_id: Optional[int] = None
+        self._heartbeat = time.monotonic()
+        # Последний измеренный лаг цикла, секунды (для /ready)
+        self.last_lag = 0.0
+        # Начало текущего зависания, о котором уже сообщили (None - цикл отвечает)
+        self._stall_started: Optional[float] = None
+
+    async def start(self):
+        if not self.enabled:
+            logger.info("⏸️ Event loop monitor disabled (LOOP_MONITOR_ENABLED=False)")
+            return
+        self._loop_thread_id = threading.get_ident()
+        self._heartbeat = time.monotonic()
+        self._stopped.clear()
+        self._task = asyncio.create_task(self._run())
+        self._thread = threading.Thread(target=self._watch, name="loop-monitor", daemon=True)
+        self._thread.start()
+        logger.info(f"🩺 Event loop monitor started (interval {self.interval}s, block threshold {self.threshold}s)")
+
+    async def stop(self):
+        self._stopped.set()
+        if self._task:
+            self._task.cancel()
+            self._task = None
+        if self._thread:
+            await asyncio.to_thread(self._thread.join, 2)
+            self._thread = None
+
+    async def _run(self):
+        while True:
+            expected = time.monotonic() + self.interval
+            await asyncio.sleep(self.interval)
+            now = time.monotonic()
+            lag = max(now - expected, 0.0)
+            self._heartbeat = now
+            self.last_lag = lag
+            loop_lag_seconds.observe(lag)
+
+            if self._stall_started is not None:
+                self._stall_started = None
+                loop_stall_seconds.inc(lag)
+                logger.warning(f"🐢 Event loop was blocked for {lag:.3f}s (resumed)")
+
+    def _watch(self):
+        """Поток-сторож: снимает стек цикла, если тот не отметил пульс вовремя"""
+        while not self._stopped.wait(self.threshold / 2):
+            blocked_for = time.monotonic() - self._heartbeat - self.interval
+            if blocked_for < self.threshold or self._stall_started is not None:
+                continue
+            self._stall_started = self._heartbeat
+            loop_stalls.inc()
+            frame = sys._current_frames().get(self._loop_thread_id)
+            stack = "".join(traceback.format_stack(frame, limit=self.stack_limit)) if frame else "<no frame>"
+            logger.warning(
+                f"🚧 Event loop blocked for more than {blocked_for:.3f}s, loop thread stack:\n{stack}"
+            )
+
+
+# Единственный экземпляр на процесс
+loop_monitor = LoopMonitor()
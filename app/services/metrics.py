@@ -0,0 +1,139 @@
+"""
+Метрики процесса в текстовом формате Prometheus (GET /metrics).
+
+Небольшой реестр счетчиков и гистограмм без внешних зависимостей: каждый воркер
+отдает свои значения, агрегирует их Prometheus. Значения хранятся в памяти и
+обнуляются при перезапуске - так и ожидает формат counter/histogram.
+"""
+import time
+from contextlib import contextmanager
+from typing import Dict, List, Sequence, Tuple
+
+from app.logging_config import log_context
+from app.services.tracing import start_span
+
+# Границы корзин по умолчанию, секунды: от разбора тела до ответа Webkassa
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+LabelValues = Tuple[str, ...]
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Counter:
+    """Монотонный счетчик с метками"""
+
+    kind = "counter"
+
+    def __init__(self, name: str, description: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.description = description
+        self.labelnames = tuple(labelnames)
+        self._values: Dict[LabelValues, float] = {}
+
+    def _key(self, labels: Dict[str, object]) -> LabelValues:
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self) -> List[str]:
+        return [
+            f"{self.name}{_format_labels(self.labelnames, key)} {value:g}"
+            for key, value in sorted(self._values.items())
+        ]
+
+
+class Histogram(Counter):
+    """Гистограмма с накопительными корзинами, _sum и _count"""
+
+    kind = "histogram"
+
+    def __init__(self, name: str, description: str, labelnames: Sequence[str] = (), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, description, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._series: Dict[LabelValues, List[float]] = {}
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        # [счетчики корзин..., +Inf, sum]
+        series = self._series.setdefault(key, [0] * (len(self.buckets) + 2))
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                series[index] += 1
+        series[-2] += 1
+        series[-1] += value
+
+    def render(self) -> List[str]:
+        lines = []
+        for key, series in sorted(self._series.items()):
+            bounds = [f"{bound:g}" for bound in self.buckets] + ["+Inf"]
+            for bound, count in zip(bounds, series):
+                labels = _format_labels(self.labelnames, key, f'le="{bound}"')
+                lines.append(f"{self.name}_bucket{labels} {count:g}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, key)} {series[-1]:.6f}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, key)} {series[-2]:g}")
+        return lines
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics: List[Counter] = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            lines.append(f"# HELP {metric.name} {metric.description}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+registry = MetricsRegistry()
+
+# Этапы обработки webhook: body_parse, validation, eligibility, db_upsert, altegio_fetch,
+# receipt_build, webkassa_send, shift_close, key_refresh
+stage_seconds = registry.register(Histogram(
+    "webhook_stage_duration_seconds", "Duration of webhook pipeline stages", ("stage",)
+))
+webhook_outcomes = registry.register(Counter(
+    "webhook_outcomes_total", "Processed webhooks by resource and outcome", ("resource", "outcome")
+))
+webhook_skips = registry.register(Counter(
+    "webhook_skips_total", "Webhooks not fiscalized, by resource and reason", ("resource", "reason")
+))
+webkassa_errors = registry.register(Counter(
+    "webkassa_errors_total", "Webkassa errors by error code", ("code",)
+))
+
+
+@contextmanager
+def track_stage(stage: str, **attributes):
+    """
+    Замеряет длительность этапа (работает и вокруг await) и открывает span трассы.
+    Записи лога внутри получают stage; блок получает span для атрибутов.
+    """
+    started = time.perf_counter()
+    try:
+        with start_span(stage, **attributes) as span, log_context(stage=stage):
+            yield span
+    finally:
+        stage_seconds.observe(time.perf_counter() - started, stage=stage)
+
+
+def render_metrics() -> str:
+    return registry.render()
@@ -0,0 +1,312 @@
+"""
+Очередь уведомлений в Telegram.
+
+notify() только ставит уведомление в очередь в памяти и сразу возвращается, поэтому
+время фискализации не зависит от Telegram. Фоновая задача отправляет уведомления
+через один общий HTTP-клиент:
+- одинаковые уведомления в течение NOTIFY_DEDUP_WINDOW секунд отправляются один раз,
+  число повторов приписывается к следующей отправке. Одинаковыми считаются уведомления
+  с одним текстом и одним dedup_key, а без dedup_key - с одним текстом и деталями:
+  уведомления с данными конкретного запроса в деталях передают dedup_key;
+- уведомления, пришедшие в течение NOTIFY_BATCH_DELAY секунд, объединяются в одно
+  сообщение (до лимита длины Telegram);
+- отправка не чаще NOTIFY_RATE_PER_MINUTE сообщений в минуту, ответ 429 выдерживает
+  retry_after из ответа Telegram.
+Неотправленные уведомления при остановке сохраняются в NOTIFY_OUTBOX_FILE (если задан)
+и отправляются после запуска.
+"""
+import asyncio
+import hashlib
+import html
+import json
+import logging
+import os
+import time
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+import httpx
+
+from app.services.metrics import Counter, registry
+
+logger = logging.getLogger(__name__)
+
+TELEGRAM_API_URL = "https://api.telegram.org"
+# Лимит Telegram - 4096 символов, запас на заголовок объединенного сообщения
+MAX_MESSAGE_CHARS = 4000
+MAX_DETAIL_CHARS = 400
+
+notifications_total = registry.register(Counter(
+    "telegram_notifications_total", "Telegram notifications by outcome", ("outcome",)
+))
+
+
+class Notification:
+    """Одно уведомление в очереди"""
+
+    __slots__ = ("message", "details", "created_at", "repeats", "dedup_key")
+
+    def __init__(self, message: str, details: Optional[Dict[str, Any]] = None,
+                 created_at: Optional[str] = None, repeats: int = 0, dedup_key: Optional[str] = None):
+        self.message = message
+        self.details = details or {}
+        self.created_at = created_at or datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        self.repeats = repeats
+        self.dedup_key = dedup_key
+
+    def key(self) -> str:
+        """Ключ дедупликации: текст и dedup_key, а без него - текст и все детали"""
+        identity = self.dedup_key if self.dedup_key is not None else self.details
+        content = json.dumps([self.message, identity], ensure_ascii=False, sort_keys=True, default=str)
+        return hashlib.sha1(content.encode()).hexdigest()
+
+    def render(self) -> str:
+        """Текст уведомления в разметке HTML Telegram"""
+        text = f"📅 Время: {self.created_at}\n💬 Сообщение: {html.escape(self.message)}\n"
+        if self.repeats:
+            text += f"🔁 Повторялось еще {self.repeats} раз(а) с прошлой отправки\n"
+        if self.details:
+            text += "\n📋 Детали ошибки:\n"
+            for key, value in self.details.items():
+                # Обрезаем длинные значения для читаемости
+                value = str(value)
+                if len(value) > MAX_DETAIL_CHARS:
+                    value = value[:MAX_DETAIL_CHARS] + "..."
+                text += f"• {html.escape(str(key))}: {html.escape(value)}\n"
+        return text
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {"message": self.message, "details": self.details, "created_at": self.created_at,
+                "repeats": self.repeats, "dedup_key": self.dedup_key}
+
+
+def build_messages(notifications: List[Notification]) -> List[Tuple[str, int]]:
+    """
+    Объединяет уведомления в сообщения Telegram не длиннее MAX_MESSAGE_CHARS.
+    Returns: [(текст, сколько первых уведомлений из оставшихся в него вошло), ...]
+    """
+    messages: List[List[str]] = []
+    current: List[str] = []
+    length = 0
+    for notification in notifications:
+        text = notification.render()
+        if len(text) > MAX_MESSAGE_CHARS:
+            text = text[:MAX_MESSAGE_CHARS - 30] + "\n\n[Сообщение обрезано]"
+        if current and length + len(text) + 2 > MAX_MESSAGE_CHARS:
+            messages.append(current)
+            current, length = [], 0
+        current.append(text)
+        length += len(text) + 2
+    if current:
+        messages.append(current)
+
+    rendered: List[Tuple[str, int]] = []
+    for texts in messages:
+        title = "🚨 ОШИБКА WEBKASSA" if len(texts) == 1 else f"🚨 ОШИБКИ WEBKASSA ({len(texts)})"
+        rendered.append((f"{title}\n\n" + "\n".join(texts), len(texts)))
+    return rendered
+
+
+class TelegramNotifier:
+    """Фоновая отправка уведомлений с дедупликацией, объединением и ограничением частоты"""
+
+    def __init__(self):
+        self.bot_token = os.getenv("TELEGRAM_BOT_TOKEN", "")
+        # Без токена бота отправлять некуда - уведомления остаются только в логе
+        self.enabled = os.getenv("NOTIFY_ENABLED", "True").lower() == "true" and bool(self.bot_token)
+        self.chat_id = os.getenv("TELEGRAM_CHAT_ID", "1125559425")  # ID чата для уведомлений
+        self.dedup_window = float(os.getenv("NOTIFY_DEDUP_WINDOW", "300"))
+        self.batch_delay = float(os.getenv("NOTIFY_BATCH_DELAY", "2"))
+        self.batch_size = int(os.getenv("NOTIFY_BATCH_SIZE", "20"))
+        self.min_interval = 60.0 / float(os.getenv("NOTIFY_RATE_PER_MINUTE", "20"))
+        self.max_attempts = int(os.getenv("NOTIFY_MAX_ATTEMPTS", "3"))
+        outbox_file = os.getenv("NOTIFY_OUTBOX_FILE", "")
+        self.outbox_file = Path(outbox_file) if outbox_file else None
+        self._queue: asyncio.Queue = asyncio.Queue(maxsize=int(os.getenv("NOTIFY_QUEUE_SIZE", "1000")))
+        # dedup_key -> (время последней отправки, число подавленных повторов)
+        self._recent: Dict[str, Tuple[float, int]] = {}
+        self._client: Optional[httpx.AsyncClient] = None
+        self._task: Optional[asyncio.Task] = None
+        self._pending: List[Notification] = []
+        self._next_send_at = 0.0
+
+    @property
+    def queue_depth(self) -> int:
+        return self._queue.qsize() + len(self._pending)
+
+    @property
+    def queue_capacity(self) -> int:
+        return self._queue.maxsize
+
+    async def start(self):
+        if not self.enabled:
+            if not self.bot_token:
+                logger.warning("⚠️ TELEGRAM_BOT_TOKEN is not set, Telegram notifications are disabled")
+            else:
+                logger.info("⏸️ Telegram notifications disabled (NOTIFY_ENABLED=False)")
+            return
+        self._client = httpx.AsyncClient(
+            base_url=TELEGRAM_API_URL,
+            timeout=10,
+            limits=httpx.Limits(max_connections=2, max_keepalive_connections=1),
+        )
+        for notification in self._load_outbox():
+            self._put(notification)
+        self._task = asyncio.create_task(self._run())
+        logger.info(
+            f"📨 Telegram notifier started (dedup {self.dedup_window:.0f}s, "
+            f"batch {self.batch_delay}s, {60 / self.min_interval:.0f}/min)"
+        )
+
+    async def stop(self):
+        """Останавливает отправку; неотправленное сохраняется в NOTIFY_OUTBOX_FILE"""
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        unsent = self._pending + [self._queue.get_nowait() for _ in range(self._queue.qsize())]
+        self._pending = []
+        self._save_outbox(unsent)
+        if self._client:
+            await self._client.aclose()
+            self._client = None
+
+    def notify(self, message: str, error_details: Optional[Dict[str, Any]] = None,
+               dedup_key: Optional[str] = None) -> bool:
+        """
+        Ставит уведомление в очередь; никогда не ждет. False - уведомление подавлено
+        как повтор или очередь переполнена. dedup_key - что делает уведомление тем же
+        самым (например, касса), если в деталях есть данные конкретного запроса.
+        """
+        logger.info(f"📱 Telegram notification: {message}")
+        if not self.enabled:
+            return False
+        notification = Notification(message, error_details, dedup_key=dedup_key)
+        key = notification.key()
+        now = time.monotonic()
+        sent_at, suppressed = self._recent.get(key, (None, 0))
+        if sent_at is not None and now - sent_at < self.dedup_window:
+            self._recent[key] = (sent_at, suppressed + 1)
+            notifications_total.inc(outcome="deduplicated")
+            logger.info(f"🔁 Duplicate Telegram notification suppressed ({suppressed + 1} in window)")
+            return False
+        notification.repeats = suppressed
+        self._recent[key] = (now, 0)
+        self._prune_recent(now)
+        return self._put(notification)
+
+    def _put(self, notification: Notification) -> bool:
+        try:
+            self._queue.put_nowait(notification)
+            return True
+        except asyncio.QueueFull:
+            notifications_total.inc(outcome="dropped")
+            logger.warning(f"⚠️ Telegram notification queue full, dropped: {notification.message}")
+            return False
+
+    def _prune_recent(self, now: float):
+        if len(self._recent) > 1000:
+            self._recent = {
+                key: value for key, value in self._recent.items() if now - value[0] < self.dedup_window
+            }
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                self._pending = [await self._queue.get()]
+                # Уведомления одного сбоя приходят пачкой - собираем их в одно сообщение
+                deadline = loop.time() + self.batch_delay
+                while len(self._pending) < self.batch_size:
+                    timeout = deadline - loop.time()
+                    if timeout <= 0:
+                        break
+                    try:
+                        self._pending.append(await asyncio.wait_for(self._queue.get(), timeout))
+                    except asyncio.TimeoutError:
+                        break
+                for text, count in build_messages(self._pending):
+                    await self._send(text)
+                    # Отправленное убираем сразу: при остановке в outbox попадет только неотправленное
+                    del self._pending[:count]
+                    notifications_total.inc(count, outcome="processed")
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"❌ Telegram notifier error: {e}", exc_info=True)
+                self._pending = []
+                await asyncio.sleep(1)
+
+    async def _send(self, text: str) -> bool:
+        payload = {"chat_id": self.chat_id, "text": text, "parse_mode": "HTML"}
+        for attempt in range(1, self.max_attempts + 1):
+            # Не чаще NOTIFY_RATE_PER_MINUTE сообщений в минуту
+            delay = self._next_send_at - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            self._next_send_at = time.monotonic() + self.min_interval
+            try:
+                response = await self._client.post(f"/bot{self.bot_token}/sendMessage", json=payload)
+            except httpx.RequestError as e:
+                logger.warning(f"⚠️ Telegram request failed (attempt {attempt}): {e}")
+                await asyncio.sleep(2 ** attempt)
+                continue
+            if response.status_code == 200:
+                notifications_total.inc(outcome="sent")
+                logger.info("✅ Telegram notification sent successfully")
+                return True
+            if response.status_code == 429:
+                retry_after = self._retry_after(response)
+                logger.warning(f"⏳ Telegram rate limit hit, retrying in {retry_after}s")
+                self._next_send_at = time.monotonic() + retry_after
+                continue
+            logger.error(f"❌ Failed to send Telegram notification: {response.status_code} - {response.text}")
+            break
+        notifications_total.inc(outcome="failed")
+        return False
+
+    @staticmethod
+    def _retry_after(response: httpx.Response) -> float:
+        try:
+            return float(response.json().get("parameters", {}).get("retry_after", 5))
+        except ValueError:
+            return 5.0
+
+    def _load_outbox(self) -> List[Notification]:
+        if not self.outbox_file or not self.outbox_file.is_file():
+            return []
+        notifications = []
+        try:
+            with open(self.outbox_file, encoding="utf-8") as outbox:
+                for line in outbox:
+                    if line.strip():
+                        notifications.append(Notification(**json.loads(line)))
+            self.outbox_file.unlink()
+        except (OSError, ValueError, TypeError) as e:
+            logger.warning(f"⚠️ Failed to load Telegram outbox {self.outbox_file}: {e}")
+        if notifications:
+            logger.info(f"📨 Loaded {len(notifications)} unsent Telegram notification(s) from {self.outbox_file}")
+        return notifications
+
+    def _save_outbox(self, notifications: List[Notification]):
+        if not notifications:
+            return
+        if not self.outbox_file:
+            logger.warning(f"⚠️ {len(notifications)} unsent Telegram notification(s) discarded on shutdown")
+            return
+        try:
+            self.outbox_file.parent.mkdir(parents=True, exist_ok=True)
+            with open(self.outbox_file, "a", encoding="utf-8") as outbox:
+                for notification in notifications:
+                    outbox.write(json.dumps(notification.to_dict(), ensure_ascii=False, default=str) + "\n")
+            logger.info(f"📨 Saved {len(notifications)} unsent Telegram notification(s) to {self.outbox_file}")
+        except OSError as e:
+            logger.warning(f"⚠️ Failed to save Telegram outbox: {e}")
+
+
+# Единственный экземпляр на процесс
+telegram_notifier = TelegramNotifier()
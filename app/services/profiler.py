@@ -0,0 +1,278 @@
+"""
+Статистический профилировщик живого процесса.
+
+Отдельный поток с заданной частотой снимает стеки потоков через sys._current_frames
+и считает, сколько раз встретилась каждая цепочка функций. Интерпретатор при этом не
+трассирует вызовы, поэтому накладные расходы - одно короткое пробуждение потока на
+выборку, и профилировать можно прямо в проде (GET /api/admin/profile).
+
+Результат отдается в двух форматах:
+- collapsed - строки "корень;...;функция N", вход для flamegraph.pl, speedscope, inferno;
+- speedscope - JSON формата https://www.speedscope.app/file-format-schema.json.
+
+Автозахват медленных webhook (PROFILE_SLOW_WEBHOOKS): поток постоянно снимает стек
+потока event loop вместе с текущей asyncio-задачей в кольцевой буфер. Если обработка
+webhook заняла дольше PROFILE_SLOW_WEBHOOK_THRESHOLD, выборки этой задачи за время
+обработки сохраняются в PROFILE_DIR файлом collapsed-стеков.
+"""
+import asyncio
+import collections
+import logging
+import os
+import sys
+import threading
+import time
+from datetime import datetime
+from pathlib import Path
+from types import CodeType, FrameType
+from typing import Deque, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+PROFILER_DEFAULT_INTERVAL = float(os.getenv("PROFILER_INTERVAL", "0.005"))
+PROFILER_MAX_SECONDS = float(os.getenv("PROFILER_MAX_SECONDS", "60"))
+
+# Стек - кортеж объектов кода от корня к листу (функции без номеров строк,
+# чтобы выборки из разных строк одной функции складывались вместе)
+Stack = Tuple[CodeType, ...]
+
+_SITE_PACKAGES = os.sep + "site-packages" + os.sep
+_STDLIB = os.path.dirname(os.__file__) + os.sep
+
+
+def sample_stack(frame: Optional[FrameType], limit: int = 128) -> Stack:
+    codes = []
+    while frame is not None and len(codes) < limit:
+        codes.append(frame.f_code)
+        frame = frame.f_back
+    codes.reverse()
+    return tuple(codes)
+
+
+def _short_path(filename: str) -> str:
+    if _SITE_PACKAGES in filename:
+        return filename.split(_SITE_PACKAGES, 1)[1]
+    if filename.startswith(_STDLIB):
+        return filename[len(_STDLIB):]
+    cwd = os.getcwd() + os.sep
+    return filename[len(cwd):] if filename.startswith(cwd) else filename
+
+
+def _frame_name(code: CodeType) -> str:
+    return getattr(code, "co_qualname", code.co_name)
+
+
+def _frame_label(code: CodeType) -> str:
+    # Пробелы допустимы: количество отделяется последним пробелом строки, ';' - разделитель
+    return f"{_frame_name(code)} ({_short_path(code.co_filename)}:{code.co_firstlineno})".replace(";", ":")
+
+
+class Profile:
+    """Выборки стеков в порядке снятия: (метка потока, стек, вес в секундах)"""
+
+    def __init__(self, name: str, interval: float):
+        self.name = name
+        self.interval = interval
+        self.samples: List[Tuple[str, Stack, float]] = []
+        self.started_at = time.time()
+        self.duration = 0.0
+
+    def add(self, thread: str, stack: Stack, weight: float):
+        if stack:
+            self.samples.append((thread, stack, weight))
+
+    def to_collapsed(self) -> str:
+        counts: Dict[Tuple[str, ...], int] = collections.Counter()
+        for thread, stack, _ in self.samples:
+            labels = tuple(_frame_label(code) for code in stack)
+            counts[(thread,) + labels if thread else labels] += 1
+        return "".join(f"{';'.join(labels)} {count}\n" for labels, count in sorted(counts.items()))
+
+    def to_speedscope(self) -> Dict:
+        frames: List[Dict] = []
+        frame_index: Dict[CodeType, int] = {}
+        samples, weights = [], []
+        for _, stack, weight in self.samples:
+            indexes = []
+            for code in stack:
+                if code not in frame_index:
+                    frame_index[code] = len(frames)
+                    frames.append({
+                        "name": _frame_name(code),
+                        "file": _short_path(code.co_filename),
+                        "line": code.co_firstlineno,
+                    })
+                indexes.append(frame_index[code])
+            samples.append(indexes)
+            weights.append(round(weight, 6))
+        return {
+            "$schema": "https://www.speedscope.app/file-format-schema.json",
+            "name": self.name,
+            "exporter": "altegio-webkassa-integration",
+            "shared": {"frames": frames},
+            "profiles": [{
+                "type": "sampled",
+                "name": self.name,
+                "unit": "seconds",
+                "startValue": 0,
+                "endValue": round(sum(weights), 6),
+                "samples": samples,
+                "weights": weights,
+            }],
+        }
+
+
+def _sample_for(profile: Profile, seconds: float, thread_id: Optional[int]):
+    """Снимает выборки в текущем (рабочем) потоке; thread_id=None - все потоки, кроме своего"""
+    own_id = threading.get_ident()
+    names = {thread.ident: thread.name for thread in threading.enumerate()}
+    started = last = time.perf_counter()
+    deadline = started + seconds
+    while True:
+        time.sleep(profile.interval)
+        now = time.perf_counter()
+        weight, last = now - last, now
+        frames = sys._current_frames()
+        if thread_id is not None:
+            profile.add("", sample_stack(frames.get(thread_id)), weight)
+        else:
+            for ident, frame in frames.items():
+                if ident != own_id:
+                    profile.add(names.get(ident, str(ident)), sample_stack(frame), weight)
+        if now >= deadline:
+            break
+    profile.duration = time.perf_counter() - started
+
+
+_capture_lock = asyncio.Lock()
+
+
+def capture_in_progress() -> bool:
+    return _capture_lock.locked()
+
+
+async def capture_profile(seconds: float, interval: float = PROFILER_DEFAULT_INTERVAL,
+                          all_threads: bool = False) -> Profile:
+    """
+    Профилирует процесс seconds секунд, не блокируя event loop (выборки снимает
+    рабочий поток). По умолчанию - только поток event loop, где работают обработчики.
+    Одновременно выполняется один захват.
+    """
+    seconds = min(max(seconds, interval), PROFILER_MAX_SECONDS)
+    async with _capture_lock:
+        profile = Profile(
+            f"altegio-webkassa {'all threads' if all_threads else 'event loop'} "
+            f"{datetime.now().isoformat(timespec='seconds')}",
+            interval,
+        )
+        thread_id = None if all_threads else threading.get_ident()
+        await asyncio.to_thread(_sample_for, profile, seconds, thread_id)
+        return profile
+
+
+class SlowWebhookProfiler:
+    """Непрерывные выборки потока event loop и сохранение профиля медленных webhook"""
+
+    def __init__(self):
+        self.enabled = os.getenv("PROFILE_SLOW_WEBHOOKS", "False").lower() == "true"
+        self.threshold = float(os.getenv("PROFILE_SLOW_WEBHOOK_THRESHOLD", "2.0"))
+        self.interval = float(os.getenv("PROFILE_SLOW_WEBHOOK_INTERVAL", "0.01"))
+        self.directory = Path(os.getenv("PROFILE_DIR", "logs/profiles"))
+        self.keep = int(os.getenv("PROFILE_KEEP", "50"))
+        # Буфер на минуту выборок: обработка дольше минуты сохранится с обрезанным началом
+        self._samples: Deque[Tuple[float, int, Stack]] = collections.deque(
+            maxlen=max(int(60 / self.interval), 1000)
+        )
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._loop_thread_id: Optional[int] = None
+        self._thread: Optional[threading.Thread] = None
+        self._stopped = threading.Event()
+
+    async def start(self):
+        if not self.enabled:
+            return
+        self._loop = asyncio.get_running_loop()
+        self._loop_thread_id = threading.get_ident()
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run, name="slow-webhook-profiler", daemon=True)
+        self._thread.start()
+        logger.info(
+            f"🔬 Slow webhook profiler started (threshold {self.threshold}s, "
+            f"interval {self.interval}s, dir {self.directory})"
+        )
+
+    async def stop(self):
+        self._stopped.set()
+        if self._thread:
+            await asyncio.to_thread(self._thread.join, 2)
+            self._thread = None
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            frame = sys._current_frames().get(self._loop_thread_id)
+            try:
+                task = asyncio.current_task(self._loop)
+            except RuntimeError:
+                task = None
+            # Цикл ждет ввода-вывода - выборка не относится ни к одной задаче
+            if task is not None and frame is not None:
+                self._samples.append((time.monotonic(), id(task), sample_stack(frame)))
+
+    async def webhook_finished(self, started: float, label: str):
+        """
+        Вызывается задачей обработки webhook по завершении; started - time.monotonic()
+        в начале обработки. Медленная обработка сохраняется в файл профиля.
+        """
+        if not self._thread:
+            return
+        duration = time.monotonic() - started
+        if duration < self.threshold:
+            return
+        task_id = id(asyncio.current_task())
+        profile = Profile(f"slow webhook {label} ({duration:.3f}s)", self.interval)
+        for sampled_at, sample_task, stack in list(self._samples):
+            if sample_task == task_id and sampled_at >= started:
+                profile.add("", stack, self.interval)
+        profile.duration = duration
+        if not profile.samples:
+            logger.info(f"🔬 Slow webhook {label} took {duration:.3f}s without CPU samples (waiting on I/O)")
+            return
+        try:
+            path = await asyncio.to_thread(self._save, profile, label)
+        except OSError as e:
+            logger.warning(f"⚠️ Failed to save slow webhook profile: {e}")
+            return
+        logger.warning(
+            f"🔬 Slow webhook {label} took {duration:.3f}s, "
+            f"{len(profile.samples)} samples saved to {path}"
+        )
+
+    def _save(self, profile: Profile, label: str) -> Path:
+        self.directory.mkdir(parents=True, exist_ok=True)
+        safe_label = "".join(char if char.isalnum() or char in "-_" else "_" for char in label)
+        path = self.directory / f"webhook_{datetime.now():%Y%m%d_%H%M%S_%f}_{safe_label}.collapsed"
+        path.write_text(profile.to_collapsed(), encoding="utf-8")
+        # Храним только последние PROFILE_KEEP профилей
+        saved = sorted(self.directory.glob("webhook_*.collapsed"))
+        for old in saved[:-self.keep] if self.keep > 0 else []:
+            old.unlink(missing_ok=True)
+        return path
+
+    def list_profiles(self) -> List[Dict]:
+        if not self.directory.is_dir():
+            return []
+        return [
+            {"name": path.name, "size": path.stat().st_size,
+             "created_at": datetime.fromtimestamp(path.stat().st_mtime).isoformat(timespec="seconds")}
+            for path in sorted(self.directory.glob("webhook_*.collapsed"), reverse=True)
+        ]
+
+    def profile_path(self, name: str) -> Optional[Path]:
+        path = self.directory / name
+        if path.name != name or path.suffix != ".collapsed" or not path.is_file():
+            return None
+        return path
+
+
+# Единственный экземпляр на процесс
+slow_webhook_profiler = SlowWebhookProfiler()
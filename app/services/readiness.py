@@ -0,0 +1,169 @@
+"""
+Проверка готовности сервиса (GET /ready) с кэшированием результата.
+
+Проверяются: доступность БД, заполненность пула соединений, возраст токенов Webkassa,
+очередь журнала фискализации, очередь уведомлений Telegram, выключатели Altegio/Webkassa и лаг event loop.
+Статус сервиса:
+- ok - все проверки в норме;
+- degraded - сервис принимает webhook, но что-то требует внимания (старый токен,
+  разомкнут выключатель, пул или очередь почти заполнены, цикл тормозит);
+- fail - webhook обработать нельзя (нет БД), /ready отвечает 503.
+
+Результат живет READY_CACHE_SECONDS секунд, а одновременные запросы ждут одну общую
+проверку, поэтому частые пробы Docker и nginx не нагружают БД.
+"""
+import asyncio
+import logging
+import os
+import time
+from datetime import datetime
+from typing import Any, Dict, Optional
+
+from sqlalchemy import text
+
+from app.db import AsyncSessionLocal, check_database_connection, get_pool_stats
+from app.services.circuit_breaker import altegio_breaker, webkassa_breaker
+from app.services.fiscalization_log import fiscalization_log_writer
+from app.services.loop_monitor import loop_monitor
+from app.services.notifications import telegram_notifier
+
+logger = logging.getLogger(__name__)
+
+OK = "ok"
+DEGRADED = "degraded"
+FAIL = "fail"
+_SEVERITY = {OK: 0, DEGRADED: 1, FAIL: 2}
+
+
+class ReadinessProbe:
+    """Кэшируемый набор проверок зависимостей сервиса"""
+
+    def __init__(self):
+        self.cache_seconds = float(os.getenv("READY_CACHE_SECONDS", "5"))
+        self.check_timeout = float(os.getenv("READY_CHECK_TIMEOUT", "2"))
+        self.pool_saturation_threshold = float(os.getenv("READY_POOL_SATURATION", "0.9"))
+        self.token_max_age_hours = float(os.getenv("READY_TOKEN_MAX_AGE_HOURS", "6"))
+        self.loop_lag_threshold = float(os.getenv("READY_LOOP_LAG_THRESHOLD", "0.5"))
+        self._result: Optional[Dict[str, Any]] = None
+        self._checked_at = 0.0
+        self._lock = asyncio.Lock()
+
+    async def check(self) -> Dict[str, Any]:
+        if self._result and time.monotonic() - self._checked_at < self.cache_seconds:
+            return self._result
+        async with self._lock:
+            # Пока ждали блокировку, проверку мог выполнить другой запрос
+            if self._result and time.monotonic() - self._checked_at < self.cache_seconds:
+                return self._result
+            self._result = await self._run_checks()
+            self._checked_at = time.monotonic()
+            return self._result
+
+    async def _run_checks(self) -> Dict[str, Any]:
+        database = await self._check_database()
+        checks = {
+            "database": database,
+            "pool": self._check_pool(),
+            # Токены читаются из той же БД: без нее проверка бессмысленна
+            "webkassa_tokens": await self._check_tokens() if database["status"] == OK
+            else {"status": DEGRADED, "error": "database unavailable"},
+            "fiscalization_log_queue": self._check_queue(),
+            "notification_queue": self._check_notifications(),
+            "circuit_breakers": self._check_breakers(),
+            "event_loop": self._check_loop(),
+        }
+        status = max((check["status"] for check in checks.values()), key=_SEVERITY.get)
+        return {
+            "status": status,
+            "checked_at": datetime.utcnow().isoformat(timespec="seconds") + "Z",
+            "checks": checks,
+        }
+
+    async def _check_database(self) -> Dict[str, Any]:
+        started = time.perf_counter()
+        try:
+            reachable = await asyncio.wait_for(check_database_connection(), self.check_timeout)
+        except asyncio.TimeoutError:
+            return {"status": FAIL, "error": f"timeout after {self.check_timeout}s"}
+        latency_ms = round((time.perf_counter() - started) * 1000, 1)
+        if not reachable:
+            return {"status": FAIL, "error": "connection failed", "latency_ms": latency_ms}
+        return {"status": OK, "latency_ms": latency_ms}
+
+    def _check_pool(self) -> Dict[str, Any]:
+        stats = get_pool_stats()
+        capacity = stats["size"] + stats["max_overflow"]
+        saturation = stats["in_use"] / capacity if capacity else 0.0
+        return {
+            "status": DEGRADED if saturation >= self.pool_saturation_threshold else OK,
+            "saturation": round(saturation, 3),
+            "in_use": stats["in_use"],
+            "capacity": capacity,
+            "wait_ms_max": stats["wait_ms_max"],
+        }
+
+    async def _check_tokens(self) -> Dict[str, Any]:
+        """Возраст токенов всех учетных записей Webkassa одним запросом"""
+        try:
+            async with AsyncSessionLocal() as session:
+                result = await asyncio.wait_for(
+                    session.execute(text("SELECT service_name, updated_at FROM api_keys")),
+                    self.check_timeout,
+                )
+                rows = result.all()
+        except Exception as e:
+            return {"status": DEGRADED, "error": f"{type(e).__name__}: {e}"}
+
+        if not rows:
+            return {"status": DEGRADED, "error": "no Webkassa token stored yet"}
+        now = datetime.utcnow()
+        tokens = {}
+        for service_name, updated_at in rows:
+            age_hours = (now - updated_at).total_seconds() / 3600 if updated_at else None
+            tokens[service_name] = {
+                "age_hours": round(age_hours, 2) if age_hours is not None else None,
+                "stale": age_hours is None or age_hours > self.token_max_age_hours,
+            }
+        stale = any(token["stale"] for token in tokens.values())
+        return {
+            "status": DEGRADED if stale else OK,
+            "max_age_hours": self.token_max_age_hours,
+            "tokens": tokens,
+        }
+
+    def _check_queue(self) -> Dict[str, Any]:
+        depth = fiscalization_log_writer.queue_depth
+        capacity = fiscalization_log_writer.queue_capacity
+        return {
+            "status": DEGRADED if capacity and depth >= capacity * 0.8 else OK,
+            "depth": depth,
+            "capacity": capacity,
+            "dropped": fiscalization_log_writer.dropped,
+        }
+
+    def _check_notifications(self) -> Dict[str, Any]:
+        depth = telegram_notifier.queue_depth
+        capacity = telegram_notifier.queue_capacity
+        return {
+            "status": DEGRADED if capacity and depth >= capacity * 0.8 else OK,
+            "depth": depth,
+            "capacity": capacity,
+            "enabled": telegram_notifier.enabled,
+        }
+
+    def _check_breakers(self) -> Dict[str, Any]:
+        breakers = {breaker.name: breaker.snapshot() for breaker in (altegio_breaker, webkassa_breaker)}
+        opened = any(breaker["state"] != "closed" for breaker in breakers.values())
+        return {"status": DEGRADED if opened else OK, **breakers}
+
+    def _check_loop(self) -> Dict[str, Any]:
+        lag = loop_monitor.last_lag
+        return {
+            "status": DEGRADED if lag >= self.loop_lag_threshold else OK,
+            "lag_ms": round(lag * 1000, 1),
+            "monitor_enabled": loop_monitor.enabled,
+        }
+
+
+# Единственный экземпляр на процесс
+readiness_probe = ReadinessProbe()
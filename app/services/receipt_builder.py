@@ -0,0 +1,277 @@
+"""
+Сборка чека Webkassa из данных Altegio.
+
+Чистые синхронные функции без ввода-вывода: позиции и платежи берутся из
+подключаемых источников, поэтому один и тот же код собирает чеки для записей
+(services + goods_transactions + transactions) и продаж товаров
+(state.items + state.payment_transactions).
+
+Денежные суммы считаются в Decimal с точностью до тиына и переводятся в float
+ровно один раз - при сериализации чека. Перед отправкой чек проверяется:
+сумма позиций за вычетом скидок должна совпадать с суммой платежей.
+Суммы в тенге, как их фактически присылает Altegio (описания схемы про копейки
+не соответствуют данным).
+"""
+from decimal import ROUND_HALF_UP, Decimal
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+
+from app.schemas.altegio import AltegioWebhookPayload
+
+# Константа для исключения платежей с комиссией эквайринга
+ACQUIRING_COMMISSION_COMMENT = "Автоматически созданная операция списания комиссии за эквайринг."
+
+PAYMENT_TYPE_CASH = 0
+PAYMENT_TYPE_CARD = 1
+
+MONEY_QUANTUM = Decimal("0.01")
+ZERO = Decimal("0")
+
+# Позиция чека и сумма к оплате по ней
+PositionEntry = Tuple[Dict[str, Any], Decimal]
+
+
+class ReceiptMismatchError(ValueError):
+    """Сумма позиций за вычетом скидок не совпадает с суммой платежей"""
+
+    def __init__(self, positions_total: Decimal, payments_total: Decimal):
+        self.positions_total = positions_total
+        self.payments_total = payments_total
+        super().__init__(
+            f"Receipt mismatch: positions total {positions_total} != payments total {payments_total}"
+        )
+
+
+def to_money(value: Any) -> Decimal:
+    """Точное значение суммы (через str, чтобы не тащить ошибку двоичного float)"""
+    if isinstance(value, Decimal):
+        return value.quantize(MONEY_QUANTUM, rounding=ROUND_HALF_UP)
+    return Decimal(str(value or 0)).quantize(MONEY_QUANTUM, rounding=ROUND_HALF_UP)
+
+
+def to_quantity(value: Any) -> Decimal:
+    return value if isinstance(value, Decimal) else Decimal(str(value))
+
+
+def should_skip_transaction(transaction_comment: str) -> bool:
+    """
+    Проверяет, нужно ли пропустить транзакцию на основе комментария
+    """
+    return transaction_comment == ACQUIRING_COMMISSION_COMMENT
+
+
+def get_client_data(client) -> Tuple[str, str]:
+    """
+    Безопасно извлекает телефон и имя клиента из разных форматов данных
+    Returns: (client_phone, client_name)
+    """
+    client_phone = ""
+    client_name = ""
+
+    if client:
+        if isinstance(client, dict):
+            client_phone = client.get('phone', '')
+            client_name = client.get('name', '')
+        elif isinstance(client, list) and client:
+            first_client = client[0]
+            if isinstance(first_client, dict):
+                client_phone = first_client.get('phone', '')
+                client_name = first_client.get('name', '')
+        elif hasattr(client, 'phone'):
+            client_phone = client.phone
+            client_name = client.name
+
+    return client_phone, client_name
+
+
+def get_sale_state(altegio_document: Any) -> Dict[str, Any]:
+    """Возвращает data.state документа продажи товаров (или пустой словарь)"""
+    if isinstance(altegio_document, dict):
+        data = altegio_document.get('data')
+        if isinstance(data, dict) and isinstance(data.get('state'), dict):
+            return data['state']
+    return {}
+
+
+def make_position(name: str, count: Any, price: Decimal, discount: Decimal) -> Dict[str, Any]:
+    return {
+        "Count": count,
+        "Price": price,  # Оригинальная цена за единицу
+        "PositionName": name,
+        "Discount": discount,  # Скидка в тенге
+        "Tax": "0",
+        "TaxType": "0",
+        "TaxPercent": "0"
+    }
+
+
+# --- Источники позиций -------------------------------------------------------
+
+def positions_from_services(payload: AltegioWebhookPayload, altegio_document: Any) -> List[PositionEntry]:
+    """Услуги записи из webhook (payload.data.services)"""
+    entries = []
+    for service in payload.data.services:
+        price = to_money(service.cost_per_unit)
+        total = to_money(service.cost_to_pay)
+        discount = to_money(price * to_quantity(service.amount) - total)
+        entries.append((make_position(service.title, service.amount, price, discount), total))
+    return entries
+
+
+def positions_from_goods_transactions(payload: AltegioWebhookPayload, altegio_document: Any) -> List[PositionEntry]:
+    """Товары записи из webhook (payload.data.goods_transactions)"""
+    entries = []
+    for good in payload.data.goods_transactions:
+        count = abs(good["amount"])
+        price = to_money(good["cost_per_unit"])
+        original_total = price * to_quantity(count)
+        if "cost_to_pay" in good:
+            total = to_money(good["cost_to_pay"])
+        else:
+            total = to_money(original_total * (100 - to_quantity(good["discount"])) / 100)
+        discount = to_money(original_total - total)
+        entries.append((make_position(good["title"], count, price, discount), total))
+    return entries
+
+
+def positions_from_sale_items(payload: AltegioWebhookPayload, altegio_document: Any) -> List[PositionEntry]:
+    """Товары из документа продажи (data.state.items)"""
+    entries = []
+    for item in get_sale_state(altegio_document).get('items') or []:
+        count = abs(item.get('amount', 1))
+        price = to_money(item.get('default_cost_per_unit', 0))
+        total = to_money(item.get('cost_to_pay_total', 0))
+        discount = to_money(price * to_quantity(count) - total)
+        entries.append((make_position(item.get('title', 'Unknown Item'), count, price, discount), total))
+    return entries
+
+
+# --- Источники платежей ------------------------------------------------------
+
+def transactions_from_document(altegio_document: Any) -> List[Dict[str, Any]]:
+    """
+    Транзакции из документа Altegio: список, {"data": [...]} или документ продажи
+    """
+    if isinstance(altegio_document, list):
+        return altegio_document
+    if isinstance(altegio_document, dict):
+        state = get_sale_state(altegio_document)
+        if state:
+            return state.get('payment_transactions') or []
+        data = altegio_document.get('data', [])
+        return data if isinstance(data, list) else []
+    return []
+
+
+def payments_from_transactions(altegio_document: Any) -> List[Dict[str, Any]]:
+    """Платежи из документа транзакций визита"""
+    return build_payments(transactions_from_document(altegio_document))
+
+
+def payments_from_sale_transactions(altegio_document: Any) -> List[Dict[str, Any]]:
+    """Платежи из документа продажи (data.state.payment_transactions)"""
+    return build_payments(get_sale_state(altegio_document).get('payment_transactions') or [])
+
+
+def build_payments(transactions: Sequence[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Положительные транзакции без комиссии эквайринга -> платежи Webkassa"""
+    payments = []
+    for transaction in transactions:
+        amount = transaction.get('amount', 0)
+        if should_skip_transaction(transaction.get('comment', '')):
+            continue
+        if amount > 0:
+            account_info = transaction.get('account') or {}
+            is_cash = account_info.get('is_cash', True)
+            payments.append({
+                "Sum": to_money(amount),
+                "PaymentType": PAYMENT_TYPE_CASH if is_cash else PAYMENT_TYPE_CARD
+            })
+    return payments
+
+
+PositionSource = Callable[[AltegioWebhookPayload, Any], List[PositionEntry]]
+PaymentSource = Callable[[Any], List[Dict[str, Any]]]
+
+POSITION_SOURCES: Dict[str, PositionSource] = {
+    "services": positions_from_services,
+    "goods_transactions": positions_from_goods_transactions,
+    "sale_items": positions_from_sale_items,
+}
+
+PAYMENT_SOURCES: Dict[str, PaymentSource] = {
+    "transactions": payments_from_transactions,
+    "payment_transactions": payments_from_sale_transactions,
+}
+
+# Какие источники используются для каждого типа webhook
+RECEIPT_LAYOUTS: Dict[str, Tuple[Tuple[str, ...], str]] = {
+    "record": (("services", "goods_transactions"), "transactions"),
+    "goods_operations_sale": (("sale_items",), "payment_transactions"),
+}
+
+
+def check_receipt_totals(positions_total: Decimal, payments: Sequence[Dict[str, Any]]):
+    """Проверяет чек до отправки, чтобы расхождение не стоило запроса в Webkassa"""
+    payments_total = sum((payment["Sum"] for payment in payments), ZERO)
+    if payments_total != positions_total:
+        raise ReceiptMismatchError(positions_total, payments_total)
+
+
+def serialize_money(receipt: Dict[str, Any]) -> Dict[str, Any]:
+    """Единственная точка перевода Decimal-сумм в float для JSON"""
+    for position in receipt["Positions"]:
+        position["Price"] = float(position["Price"])
+        position["Discount"] = float(position["Discount"])
+    for payment in receipt["Payments"]:
+        payment["Sum"] = float(payment["Sum"])
+    return receipt
+
+
+def build_receipt(
+    payload: AltegioWebhookPayload,
+    altegio_document: Any,
+    cashbox_id: Optional[str],
+    position_sources: Optional[Sequence[str]] = None,
+    payment_source: Optional[str] = None,
+    check_totals: bool = True,
+) -> Dict[str, Any]:
+    """
+    Преобразует данные из Altegio webhook и документа в формат, ожидаемый Webkassa.
+
+    Источники по умолчанию выбираются по payload.resource (см. RECEIPT_LAYOUTS).
+    Если в документе нет платежей, чек оплачивается одной безналичной суммой позиций.
+    При check_totals=True несходящийся чек вызывает ReceiptMismatchError.
+    """
+    default_positions, default_payments = RECEIPT_LAYOUTS.get(payload.resource, RECEIPT_LAYOUTS["record"])
+    position_sources = position_sources or default_positions
+    payment_source = payment_source or default_payments
+
+    positions = []
+    total_sum = ZERO
+    for source_name in position_sources:
+        for position, total in POSITION_SOURCES[source_name](payload, altegio_document):
+            positions.append(position)
+            total_sum += total
+
+    payments = PAYMENT_SOURCES[payment_source](altegio_document)
+    if not payments:
+        payments.append({
+            "Sum": total_sum,
+            "PaymentType": PAYMENT_TYPE_CARD  # По умолчанию банковская карта
+        })
+
+    if check_totals:
+        check_receipt_totals(total_sum, payments)
+
+    client_phone, _ = get_client_data(payload.data.client)
+    return serialize_money({
+        "CashboxUniqueNumber": cashbox_id,
+        "OperationType": 2,  # Продажа
+        "Positions": positions,
+        "TicketModifiers": [],
+        "Payments": payments,
+        "Change": 0.0,
+        "RoundType": 2,
+        "ExternalCheckNumber": payload.data.id,
+        "CustomerPhone": client_phone
+    })
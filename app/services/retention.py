@@ -0,0 +1,303 @@
+"""
+Помесячные секции webhook_records / webhook_payloads и архивация старой истории.
+
+Обе таблицы секционированы по created_at (RANGE, секция на календарный месяц,
+плюс секция DEFAULT на всякий случай). Фоновая задача заранее создает секции
+на несколько месяцев вперед, а секции старше RETENTION_MONTHS выгружает потоково
+в сжатый JSONL (webhook_records_YYYY_MM.jsonl.gz) и удаляет. Строки, попавшие
+в DEFAULT, переносятся в секцию месяца при ее создании, а устаревшие строки DEFAULT
+архивируются отдельно. Размер индексов и время статистических запросов остаются
+постоянными при росте истории.
+"""
+import asyncio
+import gzip
+import json
+import logging
+import os
+import re
+from datetime import datetime
+from pathlib import Path
+from typing import List, Optional
+
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncConnection
+
+from app.db import engine
+
+logger = logging.getLogger(__name__)
+
+RECORDS_TABLE = "webhook_records"
+PAYLOADS_TABLE = "webhook_payloads"
+KEYS_TABLE = "webhook_record_keys"
+# Таблицы с одинаковой разбивкой; payloads ссылаются на records, поэтому идут вторыми
+PARTITIONED_TABLES = (RECORDS_TABLE, PAYLOADS_TABLE)
+
+PARTITION_NAME_RE = re.compile(r"^webhook_records_p(\d{4})_(\d{2})$")
+
+
+def month_start(value: datetime) -> datetime:
+    return value.replace(day=1, hour=0, minute=0, second=0, microsecond=0, tzinfo=None)
+
+
+def add_months(value: datetime, months: int) -> datetime:
+    """Начало месяца через months месяцев от value (может быть отрицательным)"""
+    index = value.year * 12 + value.month - 1 + months
+    return datetime(index // 12, index % 12 + 1, 1)
+
+
+def partition_name(table: str, month: datetime) -> str:
+    return f"{table}_p{month.year:04d}_{month.month:02d}"
+
+
+def months_to_archive(months: List[datetime], cutoff: datetime) -> List[datetime]:
+    """Месяцы секций, целиком лежащие раньше cutoff"""
+    return [month for month in months if add_months(month, 1) <= cutoff]
+
+
+async def move_default_rows(conn: AsyncConnection, month: datetime, upper: datetime) -> int:
+    """
+    Создает секции месяца, строки которого уже лежат в DEFAULT: PostgreSQL не создает
+    секцию, пока в DEFAULT есть строки ее диапазона. Отсоединить DEFAULT нельзя - на его
+    записи ссылается webhook_record_keys, - поэтому строки месяца копируются во временные
+    таблицы, удаляются из DEFAULT (payloads и ключи - каскадом), секции создаются, и строки
+    вставляются обратно через родительские таблицы. Вызывать внутри savepoint.
+    """
+    bounds = {"lower": month, "upper": upper}
+    in_month = "WHERE created_at >= :lower AND created_at < :upper"
+    for table in (RECORDS_TABLE, PAYLOADS_TABLE, KEYS_TABLE):
+        await conn.execute(
+            text(f"CREATE TEMPORARY TABLE moving_{table} ON COMMIT DROP AS SELECT * FROM {table} {in_month}"),
+            bounds,
+        )
+    result = await conn.execute(text(f"DELETE FROM {RECORDS_TABLE}_default {in_month}"), bounds)
+    for table in PARTITIONED_TABLES:
+        await conn.execute(text(
+            f"CREATE TABLE {partition_name(table, month)} PARTITION OF {table} "
+            f"FOR VALUES FROM ('{month.isoformat()}') TO ('{upper.isoformat()}')"
+        ))
+    for table in (RECORDS_TABLE, PAYLOADS_TABLE, KEYS_TABLE):
+        await conn.execute(text(f"INSERT INTO {table} SELECT * FROM moving_{table}"))
+        await conn.execute(text(f"DROP TABLE moving_{table}"))
+    return result.rowcount
+
+
+async def ensure_partitions(conn: AsyncConnection, start: Optional[datetime] = None, months_ahead: int = 3):
+    """
+    Создает помесячные секции обеих таблиц от start (по умолчанию текущий месяц)
+    до months_ahead месяцев вперед, а также секции DEFAULT.
+    """
+    now = datetime.utcnow()
+    month = month_start(start or now)
+    last = add_months(now, months_ahead)
+    has_default = await conn.scalar(text(f"SELECT to_regclass('{RECORDS_TABLE}_default') IS NOT NULL"))
+    while month <= last:
+        upper = add_months(month, 1)
+        if has_default and await conn.scalar(
+            text(f"SELECT to_regclass('{partition_name(RECORDS_TABLE, month)}') IS NULL AND EXISTS ("
+                 f"SELECT 1 FROM {RECORDS_TABLE}_default WHERE created_at >= :lower AND created_at < :upper)"),
+            {"lower": month, "upper": upper},
+        ):
+            try:
+                async with conn.begin_nested():
+                    moved = await move_default_rows(conn, month, upper)
+                logger.info(f"📦 Moved {moved} record(s) for {month:%Y-%m} from DEFAULT into a monthly partition")
+            except Exception as e:
+                logger.warning(f"⚠️ Failed to move {month:%Y-%m} rows out of the DEFAULT partition: {e}")
+            month = upper
+            continue
+
+        for table in PARTITIONED_TABLES:
+            name = partition_name(table, month)
+            try:
+                # Savepoint: ошибка одной секции не должна ронять всю транзакцию
+                async with conn.begin_nested():
+                    await conn.execute(text(
+                        f"CREATE TABLE IF NOT EXISTS {name} PARTITION OF {table} "
+                        f"FOR VALUES FROM ('{month.isoformat()}') TO ('{upper.isoformat()}')"
+                    ))
+            except Exception as e:
+                logger.warning(f"⚠️ Failed to create partition {name}: {e}")
+        month = upper
+
+    for table in PARTITIONED_TABLES:
+        await conn.execute(text(f"CREATE TABLE IF NOT EXISTS {table}_default PARTITION OF {table} DEFAULT"))
+
+
+async def list_record_partitions(conn: AsyncConnection) -> List[datetime]:
+    """Месяцы существующих помесячных секций webhook_records (по возрастанию)"""
+    result = await conn.execute(text(
+        "SELECT child.relname FROM pg_inherits "
+        "JOIN pg_class parent ON parent.oid = pg_inherits.inhparent "
+        "JOIN pg_class child ON child.oid = pg_inherits.inhrelid "
+        "WHERE parent.relname = :parent"
+    ), {"parent": RECORDS_TABLE})
+    months = []
+    for (name,) in result:
+        match = PARTITION_NAME_RE.match(name)
+        if match:
+            months.append(datetime(int(match.group(1)), int(match.group(2)), 1))
+    return sorted(months)
+
+
+class RetentionManager:
+    """Фоновое обслуживание секций: создание будущих и архивация старых"""
+
+    def __init__(self):
+        self.enabled = os.getenv("RETENTION_ENABLED", "True").lower() == "true"
+        self.retention_months = int(os.getenv("RETENTION_MONTHS", "12"))
+        self.archive_dir = Path(os.getenv("RETENTION_ARCHIVE_DIR", "/app/archive"))
+        self.check_interval = float(os.getenv("RETENTION_CHECK_INTERVAL", "21600"))
+        self.months_ahead = int(os.getenv("PARTITION_MONTHS_AHEAD", "3"))
+        self.batch_size = int(os.getenv("RETENTION_EXPORT_BATCH", "500"))
+        self._task: Optional[asyncio.Task] = None
+
+    async def start(self):
+        if not self.enabled:
+            logger.info("⏸️ Retention job disabled (RETENTION_ENABLED=False)")
+            return
+        self._task = asyncio.create_task(self._run())
+        logger.info(f"🗄️ Retention job started: keep {self.retention_months} month(s), archive to {self.archive_dir}")
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            self._task = None
+
+    async def _run(self):
+        while True:
+            try:
+                await self.run_once()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"❌ Error in retention job: {e}", exc_info=True)
+            await asyncio.sleep(self.check_interval)
+
+    def cutoff(self, now: Optional[datetime] = None) -> datetime:
+        """Секции, целиком лежащие раньше этой даты, архивируются"""
+        return add_months(now or datetime.utcnow(), -self.retention_months)
+
+    async def run_once(self) -> List[str]:
+        """Один проход: будущие секции + архивация устаревших. Возвращает пути архивов."""
+        async with engine.begin() as conn:
+            await ensure_partitions(conn, months_ahead=self.months_ahead)
+            months = await list_record_partitions(conn)
+
+        cutoff = self.cutoff()
+        archived = []
+        for month in months_to_archive(months, cutoff):
+            path = await self.archive_partition(month)
+            if path:
+                archived.append(path)
+        path = await self.archive_default(cutoff)
+        if path:
+            archived.append(path)
+        return archived
+
+    async def archive_partition(self, month: datetime) -> Optional[str]:
+        """
+        Потоково выгружает секцию месяца в gzip JSONL и удаляет ее.
+        Выгрузка и удаление - одна транзакция: при ошибке данные остаются в базе.
+        """
+        records = partition_name(RECORDS_TABLE, month)
+        payloads = partition_name(PAYLOADS_TABLE, month)
+        upper = add_months(month, 1)
+        self.archive_dir.mkdir(parents=True, exist_ok=True)
+        target = self.archive_dir / f"{RECORDS_TABLE}_{month:%Y_%m}.jsonl.gz"
+        temporary = target.with_name(target.name + ".part")
+
+        async with engine.connect() as conn:
+            async with conn.begin():
+                # Архивирует один воркер; остальные пропускают проход
+                locked = await conn.scalar(text("SELECT pg_try_advisory_xact_lock(hashtext('webhook_retention'))"))
+                if not locked:
+                    return None
+
+                logger.info(f"🗄️ Archiving partition {records} to {target}")
+                try:
+                    exported = await self._export(conn, records, payloads, temporary)
+                    await conn.execute(text(f"DROP TABLE IF EXISTS {payloads}"))
+                    # Ключи ссылаются на записи: без них секцию можно отсоединить
+                    await conn.execute(
+                        text("DELETE FROM webhook_record_keys WHERE created_at >= :lower AND created_at < :upper"),
+                        {"lower": month, "upper": upper},
+                    )
+                    await conn.execute(text(f"ALTER TABLE {RECORDS_TABLE} DETACH PARTITION {records}"))
+                    await conn.execute(text(f"DROP TABLE {records}"))
+                except BaseException:
+                    temporary.unlink(missing_ok=True)
+                    raise
+                os.replace(temporary, target)
+
+        logger.info(f"✅ Partition {records} archived ({exported} record(s)) and dropped")
+        return str(target)
+
+    async def archive_default(self, cutoff: datetime) -> Optional[str]:
+        """
+        Выгружает и удаляет строки секции DEFAULT старше cutoff: помесячная архивация
+        видит только именованные секции.
+        """
+        records = f"{RECORDS_TABLE}_default"
+        payloads = f"{PAYLOADS_TABLE}_default"
+        older = f"created_at < '{cutoff.isoformat()}'"
+
+        async with engine.connect() as conn:
+            async with conn.begin():
+                if not await conn.scalar(text(f"SELECT to_regclass('{records}') IS NOT NULL")):
+                    return None
+                if not await conn.scalar(text(f"SELECT EXISTS (SELECT 1 FROM {records} WHERE {older})")):
+                    return None
+                locked = await conn.scalar(text("SELECT pg_try_advisory_xact_lock(hashtext('webhook_retention'))"))
+                if not locked:
+                    return None
+
+                self.archive_dir.mkdir(parents=True, exist_ok=True)
+                target = self.archive_dir / f"{records}_{datetime.utcnow():%Y_%m_%d_%H%M%S}.jsonl.gz"
+                temporary = target.with_name(target.name + ".part")
+                logger.info(f"🗄️ Archiving {records} rows before {cutoff:%Y-%m-%d} to {target}")
+                try:
+                    exported = await self._export(conn, records, payloads, temporary, where=f"r.{older}")
+                    # payloads и ключи удаляются каскадом
+                    await conn.execute(text(f"DELETE FROM {records} WHERE {older}"))
+                except BaseException:
+                    temporary.unlink(missing_ok=True)
+                    raise
+                os.replace(temporary, target)
+
+        logger.info(f"✅ {exported} record(s) archived from {records} and deleted")
+        return str(target)
+
+    async def _export(self, conn: AsyncConnection, records: str, payloads: str, path: Path, where: str = "") -> int:
+        """Пишет секцию (или ее строки, подходящие под where) в gzip JSONL порциями"""
+        exported = 0
+        output = await asyncio.to_thread(gzip.open, path, "wt", encoding="utf-8")
+        try:
+            # Явный курсор: его можно закрыть до удаления секции в этой же транзакции
+            await conn.execute(text(
+                f"DECLARE archive_cursor NO SCROLL CURSOR FOR "
+                f"SELECT r.*, p.raw_data, p.services_data, p.webkassa_response "
+                f"FROM {records} r LEFT JOIN {payloads} p "
+                f"ON p.record_id = r.id AND p.created_at = r.created_at "
+                f"{'WHERE ' + where + ' ' if where else ''}"
+                f"ORDER BY r.created_at, r.id"
+            ))
+            try:
+                while True:
+                    result = await conn.execute(text(f"FETCH {self.batch_size} FROM archive_cursor"))
+                    rows = result.all()
+                    if not rows:
+                        break
+                    chunk = "".join(
+                        json.dumps(dict(row._mapping), ensure_ascii=False, default=str) + "\n" for row in rows
+                    )
+                    await asyncio.to_thread(output.write, chunk)
+                    exported += len(rows)
+            finally:
+                await conn.execute(text("CLOSE archive_cursor"))
+        finally:
+            await asyncio.to_thread(output.close)
+        return exported
+
+
+# Единственный экземпляр на процесс
+retention_manager = RetentionManager()
@@ -0,0 +1,290 @@
+"""
+Плановое закрытие смен Webkassa.
+
+Webkassa отклоняет чеки смены старше 24 часов (Code 11 "закрыть смену"). Менеджер
+отслеживает возраст смены по каждой кассе и закрывает смену в фоне - по расписанию
+или при приближении к лимиту, когда касса простаивает. Новая смена открывается
+автоматически первым чеком, поэтому клиент не платит за закрытие смены своим чеком.
+Реактивное закрытие при Code 11 в send_to_webkassa_with_auto_refresh остается запасным путем.
+"""
+import asyncio
+import logging
+import os
+import time
+from contextlib import asynccontextmanager
+from datetime import datetime, timedelta
+from typing import Any, Dict, Optional
+
+from sqlalchemy import update
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.future import select
+
+from app.db import AsyncSessionLocal
+from app.models import ApiKey, CashboxShift
+from app.services.token_cache import token_cache
+
+logger = logging.getLogger(__name__)
+
+
+def parse_close_time(value: Optional[str]) -> Optional[tuple]:
+    """Разбирает SHIFT_CLOSE_TIME вида "HH:MM" (локальное время кассы)"""
+    if not value:
+        return None
+    try:
+        hours, minutes = value.split(":")
+        return int(hours), int(minutes)
+    except ValueError:
+        logger.warning(f"⚠️ Invalid SHIFT_CLOSE_TIME '{value}', scheduled close disabled")
+        return None
+
+
+class ShiftState:
+    """Состояние смены одной кассы в памяти воркера"""
+
+    def __init__(self, cashbox_id: str, service_name: str, shift_number: Optional[int] = None,
+                 opened_at: Optional[datetime] = None):
+        self.cashbox_id = cashbox_id
+        self.service_name = service_name
+        self.shift_number = shift_number
+        self.opened_at = opened_at
+        self.last_check_at = 0.0  # time.monotonic() последнего чека этого воркера
+        self.in_flight = 0
+        self.retry_after = 0.0  # time.monotonic(), раньше которого не повторяем неудачное закрытие
+
+
+class ShiftManager:
+    """Фоновый менеджер жизненного цикла смен по кассам"""
+
+    def __init__(self):
+        self.enabled = os.getenv("SHIFT_MANAGER_ENABLED", "True").lower() == "true"
+        self.check_interval = float(os.getenv("SHIFT_CHECK_INTERVAL", "60"))
+        self.max_age = timedelta(hours=float(os.getenv("SHIFT_MAX_AGE_HOURS", "23")))
+        # После этого возраста смена закрывается даже без простоя кассы
+        self.force_age = timedelta(hours=float(os.getenv("SHIFT_FORCE_AGE_HOURS", "23.75")))
+        self.idle_seconds = float(os.getenv("SHIFT_IDLE_SECONDS", "120"))
+        self.close_time = parse_close_time(os.getenv("SHIFT_CLOSE_TIME"))
+        self.utc_offset = timedelta(hours=float(os.getenv("SHIFT_UTC_OFFSET_HOURS", "5")))
+        self._shifts: Dict[str, ShiftState] = {}
+        self._task: Optional[asyncio.Task] = None
+        self._loaded = False
+
+    async def start(self):
+        """Загружает известные смены и запускает фоновый цикл"""
+        if not self.enabled:
+            logger.info("⏸️ Shift manager disabled (SHIFT_MANAGER_ENABLED=False)")
+            return
+        await self._load_shifts()
+        self._task = asyncio.create_task(self._run())
+        logger.info(f"🕐 Shift manager started for {len(self._shifts)} cashbox(es)")
+
+    async def _load_shifts(self) -> bool:
+        """
+        Загружает открытые смены из cashbox_shifts. Номер смены меняется только с новым
+        чеком, поэтому без загрузки после перезапуска возраст смены неизвестен и она не
+        закрывается до конца. При ошибке загрузка повторяется на следующем тике.
+        """
+        try:
+            async with AsyncSessionLocal() as db:
+                result = await db.execute(select(CashboxShift))
+                rows = result.scalars().all()
+        except Exception as e:
+            logger.warning(f"⚠️ Failed to load cashbox shifts, will retry: {e}")
+            return False
+        self.seed(rows)
+        self._loaded = True
+        return True
+
+    def seed(self, rows):
+        """Заполняет состояние касс строками cashbox_shifts"""
+        for row in rows:
+            state = self._state(row.cashbox_id, row.service_name)
+            # Смена, уже учтенная этим воркером по чеку, новее строки из БД
+            if state.shift_number is None:
+                state.shift_number = row.shift_number
+                state.opened_at = row.opened_at
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            self._task = None
+
+    def _state(self, cashbox_id: str, service_name: str) -> ShiftState:
+        state = self._shifts.get(cashbox_id)
+        if state is None:
+            state = ShiftState(cashbox_id, service_name)
+            self._shifts[cashbox_id] = state
+        state.service_name = service_name
+        return state
+
+    @asynccontextmanager
+    async def check_in_flight(self, cashbox_id: str, service_name: str):
+        """Помечает кассу занятой на время отправки чека, чтобы не закрыть смену посреди чека"""
+        state = self._state(cashbox_id, service_name)
+        state.in_flight += 1
+        try:
+            yield
+        finally:
+            state.in_flight -= 1
+            state.last_check_at = time.monotonic()
+
+    async def record_check(self, cashbox_id: str, service_name: str, response_data: Optional[Dict[str, Any]]):
+        """Учитывает успешный чек: новый номер смены означает, что смена только что открылась"""
+        data = (response_data or {}).get("Data") or {}
+        shift_number = data.get("ShiftNumber")
+        if shift_number is None:
+            return
+        state = self._state(cashbox_id, service_name)
+        if state.shift_number == shift_number:
+            return
+
+        state.shift_number = shift_number
+        state.opened_at = datetime.utcnow()
+        logger.info(f"🕐 Cashbox {cashbox_id}: shift {shift_number} opened")
+        try:
+            async with AsyncSessionLocal() as db:
+                # Смена с тем же номером могла быть открыта другим воркером раньше - сохраняем его время
+                statement = insert(CashboxShift).values(
+                    cashbox_id=cashbox_id,
+                    service_name=service_name,
+                    shift_number=shift_number,
+                    opened_at=state.opened_at,
+                    closed_at=None,
+                    updated_at=state.opened_at,
+                )
+                statement = statement.on_conflict_do_update(
+                    index_elements=[CashboxShift.cashbox_id],
+                    set_={
+                        "service_name": statement.excluded.service_name,
+                        "shift_number": statement.excluded.shift_number,
+                        "opened_at": statement.excluded.opened_at,
+                        "closed_at": None,
+                        "updated_at": statement.excluded.updated_at,
+                    },
+                    where=CashboxShift.shift_number.is_distinct_from(shift_number),
+                ).returning(CashboxShift.opened_at)
+                result = await db.execute(statement)
+                if result.first() is None:
+                    row = await db.get(CashboxShift, cashbox_id)
+                    if row and row.opened_at:
+                        state.opened_at = row.opened_at
+                await db.commit()
+        except Exception as e:
+            logger.warning(f"⚠️ Failed to persist shift state for cashbox {cashbox_id}: {e}")
+
+    async def record_closed(self, cashbox_id: str):
+        """Учитывает закрытие смены (плановое или реактивное по Code 11)"""
+        state = self._shifts.get(cashbox_id)
+        if state:
+            state.shift_number = None
+            state.opened_at = None
+        try:
+            async with AsyncSessionLocal() as db:
+                await db.execute(
+                    update(CashboxShift)
+                    .where(CashboxShift.cashbox_id == cashbox_id)
+                    .values(shift_number=None, opened_at=None, closed_at=datetime.utcnow())
+                )
+                await db.commit()
+        except Exception as e:
+            logger.warning(f"⚠️ Failed to persist shift close for cashbox {cashbox_id}: {e}")
+
+    def _last_scheduled_close(self, now: datetime) -> Optional[datetime]:
+        """Последний момент планового закрытия (UTC) не позже now"""
+        if not self.close_time:
+            return None
+        local_now = now + self.utc_offset
+        scheduled = local_now.replace(hour=self.close_time[0], minute=self.close_time[1], second=0, microsecond=0)
+        if scheduled > local_now:
+            scheduled -= timedelta(days=1)
+        return scheduled - self.utc_offset
+
+    def is_due(self, state: ShiftState, now: Optional[datetime] = None) -> bool:
+        """Нужно ли закрыть смену сейчас"""
+        if state.shift_number is None or state.opened_at is None or state.in_flight:
+            return False
+        if time.monotonic() < state.retry_after:
+            return False
+        now = now or datetime.utcnow()
+        age = now - state.opened_at
+        if age >= self.force_age:
+            return True
+        idle = time.monotonic() - state.last_check_at >= self.idle_seconds
+        if not idle:
+            return False
+        scheduled = self._last_scheduled_close(now)
+        return age >= self.max_age or (scheduled is not None and state.opened_at < scheduled)
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.sleep(self.check_interval)
+                if not self._loaded:
+                    await self._load_shifts()
+                for state in list(self._shifts.values()):
+                    if self.is_due(state):
+                        await self.close_shift(state)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"❌ Error in shift manager loop: {e}", exc_info=True)
+
+    async def _get_token(self, service_name: str) -> Optional[str]:
+        cached = token_cache.get(service_name)
+        if cached:
+            return cached.api_key
+        async with AsyncSessionLocal() as db:
+            result = await db.execute(select(ApiKey.api_key).filter(ApiKey.service_name == service_name))
+            return result.scalar()
+
+    async def close_shift(self, state: ShiftState) -> bool:
+        """Закрывает смену кассы, если ее не закрыл другой воркер"""
+        from app.routes.webhook import close_webkassa_shift
+
+        shift_number = state.shift_number
+        age_hours = (datetime.utcnow() - state.opened_at).total_seconds() / 3600
+        # Атомарно "забираем" смену: закрывать ее будет только один воркер
+        async with AsyncSessionLocal() as db:
+            result = await db.execute(
+                update(CashboxShift)
+                .where(
+                    CashboxShift.cashbox_id == state.cashbox_id,
+                    CashboxShift.shift_number == shift_number,
+                )
+                .values(shift_number=None, opened_at=None, closed_at=datetime.utcnow())
+                .returning(CashboxShift.cashbox_id)
+            )
+            claimed = result.first() is not None
+            await db.commit()
+        if not claimed:
+            logger.info(f"🕐 Cashbox {state.cashbox_id}: shift {shift_number} already closed elsewhere")
+            state.shift_number = None
+            state.opened_at = None
+            return False
+
+        logger.info(f"🕐 Cashbox {state.cashbox_id}: closing shift {shift_number} (age {age_hours:.1f}h)")
+        api_token = await self._get_token(state.service_name)
+        closed = {"success": False, "error": "No API key found"}
+        if api_token:
+            closed = await close_webkassa_shift(api_token, cashbox_id=state.cashbox_id)
+
+        if closed["success"]:
+            logger.info(f"✅ Cashbox {state.cashbox_id}: shift {shift_number} closed by schedule")
+            state.shift_number = None
+            state.opened_at = None
+            return True
+
+        logger.error(f"❌ Cashbox {state.cashbox_id}: scheduled shift close failed: {closed}")
+        state.retry_after = time.monotonic() + 5 * self.check_interval
+        # Возвращаем смену, чтобы повторить на следующем тике (или закрыть реактивно по Code 11)
+        async with AsyncSessionLocal() as db:
+            await db.execute(
+                update(CashboxShift)
+                .where(CashboxShift.cashbox_id == state.cashbox_id, CashboxShift.shift_number.is_(None))
+                .values(shift_number=shift_number, opened_at=state.opened_at)
+            )
+            await db.commit()
+        return False
+
+
+# Единственный экземпляр на процесс
+shift_manager = ShiftManager()
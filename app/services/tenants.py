@@ -0,0 +1,121 @@
+"""
+Реестр арендаторов: кэшированное сопоставление company_id Altegio -> учетная запись, касса и токен Webkassa
+"""
+import logging
+import os
+import time
+from typing import Dict, Optional, Tuple
+
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.future import select
+
+from app.models import ApiKey, WebkassaTenant
+from app.services.token_cache import token_cache, WEBKASSA_SERVICE_NAME
+
+logger = logging.getLogger(__name__)
+
+# Канал, в который триггер webkassa_tenants публикует изменения реестра
+TENANT_CHANNEL = "webkassa_tenant"
+
+
+class TenantConfig:
+    """Параметры Webkassa для одной компании Altegio"""
+
+    def __init__(self, company_id: Optional[int], login: Optional[str], password: Optional[str],
+                 cashbox_id: Optional[str], service_name: str = WEBKASSA_SERVICE_NAME):
+        self.company_id = company_id
+        self.login = login
+        self.password = password
+        self.cashbox_id = cashbox_id
+        self.service_name = service_name
+
+    @property
+    def is_default(self) -> bool:
+        """Обслуживается ли компания учетной записью из переменных окружения"""
+        return self.service_name == WEBKASSA_SERVICE_NAME
+
+    @property
+    def api_key(self) -> Optional[ApiKey]:
+        """Закэшированный токен арендатора (None, если кэшу нельзя доверять)"""
+        return token_cache.get(self.service_name)
+
+    def __repr__(self):
+        return f"<TenantConfig(company_id={self.company_id}, cashbox_id='{self.cashbox_id}', service='{self.service_name}')>"
+
+
+def default_tenant(company_id: Optional[int] = None) -> TenantConfig:
+    """Арендатор по умолчанию - учетная запись и касса из переменных окружения"""
+    return TenantConfig(
+        company_id=company_id,
+        login=os.getenv("WEBKASSA_LOGIN"),
+        password=os.getenv("WEBKASSA_PASSWORD"),
+        cashbox_id=os.getenv("WEBKASSA_CASHBOX_ID"),
+    )
+
+
+def tenant_from_record(record: WebkassaTenant) -> TenantConfig:
+    if record.webkassa_password and not os.getenv(record.password_env):
+        logger.warning(
+            f"⚠️ Пароль Webkassa компании {record.company_id} хранится в БД в открытом виде: "
+            f"задайте {record.password_env} и очистите webkassa_tenants.webkassa_password"
+        )
+    return TenantConfig(
+        company_id=record.company_id,
+        login=record.webkassa_login,
+        password=record.password,
+        cashbox_id=record.cashbox_id,
+        service_name=record.service_name,
+    )
+
+
+class TenantRegistry:
+    """
+    In-memory кэш реестра webkassa_tenants с TTL.
+    Записи сбрасываются сразу по NOTIFY от триггера, TTL страхует от потери уведомлений.
+    """
+
+    def __init__(self, ttl: Optional[float] = None):
+        self.ttl = ttl if ttl is not None else float(os.getenv("TENANT_CACHE_TTL", "300"))
+        self._entries: Dict[int, Tuple[TenantConfig, float]] = {}
+
+    async def get(self, db: AsyncSession, company_id: int) -> TenantConfig:
+        """Возвращает параметры Webkassa для компании (из кэша или из реестра)"""
+        entry = self._entries.get(company_id)
+        if entry and entry[1] > time.monotonic():
+            return entry[0]
+
+        result = await db.execute(
+            select(WebkassaTenant).filter(
+                WebkassaTenant.company_id == company_id,
+                WebkassaTenant.is_active == True
+            )
+        )
+        record = result.scalars().first()
+        if record:
+            tenant = tenant_from_record(record)
+            logger.info(f"🏢 Company {company_id} uses Webkassa cashbox {tenant.cashbox_id}")
+        else:
+            tenant = default_tenant(company_id)
+
+        self._entries[company_id] = (tenant, time.monotonic() + self.ttl)
+        return tenant
+
+    def invalidate(self, company_id: Optional[int] = None):
+        """Сбрасывает кэш одной компании или весь кэш"""
+        if company_id is None:
+            self._entries.clear()
+        else:
+            self._entries.pop(company_id, None)
+
+    def on_notification(self, payload: str):
+        """Обработчик NOTIFY: payload - company_id, пустой payload - сбросить все"""
+        if payload:
+            self.invalidate(int(payload))
+            logger.info(f"🏢 Tenant registry entry for company {payload} invalidated")
+        else:
+            self.invalidate()
+
+
+# Единственный экземпляр на процесс
+tenant_registry = TenantRegistry()
+token_cache.subscribe(TENANT_CHANNEL, tenant_registry.on_notification)
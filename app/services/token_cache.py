@@ -0,0 +1,262 @@
+"""
+In-memory кэш API ключей Webkassa, синхронизируемый между воркерами через Postgres LISTEN/NOTIFY
+"""
+import asyncio
+import json
+import logging
+import os
+from datetime import datetime
+from typing import Awaitable, Callable, Dict, Optional, Tuple
+
+import asyncpg
+
+from app.db import engine
+from app.models import ApiKey
+
+logger = logging.getLogger(__name__)
+
+# Канал, в который триггер api_keys публикует каждую ротацию токена
+TOKEN_CHANNEL = "webkassa_token"
+
+WEBKASSA_SERVICE_NAME = "Webkassa"
+
+# Задержки переподключения слушателя (секунды)
+RECONNECT_DELAYS = (1, 2, 5, 10, 30)
+
+
+def get_listener_dsn() -> str:
+    """DSN для прямого asyncpg подключения (без драйвера SQLAlchemy в схеме)"""
+    return engine.url.set(drivername="postgresql").render_as_string(hide_password=False)
+
+
+def api_key_from_notification(payload: str) -> ApiKey:
+    """Восстанавливает ApiKey из JSON, отправленного триггером через pg_notify"""
+    data = json.loads(payload)
+    created_at = data.get("created_at")
+    updated_at = data.get("updated_at")
+    return ApiKey(
+        id=data.get("id"),
+        service_name=data["service_name"],
+        api_key=data["api_key"],
+        user_id=data.get("user_id"),
+        created_at=datetime.fromisoformat(created_at) if created_at else None,
+        updated_at=datetime.fromisoformat(updated_at) if updated_at else None,
+    )
+
+
+class WebkassaTokenCache:
+    """
+    Кэш API ключей по service_name.
+
+    Каждый воркер держит одно выделенное соединение с LISTEN на канал TOKEN_CHANNEL,
+    поэтому ротация токена любым процессом (приложение, cron скрипт, ручной UPDATE)
+    сразу попадает в кэш всех воркеров. Пока слушатель не подключен, кэш не используется
+    и ключи читаются из базы как раньше.
+    """
+
+    def __init__(self, channel: str = TOKEN_CHANNEL):
+        self.channel = channel
+        self._keys: Dict[str, ApiKey] = {}
+        # service_name -> (устаревший токен, событие его ротации)
+        self._rotation_events: Dict[str, Tuple[Optional[str], asyncio.Event]] = {}
+        self.refresh_wait_timeout = float(os.getenv("TOKEN_REFRESH_WAIT_TIMEOUT", "5"))
+        self._refresh_locks: Dict[str, asyncio.Lock] = {}
+        self._connection: Optional[asyncpg.Connection] = None
+        self._reconnect_task: Optional[asyncio.Task] = None
+        self._closing = False
+        # Дополнительные каналы, которые слушаются через то же соединение
+        self._subscriptions: Dict[str, Callable[[str], None]] = {}
+
+    @property
+    def listening(self) -> bool:
+        """Подключен ли слушатель уведомлений (только тогда кэшу можно доверять)"""
+        return self._connection is not None and not self._connection.is_closed()
+
+    async def start(self):
+        """Подключает слушатель; при ошибке переподключается в фоне"""
+        self._closing = False
+        try:
+            await self._connect()
+        except Exception as e:
+            logger.warning(f"⚠️ Token listener unavailable, falling back to DB reads: {e}")
+            self._schedule_reconnect()
+
+    async def stop(self):
+        """Останавливает слушатель и переподключение"""
+        self._closing = True
+        if self._reconnect_task:
+            self._reconnect_task.cancel()
+            self._reconnect_task = None
+        if self._connection and not self._connection.is_closed():
+            await self._connection.close()
+        self._connection = None
+        self._keys.clear()
+
+    def subscribe(self, channel: str, callback: Callable[[str], None]):
+        """
+        Подписывает callback(payload) на дополнительный канал NOTIFY.
+        Вызывать до start(); при потере соединения колбэк получает пустой payload.
+        """
+        self._subscriptions[channel] = callback
+
+    async def _connect(self):
+        connection = await asyncpg.connect(get_listener_dsn())
+        connection.add_termination_listener(self._on_termination)
+        await connection.add_listener(self.channel, self._on_notify)
+        for channel, callback in self._subscriptions.items():
+            await connection.add_listener(channel, self._make_subscription_listener(callback))
+        # Ключи, закэшированные до подключения, могли пропустить уведомления
+        self._keys.clear()
+        self._connection = connection
+        logger.info(f"📡 Listening for Webkassa token rotations on channel '{self.channel}'")
+
+    def _on_notify(self, connection, pid, channel, payload):
+        try:
+            api_key = api_key_from_notification(payload)
+        except Exception as e:
+            logger.error(f"❌ Invalid token notification payload: {e}")
+            return
+        self.put(api_key)
+        logger.info(f"📡 Token for '{api_key.service_name}' rotated by backend pid {pid}, cache updated")
+
+    @staticmethod
+    def _make_subscription_listener(callback: Callable[[str], None]):
+        def listener(connection, pid, channel, payload):
+            try:
+                callback(payload)
+            except Exception as e:
+                logger.error(f"❌ Error handling notification on '{channel}': {e}")
+        return listener
+
+    def _on_termination(self, connection):
+        if connection is not self._connection:
+            return
+        self._connection = None
+        self._keys.clear()
+        for callback in self._subscriptions.values():
+            callback("")
+        if not self._closing:
+            logger.warning("⚠️ Token listener connection lost, reconnecting...")
+            self._schedule_reconnect()
+
+    def _schedule_reconnect(self):
+        if self._reconnect_task is None or self._reconnect_task.done():
+            self._reconnect_task = asyncio.create_task(self._reconnect_loop())
+
+    async def _reconnect_loop(self):
+        attempt = 0
+        while not self._closing and not self.listening:
+            await asyncio.sleep(RECONNECT_DELAYS[min(attempt, len(RECONNECT_DELAYS) - 1)])
+            attempt += 1
+            try:
+                await self._connect()
+            except Exception as e:
+                logger.warning(f"⚠️ Token listener reconnect attempt {attempt} failed: {e}")
+
+    def get(self, service_name: str = WEBKASSA_SERVICE_NAME) -> Optional[ApiKey]:
+        """Возвращает закэшированный ключ или None, если кэшу нельзя доверять"""
+        if not self.listening:
+            return None
+        return self._keys.get(service_name)
+
+    def put(self, api_key: ApiKey):
+        """
+        Сохраняет ключ, не затирая более свежую версию. Ожидающих ротацию будит только
+        ключ, отличный от устаревшего, - простое чтение из БД старого токена их не будит.
+        """
+        current = self._keys.get(api_key.service_name)
+        if (current is not None and current.updated_at and api_key.updated_at
+                and api_key.updated_at < current.updated_at):
+            return
+        self._keys[api_key.service_name] = api_key
+        waiting = self._rotation_events.get(api_key.service_name)
+        if waiting and api_key.api_key != waiting[0]:
+            del self._rotation_events[api_key.service_name]
+            waiting[1].set()
+
+    async def _open_lock_connection(self) -> asyncpg.Connection:
+        """Отдельное соединение для advisory lock (session lock живет до его закрытия)"""
+        return await asyncpg.connect(get_listener_dsn())
+
+    async def refresh_once(
+        self,
+        stale_token: Optional[str],
+        refresher: Callable[[], Awaitable[Optional[ApiKey]]],
+        service_name: str = WEBKASSA_SERVICE_NAME,
+        wait_timeout: Optional[float] = None,
+    ) -> Optional[ApiKey]:
+        """
+        Выполняет refresher не более одного раза на все воркеры.
+
+        Внутри процесса обновления сериализуются asyncio.Lock, между процессами -
+        advisory lock в Postgres. Проигравшие ждут NOTIFY с новым токеном не дольше
+        wait_timeout (TOKEN_REFRESH_WAIT_TIMEOUT) секунд - ожидание идет на пути
+        запроса клиента, - а затем сами пробуют взять блокировку и обновить токен.
+        Устаревший токен не возвращается: если обновить не удалось, результат - None.
+        """
+        if wait_timeout is None:
+            wait_timeout = self.refresh_wait_timeout
+        lock = self._refresh_locks.setdefault(service_name, asyncio.Lock())
+        async with lock:
+            cached = self.get(service_name)
+            if cached and cached.api_key != stale_token:
+                logger.info(f"♻️ Token for '{service_name}' already rotated, skipping refresh")
+                return cached
+
+            if not self.listening:
+                # Без слушателя дождаться чужой ротации нельзя - обновляем сами
+                return await refresher()
+
+            lock_key = f"token_refresh:{service_name}"
+            # Событие создаем до попытки захвата, чтобы не пропустить быстрый NOTIFY
+            event = asyncio.Event()
+            self._rotation_events[service_name] = (stale_token, event)
+            connection = await self._open_lock_connection()
+            try:
+                acquired = await connection.fetchval("SELECT pg_try_advisory_lock(hashtext($1))", lock_key)
+                if not acquired:
+                    logger.info(f"⏳ Another worker is refreshing '{service_name}' token, waiting for notification...")
+                    try:
+                        await asyncio.wait_for(event.wait(), timeout=wait_timeout)
+                        return self.get(service_name)
+                    except asyncio.TimeoutError:
+                        logger.warning(
+                            f"⚠️ No token rotation for '{service_name}' within {wait_timeout}s, trying to refresh here"
+                        )
+                    acquired = await connection.fetchval("SELECT pg_try_advisory_lock(hashtext($1))", lock_key)
+                    if not acquired:
+                        # Токен мог смениться без NOTIFY - иначе обновление все еще идет в другом воркере
+                        rotated = await self._rotated_in_db(connection, service_name, stale_token)
+                        if rotated is None:
+                            logger.error(f"❌ Token refresh for '{service_name}' is still held by another worker")
+                        return rotated
+
+                try:
+                    rotated = await self._rotated_in_db(connection, service_name, stale_token)
+                    if rotated is not None:
+                        logger.info(f"♻️ Token for '{service_name}' was rotated by another worker, reusing it")
+                        return rotated
+                    return await refresher()
+                finally:
+                    await connection.execute("SELECT pg_advisory_unlock(hashtext($1))", lock_key)
+            finally:
+                self._rotation_events.pop(service_name, None)
+                await connection.close()
+
+    async def _rotated_in_db(self, connection: asyncpg.Connection, service_name: str,
+                             stale_token: Optional[str]) -> Optional[ApiKey]:
+        """Ключ из БД, если он уже отличается от устаревшего"""
+        row = await connection.fetchrow(
+            "SELECT id, service_name, api_key, user_id, created_at, updated_at "
+            "FROM api_keys WHERE service_name = $1",
+            service_name,
+        )
+        if row and row["api_key"] != stale_token:
+            api_key = ApiKey(**dict(row))
+            self.put(api_key)
+            return api_key
+        return None
+
+
+# Единственный экземпляр на процесс
+token_cache = WebkassaTokenCache()
@@ -0,0 +1,186 @@
+"""
+Трассировка обработки webhook без внешнего коллектора.
+
+Каждый webhook открывает корневой span, вложенные этапы (запросы к Altegio и Webkassa,
+обновление токена, операции с БД) - дочерние. trace_id служит correlation ID: он
+попадает в каждую запись лога (поле correlation_id) и в журнал fiscalization_logs.
+Завершенные трассы пишутся фоновым потоком в файл TRACE_EXPORT_FILE строками
+OTLP/JSON (формат ExportTraceServiceRequest), которые понимает OpenTelemetry Collector
+и большинство просмотрщиков трасс.
+"""
+import json
+import logging
+import os
+import queue
+import re
+import secrets
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+from app.logging_config import log_context
+
+logger = logging.getLogger(__name__)
+
+SERVICE_NAME = "altegio-webkassa-integration"
+TRACEPARENT_RE = re.compile(r"^[0-9a-f]{2}-([0-9a-f]{32})-([0-9a-f]{16})-[0-9a-f]{2}$")
+
+# Коды статуса OTLP
+STATUS_OK = 1
+STATUS_ERROR = 2
+
+
+class Span:
+    """Один интервал трассы; дочерние span'ы копятся в общем списке корневого"""
+
+    def __init__(self, name: str, trace_id: str, parent: Optional["Span"] = None,
+                 parent_span_id: Optional[str] = None, attributes: Optional[Dict[str, Any]] = None):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = secrets.token_hex(8)
+        self.parent_span_id = parent.span_id if parent else parent_span_id
+        self.attributes: Dict[str, Any] = dict(attributes or {})
+        self.start_ns = time.time_ns()
+        self.end_ns: Optional[int] = None
+        self.status_code = STATUS_OK
+        self.status_message = ""
+        # Корневой span владеет списком всех span'ов трассы
+        self.trace_spans: List["Span"] = parent.trace_spans if parent else []
+        self.trace_spans.append(self)
+
+    def set_attribute(self, key: str, value: Any):
+        self.attributes[key] = value
+
+    def set_error(self, message: str):
+        self.status_code = STATUS_ERROR
+        self.status_message = message
+
+    def to_otlp(self) -> Dict[str, Any]:
+        span = {
+            "traceId": self.trace_id,
+            "spanId": self.span_id,
+            "name": self.name,
+            "kind": 1,  # SPAN_KIND_INTERNAL
+            "startTimeUnixNano": str(self.start_ns),
+            "endTimeUnixNano": str(self.end_ns or time.time_ns()),
+            "attributes": [_otlp_attribute(key, value) for key, value in self.attributes.items()],
+            "status": {"code": self.status_code, "message": self.status_message},
+        }
+        if self.parent_span_id:
+            span["parentSpanId"] = self.parent_span_id
+        return span
+
+
+def _otlp_attribute(key: str, value: Any) -> Dict[str, Any]:
+    if isinstance(value, bool):
+        typed = {"boolValue": value}
+    elif isinstance(value, int):
+        typed = {"intValue": str(value)}
+    elif isinstance(value, float):
+        typed = {"doubleValue": value}
+    else:
+        typed = {"stringValue": str(value)}
+    return {"key": key, "value": typed}
+
+
+class FileSpanExporter:
+    """Пишет завершенные трассы в файл строками OTLP/JSON в фоновом потоке"""
+
+    def __init__(self):
+        self.enabled = os.getenv("TRACING_ENABLED", "True").lower() == "true"
+        self.path = Path(os.getenv("TRACE_EXPORT_FILE", "logs/traces.jsonl"))
+        self._queue: "queue.SimpleQueue[Optional[List[Span]]]" = queue.SimpleQueue()
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+
+    def export(self, spans: List[Span]):
+        if not self.enabled:
+            return
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run, name="trace-exporter", daemon=True)
+                    self._thread.start()
+        self._queue.put(list(spans))
+
+    def shutdown(self):
+        """Дописывает очередь (при завершении приложения)"""
+        if self._thread:
+            self._queue.put(None)
+            self._thread.join(timeout=5)
+            self._thread = None
+
+    def _run(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with open(self.path, "a", encoding="utf-8") as output:
+            while True:
+                spans = self._queue.get()
+                if spans is None:
+                    break
+                try:
+                    output.write(json.dumps(_otlp_request(spans), ensure_ascii=False) + "\n")
+                    # Дописываем пачкой: пока очередь не пуста, не сбрасываем буфер
+                    if self._queue.empty():
+                        output.flush()
+                except Exception as e:
+                    logger.warning(f"⚠️ Failed to export trace: {e}")
+
+
+def _otlp_request(spans: List[Span]) -> Dict[str, Any]:
+    return {
+        "resourceSpans": [{
+            "resource": {"attributes": [_otlp_attribute("service.name", SERVICE_NAME)]},
+            "scopeSpans": [{
+                "scope": {"name": "app.services.tracing"},
+                "spans": [span.to_otlp() for span in spans],
+            }],
+        }]
+    }
+
+
+exporter = FileSpanExporter()
+
+_current_span: ContextVar[Optional[Span]] = ContextVar("current_span", default=None)
+
+
+def current_trace_id() -> Optional[str]:
+    """correlation ID текущей обработки (или None вне трассы)"""
+    span = _current_span.get()
+    return span.trace_id if span else None
+
+
+@contextmanager
+def start_span(name: str, traceparent: Optional[str] = None, **attributes):
+    """
+    Открывает span: дочерний, если уже есть текущий, иначе корневой (новая трасса
+    или продолжение внешней по заголовку W3C traceparent). Исключение внутри блока
+    отмечает span ошибкой. Корневой span при завершении экспортирует всю трассу.
+    """
+    parent = _current_span.get()
+    if parent:
+        span = Span(name, parent.trace_id, parent=parent, attributes=attributes)
+    else:
+        match = TRACEPARENT_RE.match(traceparent or "")
+        if match:
+            span = Span(name, match.group(1), parent_span_id=match.group(2), attributes=attributes)
+        else:
+            span = Span(name, secrets.token_hex(16), attributes=attributes)
+
+    token = _current_span.set(span)
+    try:
+        if parent:
+            yield span
+        else:
+            with log_context(correlation_id=span.trace_id):
+                yield span
+    except BaseException as e:
+        span.set_error(f"{type(e).__name__}: {e}")
+        raise
+    finally:
+        span.end_ns = time.time_ns()
+        _current_span.reset(token)
+        if not parent:
+            exporter.export(span.trace_spans)
@@ -1,30 +1,25 @@
 #!/usr/bin/env python3
-"""Простой скрипт для просмотра логов"""
+"""Простой скрипт для просмотра логов (чтение с конца файла через app.logtools)"""
 
 import sys
 
+from app.logtools import LogFilter, format_entry, tail
+
+
 def view_clean_logs(filename="logs/errors.log", lines=20, search=""):
     """Просмотр логов с фильтрацией"""
     try:
-        with open(filename, 'r', encoding='utf-8') as f:
-            all_lines = f.readlines()
+        entries = tail(filename, lines, LogFilter(text=search or None))
         
-        # Фильтруем по поиску если нужно
         if search:
-            filtered_lines = [line for line in all_lines if search.lower() in line.lower()]
-            lines_to_show = filtered_lines[-lines:] if len(filtered_lines) > lines else filtered_lines
-            print(f"🔍 Найдено {len(filtered_lines)} строк с '{search}', показываем последние {len(lines_to_show)}:")
+            print(f"🔍 Последние {len(entries)} строк с '{search}' из {filename}:")
         else:
-            lines_to_show = all_lines[-lines:] if len(all_lines) > lines else all_lines
-            print(f"📋 Последние {len(lines_to_show)} строк из {filename}:")
+            print(f"📋 Последние {len(entries)} строк из {filename}:")
         
         print("=" * 80)
         
-        for i, line in enumerate(lines_to_show, 1):
-            # Убираем лишние символы и показываем чисто
-            clean_line = line.strip()
-            if clean_line:
-                print(f"{i:3d}: {clean_line}")
+        for i, entry in enumerate(entries, 1):
+            print(f"{i:3d}: {format_entry(entry)}")
                 
     except FileNotFoundError:
         print(f"❌ Файл {filename} не найден")
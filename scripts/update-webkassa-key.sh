@@ -23,7 +23,7 @@ fi
 
 # Запускаем скрипт обновления внутри контейнера
 log "Executing update script in backend container"
-docker-compose -f "$SCRIPT_DIR/docker-compose.yml" exec -T backend python /app/scripts/update_webkassa_key.py
+docker-compose -f "$SCRIPT_DIR/docker-compose.yml" exec -T backend python /app/scripts/update_webkassa_key.py --all-tenants
 
 if [ $? -eq 0 ]; then
     log "✅ Webkassa API key update completed successfully"
@@ -4,13 +4,14 @@
 Этот скрипт должен запускаться через cron или systemd timer.
 """
 
+import argparse
 import asyncio
 import os
 import sys
 import logging
 import json
 from datetime import datetime
-from typing import Optional
+from typing import List, Optional
 
 # Добавляем путь к app модулю
 sys.path.append('/app')
@@ -18,15 +19,16 @@ sys.path.append('/app')
 from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy import select
-from app.models import ApiKey
+from app.models import ApiKey, WebkassaTenant
+from app.logging_config import rotating_file_handler
 import httpx
 
-# Настройка логирования
+# Настройка логирования: файл ротируется по размеру и по суткам, как лог приложения
 logging.basicConfig(
     level=logging.INFO,
     format='%(asctime)s - %(levelname)s - %(message)s',
     handlers=[
-        logging.FileHandler('/app/logs/webkassa_key_update.log'),
+        rotating_file_handler('/app/logs/webkassa_key_update.log', max_bytes=10 * 1024 * 1024),
         logging.StreamHandler()
     ]
 )
@@ -36,7 +38,7 @@ logger = logging.getLogger(__name__)
 class WebkassaKeyUpdater:
     """Класс для обновления API ключа Webkassa"""
     
-    def __init__(self):
+    def __init__(self, service_name: str = "Webkassa", login: str = None, password: str = None):
         # Строим URL базы данных из переменных окружения
         db_user = os.getenv("POSTGRES_USER", "postgres")
         db_password = os.getenv("POSTGRES_PASSWORD", "postgres")
@@ -46,8 +48,10 @@ class WebkassaKeyUpdater:
         
         self.db_url = f"postgresql+asyncpg://{db_user}:{db_password}@{db_host}:{db_port}/{db_name}"
         
-        self.webkassa_login = os.getenv("WEBKASSA_LOGIN")
-        self.webkassa_password = os.getenv("WEBKASSA_PASSWORD")
+        # Запись токена в api_keys: "Webkassa" для основной учетной записи, "Webkassa:<company_id>" для арендаторов
+        self.service_name = service_name
+        self.webkassa_login = login or os.getenv("WEBKASSA_LOGIN")
+        self.webkassa_password = password or os.getenv("WEBKASSA_PASSWORD")
         self.webkassa_auth_url = os.getenv("WEBKASSA_AUTH_URL", "https://api.webkassa.kz/api/Authorize")
         
         # Создаем асинхронный движок базы данных
@@ -104,7 +108,7 @@ class WebkassaKeyUpdater:
             async with self.SessionLocal() as db:
                 # Ищем существующую запись
                 result = await db.execute(
-                    select(ApiKey).filter(ApiKey.service_name == "Webkassa")
+                    select(ApiKey).filter(ApiKey.service_name == self.service_name)
                 )
                 api_key_record = result.scalars().first()
                 
@@ -133,7 +137,7 @@ class WebkassaKeyUpdater:
                         logger.info(f"👤 User ID: {user_id}")
                     
                     api_key_record = ApiKey(
-                        service_name="Webkassa",
+                        service_name=self.service_name,
                         api_key=new_token,
                         user_id=user_id
                     )
@@ -204,7 +208,7 @@ class WebkassaKeyUpdater:
         """
         Основной метод для выполнения обновления API ключа
         """
-        logger.info("Starting Webkassa API key update process")
+        logger.info(f"Starting Webkassa API key update process ({self.service_name})")
         
         try:
             # Получаем новый токен
@@ -277,10 +281,51 @@ class WebkassaKeyUpdater:
             await self.engine.dispose()
 
 
+async def load_tenant_updaters(company_id: Optional[int] = None) -> List[WebkassaKeyUpdater]:
+    """
+    Создает обновляющие объекты для арендаторов из реестра webkassa_tenants
+    """
+    registry_updater = WebkassaKeyUpdater()
+    try:
+        async with registry_updater.SessionLocal() as db:
+            query = select(WebkassaTenant).filter(WebkassaTenant.is_active == True)
+            if company_id is not None:
+                query = query.filter(WebkassaTenant.company_id == company_id)
+            result = await db.execute(query)
+            tenants = result.scalars().all()
+    finally:
+        await registry_updater.engine.dispose()
+    
+    return [
+        WebkassaKeyUpdater(
+            service_name=tenant.service_name,
+            login=tenant.webkassa_login,
+            password=tenant.password
+        )
+        for tenant in tenants
+    ]
+
+
 async def main():
     """Точка входа для скрипта"""
-    updater = WebkassaKeyUpdater()
-    success = await updater.run_update()
+    parser = argparse.ArgumentParser(description="Обновление API ключа Webkassa")
+    parser.add_argument("--company-id", type=int, help="Обновить токен арендатора из реестра webkassa_tenants")
+    parser.add_argument("--all-tenants", action="store_true", help="Обновить основной токен и токены всех арендаторов")
+    args = parser.parse_args()
+    
+    if args.company_id is not None:
+        updaters = await load_tenant_updaters(args.company_id)
+        if not updaters:
+            logger.error(f"💥 Company {args.company_id} not found in webkassa_tenants registry")
+            sys.exit(1)
+    elif args.all_tenants:
+        updaters = [WebkassaKeyUpdater()] + await load_tenant_updaters()
+    else:
+        updaters = [WebkassaKeyUpdater()]
+    
+    success = True
+    for updater in updaters:
+        success = await updater.run_update() and success
     
     if success:
         logger.info("🎉 Webkassa API key update process completed successfully")
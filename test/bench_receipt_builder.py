@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+"""
+Бенчмарк сборки чека Webkassa (app/services/receipt_builder.py)
+
+Запуск: python test/bench_receipt_builder.py [количество итераций]
+"""
+
+import copy
+import os
+import sys
+import timeit
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.schemas.altegio import AltegioWebhookPayload
+from app.services.receipt_builder import build_receipt
+
+EXAMPLE = AltegioWebhookPayload.model_config["json_schema_extra"]["example"]
+
+
+def make_record_case(services_count=5, goods_count=3, transactions_count=4):
+    data = copy.deepcopy(EXAMPLE)
+    base_service = data["data"]["services"][0]
+    data["data"]["services"] = [dict(base_service, title=f"Услуга {i}", cost_to_pay=3600) for i in range(services_count)]
+    data["data"]["goods_transactions"] = [
+        {"title": f"Товар {i}", "amount": -1, "cost_per_unit": 1500, "discount": 10} for i in range(goods_count)
+    ]
+    # Платежи делят сумму чека поровну, чтобы чек сходился
+    receipt_total = 3600 * services_count + 1350 * goods_count
+    document = {"data": [
+        {"amount": receipt_total / transactions_count, "comment": "", "account": {"is_cash": i % 2 == 0, "title": "Касса"}}
+        for i in range(transactions_count)
+    ]}
+    return AltegioWebhookPayload(**data), document
+
+
+def make_sale_case(items_count=5):
+    data = copy.deepcopy(EXAMPLE)
+    data["resource"] = "goods_operations_sale"
+    data["data"]["services"] = []
+    document = {"data": {"state": {
+        "items": [
+            {"title": f"Товар {i}", "amount": -1, "default_cost_per_unit": 5000, "cost_to_pay_total": 4500}
+            for i in range(items_count)
+        ],
+        "payment_transactions": [{"amount": 4500 * items_count, "comment": "", "account": {"is_cash": False}}],
+    }}}
+    return AltegioWebhookPayload(**data), document
+
+
+def run(number: int = 20000):
+    cases = {
+        "record (5 услуг, 3 товара, 4 платежа)": make_record_case(),
+        "goods_operations_sale (5 товаров)": make_sale_case(),
+    }
+    print(f"📊 build_receipt, {number} итераций на случай")
+    for name, (payload, document) in cases.items():
+        seconds = timeit.timeit(lambda: build_receipt(payload, document, "CB"), number=number)
+        print(f"   {name}: {seconds / number * 1e6:.1f} мкс/чек")
+
+
+if __name__ == "__main__":
+    run(int(sys.argv[1]) if len(sys.argv) > 1 else 20000)
@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+"""
+Тесты выключателя внешних API (app/services/circuit_breaker.py)
+"""
+
+import os
+import sys
+import time
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.services.circuit_breaker import CLOSED, HALF_OPEN, OPEN, CircuitBreaker
+
+
+def make_breaker():
+    breaker = CircuitBreaker("test")
+    breaker.failure_threshold = 3
+    breaker.reset_timeout = 0.05
+    return breaker
+
+
+def test_opens_after_consecutive_failures():
+    breaker = make_breaker()
+    breaker.record_failure("HTTP 502")
+    breaker.record_failure("HTTP 502")
+    breaker.record_success()  # успех сбрасывает счетчик
+    for _ in range(2):
+        breaker.record_failure("network: ConnectTimeout")
+    assert breaker.state == CLOSED and breaker.allow()
+
+    breaker.record_failure("network: ConnectTimeout")
+    assert breaker.state == OPEN
+    assert not breaker.allow()
+    assert breaker.snapshot()["last_failure"] == "network: ConnectTimeout"
+
+
+def test_half_open_allows_single_trial():
+    breaker = make_breaker()
+    for _ in range(3):
+        breaker.record_failure("HTTP 503")
+    time.sleep(0.06)
+
+    assert breaker.allow()
+    assert breaker.state == HALF_OPEN
+    assert not breaker.allow()  # второй запрос ждет результата пробного
+
+    breaker.record_failure("HTTP 503")
+    assert breaker.state == OPEN and not breaker.allow()
+
+    time.sleep(0.06)
+    assert breaker.allow()
+    breaker.record_success()
+    assert breaker.state == CLOSED and breaker.allow()
+
+
+if __name__ == "__main__":
+    test_opens_after_consecutive_failures()
+    test_half_open_allows_single_trial()
+    print("✅ Все тесты выключателя пройдены")
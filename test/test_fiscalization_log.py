@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+"""
+Тесты буферизованного журнала фискализации (app/services/fiscalization_log.py)
+"""
+
+import asyncio
+import os
+import sys
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.services.fiscalization_log import FiscalizationLogWriter
+
+
+def make_writer():
+    writer = FiscalizationLogWriter()
+    writer.enabled = True
+    writer.flush_interval = 0.02
+    writer.writes = []
+
+    # Запись в БД заменяем сбором пачек: проверяется только логика очереди
+    async def write(rows):
+        if rows:
+            writer.writes.append(list(rows))
+
+    writer._write = write
+    return writer
+
+
+def test_stop_after_flush_writes_batch_once():
+    async def scenario():
+        writer = make_writer()
+        await writer.start()
+        writer.record(1, {"request": 1}, {"response": 1}, "success")
+        await asyncio.sleep(0.1)  # пачка записана, писатель ждет новых строк
+        await writer.stop()
+        await asyncio.sleep(0.05)  # отмененная задача не должна дописать пачку повторно
+        assert len(writer.writes) == 1
+        assert writer.writes[0][0]["webhook_record_id"] == 1
+
+    asyncio.run(scenario())
+
+
+def test_stop_before_first_record():
+    async def scenario():
+        writer = make_writer()
+        await writer.start()
+        await asyncio.sleep(0)
+        await writer.stop()
+        assert writer.writes == []
+
+    asyncio.run(scenario())
+
+
+def test_stop_flushes_pending_rows():
+    async def scenario():
+        writer = make_writer()
+        writer.flush_interval = 10
+        await writer.start()
+        for record_id in range(3):
+            writer.record(record_id, {}, None, "pending")
+        await asyncio.sleep(0.05)  # строки взяты из очереди, но интервал еще не прошел
+        await writer.stop()
+        assert sorted(row["webhook_record_id"] for batch in writer.writes for row in batch) == [0, 1, 2]
+
+    asyncio.run(scenario())
+
+
+if __name__ == "__main__":
+    test_stop_after_flush_writes_batch_once()
+    test_stop_before_first_record()
+    test_stop_flushes_pending_rows()
+    print("✅ Все тесты журнала фискализации пройдены")
@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+"""
+Тесты ленивого логирования крупных данных и ротации файла лога (app/logging_config.py)
+"""
+
+import gzip
+import logging
+import os
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import logging_config
+from app.logging_config import CompressingRotatingFileHandler, JsonFormatter, LazyJson, log_payload
+from app.logtools import rotated_time_range, search
+
+
+class CountingData:
+    """Значение, которое считает, сколько раз его сериализовали (json.dumps(default=str))"""
+    dumps = 0
+
+    def __str__(self):
+        CountingData.dumps += 1
+        return "data"
+
+
+class ListHandler(logging.Handler):
+    def __init__(self):
+        super().__init__()
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append(record.getMessage())
+
+
+def make_logger(level):
+    logger = logging.getLogger(f"test.payload.{level}")
+    logger.propagate = False
+    logger.setLevel(level)
+    handler = ListHandler()
+    logger.handlers = [handler]
+    return logger, handler
+
+
+def test_lazy_json_is_capped_and_cached():
+    preview = LazyJson({"text": "я" * 100}, limit=20)
+    text = str(preview)
+    assert text.startswith('{"text": "яяя')
+    assert text.endswith("[112 chars]")
+    assert str(preview) is text
+
+
+def test_payload_not_serialized_when_level_disabled():
+    logger, handler = make_logger(logging.WARNING)
+    CountingData.dumps = 0
+    log_payload(logger, "payload", CountingData())
+    assert handler.messages == []
+    assert CountingData.dumps == 0
+
+    log_payload(logger, "payload", CountingData(), level=logging.ERROR)
+    assert handler.messages == ['payload: "data"']
+    assert CountingData.dumps == 1
+
+
+def test_payload_sampling_and_errors():
+    logger, handler = make_logger(logging.INFO)
+    original_rate = logging_config.PAYLOAD_SAMPLE_RATE
+    try:
+        logging_config.PAYLOAD_SAMPLE_RATE = 0.0
+        log_payload(logger, "sampled out", {"a": 1})
+        log_payload(logger, "error", {"a": 1}, level=logging.ERROR)
+    finally:
+        logging_config.PAYLOAD_SAMPLE_RATE = original_rate
+    assert handler.messages == ['error: {"a": 1}']
+
+
+def test_debug_level_logs_full_payload():
+    logger, handler = make_logger(logging.DEBUG)
+    log_payload(logger, "full", {"text": "x" * 5000})
+    assert len(handler.messages) == 1
+    assert "chars]" not in handler.messages[0]
+
+
+def test_rotation_by_size_and_day_with_retention(tmp_path):
+    log_file = tmp_path / "errors.log"
+    original_settle = logging_config.COMPRESS_SETTLE_SECONDS
+    logging_config.COMPRESS_SETTLE_SECONDS = 0
+    handler = CompressingRotatingFileHandler(str(log_file), max_bytes=4000, backup_count=3)
+    handler.setFormatter(JsonFormatter())
+    logger = logging.getLogger("test_rotation")
+    logger.propagate = False
+    logger.addHandler(handler)
+    try:
+        handler.rollover_at = time.time() - 1  # смена суток
+        logger.warning("after midnight")
+        for index in range(200):
+            logger.warning("record %03d %s", index, "x" * 50)
+    finally:
+        logger.removeHandler(handler)
+        handler.close()
+        logging_config.COMPRESS_SETTLE_SECONDS = original_settle
+
+    rotated = sorted(path for path in tmp_path.iterdir() if path != log_file)
+    assert len(rotated) == 3
+    assert all(path.suffix == ".gz" and rotated_time_range(path) for path in rotated)
+    assert all(gzip.open(path).read() for path in rotated)
+    assert log_file.stat().st_size < 4000
+    # Старые копии удалены, оставшиеся читаются по порядку вместе с текущим файлом
+    messages = [entry.message for entry in search(str(log_file))]
+    assert messages[-1] == "record 199 " + "x" * 50
+    assert messages == sorted(messages)
+
+
+def test_writers_follow_rotation_by_another_process(tmp_path):
+    log_file = tmp_path / "errors.log"
+    # Два обработчика одного файла - как два процесса
+    first = CompressingRotatingFileHandler(str(log_file), compress=False)
+    second = CompressingRotatingFileHandler(str(log_file), compress=False)
+    for handler in (first, second):
+        handler.setFormatter(logging.Formatter("%(message)s"))
+    record = lambda message: logging.LogRecord("test", logging.WARNING, __file__, 0, message, None, None)
+    try:
+        first.emit(record("before midnight"))
+        second.emit(record("second before midnight"))
+        # Сутки сменились в обоих процессах: ротирует файл первый, второй только переоткрывает
+        first.rollover_at = second.rollover_at = time.time() - 1
+        first.emit(record("after midnight"))
+        second.emit(record("second after midnight"))
+        first.emit(record("first after midnight"))
+    finally:
+        first.close()
+        second.close()
+
+    rotated = [path for path in tmp_path.iterdir() if path != log_file]
+    assert len(rotated) == 1
+    assert rotated[0].read_text().splitlines() == ["before midnight", "second before midnight"]
+    assert log_file.read_text().splitlines() == ["after midnight", "second after midnight", "first after midnight"]
+
+
+if __name__ == "__main__":
+    test_lazy_json_is_capped_and_cached()
+    test_payload_not_serialized_when_level_disabled()
+    test_payload_sampling_and_errors()
+    test_debug_level_logs_full_payload()
+    test_rotation_by_size_and_day_with_retention(Path(tempfile.mkdtemp()))
+    test_writers_follow_rotation_by_another_process(Path(tempfile.mkdtemp()))
+    print("✅ Все тесты логирования пройдены")
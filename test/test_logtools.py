@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+"""
+Тесты просмотра логов (app/logtools.py)
+"""
+
+import gzip
+import json
+import mmap
+import os
+import sys
+from datetime import datetime, timedelta
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.logtools import LogFilter, _offset_for_time, parse_line, search, tail
+
+START = datetime(2025, 3, 14, 9, 0, 0)
+
+
+def json_line(index, level="INFO", resource_id=None):
+    entry = {
+        "time": (START + timedelta(seconds=index)).isoformat(timespec="milliseconds"),
+        "level": level,
+        "logger": "app.routes.webhook",
+        "message": f"event {index}",
+    }
+    if resource_id is not None:
+        entry["resource_id"] = resource_id
+    return json.dumps(entry, ensure_ascii=False) + "\n"
+
+
+def write_logs(tmp_path):
+    """Сжатая ротированная копия с событиями 0-99 и текущий лог с событиями 100-199"""
+    rotated = tmp_path / "errors.log.1.gz"
+    with gzip.open(rotated, "wt", encoding="utf-8") as output:
+        output.writelines(json_line(i, resource_id=i % 10) for i in range(100))
+    os.utime(rotated, (START.timestamp() + 100,) * 2)
+    current = tmp_path / "errors.log"
+    current.write_text("".join(
+        json_line(i, level="ERROR" if i % 25 == 0 else "INFO", resource_id=i % 10) for i in range(100, 200)
+    ), encoding="utf-8")
+    return str(current)
+
+
+def messages(entries):
+    return [entry.message for entry in entries]
+
+
+def test_parse_json_and_text_lines():
+    entry = parse_line(json_line(5, resource_id=42).encode())
+    assert (entry.level, entry.message, entry.context) == ("INFO", "event 5", {"resource_id": 42})
+    assert entry.time == START + timedelta(seconds=5)
+
+    entry = parse_line("2025-03-14 09:00:07,123 - app.routes.webhook - WARNING - 🔑 key is old\n".encode())
+    assert (entry.level, entry.logger, entry.message) == ("WARNING", "app.routes.webhook", "🔑 key is old")
+    assert parse_line(b"  File \"app/main.py\", line 1").time is None
+
+
+def test_tail_reads_current_then_rotated(tmp_path):
+    path = write_logs(tmp_path)
+    assert messages(tail(path, 3)) == ["event 197", "event 198", "event 199"]
+    assert messages(tail(path, 2, LogFilter(level="ERROR"))) == ["event 150", "event 175"]
+    # Не хватило текущего файла - дочитывается сжатая копия
+    found = tail(path, 12, LogFilter(resource_id="3"))
+    assert messages(found) == [f"event {i}" for i in range(83, 200, 10)]
+
+
+def test_time_window_and_stream_search(tmp_path):
+    path = write_logs(tmp_path)
+    window = LogFilter(since=START + timedelta(seconds=150), until=START + timedelta(seconds=152))
+    assert messages(search(path, window)) == ["event 150", "event 151", "event 152"]
+    assert messages(tail(path, 10, window)) == ["event 150", "event 151", "event 152"]
+
+    found = list(search(path, LogFilter(resource_id="7", until=START + timedelta(seconds=120))))
+    assert messages(found) == [f"event {i}" for i in (7, 17, 27, 37, 47, 57, 67, 77, 87, 97, 107, 117)]
+    assert messages(search(path, LogFilter(text="EVENT 19"))) == ["event 19"] + [f"event {i}" for i in range(190, 200)]
+
+
+def test_time_search_with_untimed_lines(tmp_path):
+    """Строки traceback без времени не сдвигают двоичный поиск за подходящую запись"""
+    traceback = "".join(f'  File "app/routes/webhook.py", line {n}, in process\n' for n in range(10))
+    lines = [
+        "2025-03-14 10:00:00,000 - app.routes.webhook - INFO - first\n",
+        "2025-03-14 10:00:05,000 - app.routes.webhook - ERROR - failed\n",
+        traceback,
+        "2025-03-14 10:00:09,000 - app.routes.webhook - INFO - last\n",
+    ]
+    path = tmp_path / "errors.log"
+    path.write_text("".join(lines), encoding="utf-8")
+
+    with open(path, "rb") as stream, mmap.mmap(stream.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+        for second in range(1, 6):
+            assert _offset_for_time(mapped, datetime(2025, 3, 14, 10, 0, second)) == len(lines[0])
+        assert _offset_for_time(mapped, datetime(2025, 3, 14, 10, 0, 6)) == len("".join(lines[:3]))
+
+    since = LogFilter(since=datetime(2025, 3, 14, 10, 0, 1))
+    assert messages(search(str(path), since))[0] == "failed"
+    until = LogFilter(until=datetime(2025, 3, 14, 10, 0, 6))
+    assert "failed" in messages(tail(str(path), 20, until))
+    assert "last" not in messages(tail(str(path), 20, until))
+
+
+if __name__ == "__main__":
+    import pytest
+    sys.exit(pytest.main([__file__, "-q"]))
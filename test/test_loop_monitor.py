@@ -0,0 +1,46 @@
+#!/usr/bin/env python3
+"""
+Тест сторожа event loop (app/services/loop_monitor.py)
+"""
+
+import asyncio
+import logging
+import os
+import sys
+import time
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.services.loop_monitor import LoopMonitor, loop_stalls
+
+
+def blocking_call():
+    time.sleep(0.4)
+
+
+def test_blocking_call_is_reported_with_stack(caplog):
+    async def scenario():
+        monitor = LoopMonitor()
+        monitor.enabled = True
+        monitor.interval = 0.05
+        monitor.threshold = 0.15
+        await monitor.start()
+        await asyncio.sleep(0.1)
+        blocking_call()
+        await asyncio.sleep(0.1)
+        await monitor.stop()
+
+    stalls_before = loop_stalls._values[()]
+    with caplog.at_level(logging.WARNING, logger="app.loop_monitor"):
+        asyncio.run(scenario())
+
+    assert loop_stalls._values[()] == stalls_before + 1
+    blocked = [record.getMessage() for record in caplog.records if "loop thread stack" in record.getMessage()]
+    assert len(blocked) == 1
+    assert "in blocking_call" in blocked[0]
+    assert any("resumed" in record.getMessage() for record in caplog.records)
+
+
+if __name__ == "__main__":
+    import pytest
+    sys.exit(pytest.main([__file__, "-q"]))
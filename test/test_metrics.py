@@ -0,0 +1,42 @@
+#!/usr/bin/env python3
+"""
+Тесты метрик в формате Prometheus (app/services/metrics.py)
+"""
+
+import os
+import sys
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.services.metrics import Counter, Histogram, MetricsRegistry
+
+
+def test_histogram_buckets_are_cumulative():
+    registry = MetricsRegistry()
+    histogram = registry.register(Histogram("stage_seconds", "Stage duration", ("stage",), buckets=(0.1, 1.0)))
+    histogram.observe(0.05, stage="parse")
+    histogram.observe(0.5, stage="parse")
+    histogram.observe(3, stage="parse")
+
+    lines = registry.render().splitlines()
+    assert "# TYPE stage_seconds histogram" in lines
+    assert 'stage_seconds_bucket{stage="parse",le="0.1"} 1' in lines
+    assert 'stage_seconds_bucket{stage="parse",le="1"} 2' in lines
+    assert 'stage_seconds_bucket{stage="parse",le="+Inf"} 3' in lines
+    assert 'stage_seconds_count{stage="parse"} 3' in lines
+    assert 'stage_seconds_sum{stage="parse"} 3.550000' in lines
+
+
+def test_counter_labels_are_escaped():
+    registry = MetricsRegistry()
+    counter = registry.register(Counter("errors_total", "Errors", ("code",)))
+    counter.inc(code='say "hi"')
+    counter.inc(code='say "hi"')
+
+    assert 'errors_total{code="say \\"hi\\""} 2' in registry.render().splitlines()
+
+
+if __name__ == "__main__":
+    test_histogram_buckets_are_cumulative()
+    test_counter_labels_are_escaped()
+    print("✅ Все тесты метрик пройдены")
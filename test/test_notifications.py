@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+"""
+Тесты очереди уведомлений Telegram (app/services/notifications.py)
+"""
+
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import httpx
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.services.notifications import TELEGRAM_API_URL, TelegramNotifier
+
+
+def make_notifier(handler):
+    notifier = TelegramNotifier()
+    notifier.enabled = True
+    notifier.bot_token = "test-token"
+    notifier.batch_delay = 0.05
+    notifier.dedup_window = 0.3
+    notifier.min_interval = 0.01
+    notifier.outbox_file = None
+    # Ответы Telegram подставляет транспорт httpx, сеть не нужна
+    notifier._client = httpx.AsyncClient(base_url=TELEGRAM_API_URL, transport=httpx.MockTransport(handler))
+    return notifier
+
+
+def test_duplicates_are_suppressed_and_batched():
+    sent = []
+
+    def handler(request):
+        sent.append(json.loads(request.content)["text"])
+        return httpx.Response(200, json={"ok": True})
+
+    async def scenario():
+        notifier = make_notifier(handler)
+        notifier._task = asyncio.create_task(notifier._run())
+        started = time.perf_counter()
+        assert notifier.notify("Token expired", {"cashbox_id": "SWK1"})
+        assert not notifier.notify("Token expired", {"cashbox_id": "SWK1"})
+        assert not notifier.notify("Token expired", {"cashbox_id": "SWK1"})
+        assert notifier.notify("Shift <24h> exceeded", {"cashbox_id": "SWK1"})
+        assert time.perf_counter() - started < 0.01  # notify не ждет Telegram
+        await asyncio.sleep(0.2)
+        assert len(sent) == 1
+        assert "ОШИБКИ WEBKASSA (2)" in sent[0]
+        assert "Shift &lt;24h&gt; exceeded" in sent[0]
+
+        # После окна дедупликации повтор отправляется с числом подавленных копий
+        await asyncio.sleep(0.2)
+        assert notifier.notify("Token expired", {"cashbox_id": "SWK1"})
+        await asyncio.sleep(0.2)
+        assert len(sent) == 2
+        assert "Повторялось еще 2 раз(а)" in sent[1]
+        await notifier.stop()
+
+    asyncio.run(scenario())
+
+
+def test_dedup_key_ignores_per_request_details():
+    async def scenario():
+        notifier = make_notifier(lambda request: httpx.Response(200, json={"ok": True}))
+        for check_number in range(5):
+            notifier.notify(
+                "Token expired",
+                {"Касса": "SWK1", "Номер чека": str(check_number)},
+                dedup_key="token_expired:SWK1",
+            )
+        notifier.notify("Token expired", {"Касса": "SWK2"}, dedup_key="token_expired:SWK2")
+        assert notifier.queue_depth == 2
+        await notifier.stop()
+
+    asyncio.run(scenario())
+
+
+def test_sent_messages_are_not_saved_to_outbox():
+    sent = []
+
+    async def handler(request):
+        sent.append(request)
+        if len(sent) > 1:
+            await asyncio.sleep(10)  # второе сообщение "зависло" до остановки
+        return httpx.Response(200, json={"ok": True})
+
+    with tempfile.TemporaryDirectory() as tmp:
+        outbox = Path(tmp) / "outbox.jsonl"
+
+        async def scenario():
+            notifier = make_notifier(handler)
+            notifier.outbox_file = outbox
+            notifier._task = asyncio.create_task(notifier._run())
+            # Каждое уведомление почти на весь лимит - в одно сообщение два не войдут
+            long_details = {f"field {n}": "x" * 400 for n in range(8)}
+            notifier.notify("First", long_details)
+            notifier.notify("Second", long_details)
+            await asyncio.sleep(0.2)
+            assert len(sent) == 2
+            await notifier.stop()
+
+        asyncio.run(scenario())
+        saved = [json.loads(line)["message"] for line in outbox.read_text(encoding="utf-8").splitlines()]
+        assert saved == ["Second"]
+
+
+def test_rate_limit_retry_after_is_respected():
+    attempts = []
+
+    def handler(request):
+        attempts.append(time.monotonic())
+        if len(attempts) == 1:
+            return httpx.Response(429, json={"ok": False, "parameters": {"retry_after": 0.2}})
+        return httpx.Response(200, json={"ok": True})
+
+    async def scenario():
+        notifier = make_notifier(handler)
+        assert await notifier._send("test")
+        assert len(attempts) == 2
+        assert attempts[1] - attempts[0] >= 0.2
+        await notifier.stop()
+
+    asyncio.run(scenario())
+
+
+def test_unsent_notifications_survive_restart():
+    with tempfile.TemporaryDirectory() as tmp:
+        outbox = os.path.join(tmp, "outbox.jsonl")
+
+        async def shutdown_with_pending():
+            notifier = make_notifier(lambda request: httpx.Response(200, json={"ok": True}))
+            notifier.outbox_file = Path(outbox)
+            notifier.notify("Webkassa unavailable", {"status": 503})
+            await notifier.stop()
+
+        asyncio.run(shutdown_with_pending())
+        assert os.path.exists(outbox)
+
+        notifier = TelegramNotifier()
+        notifier.outbox_file = Path(outbox)
+        loaded = notifier._load_outbox()
+        assert [n.message for n in loaded] == ["Webkassa unavailable"]
+        assert loaded[0].details == {"status": 503}
+        assert not os.path.exists(outbox)
+
+
+def test_disabled_without_bot_token():
+    saved = os.environ.pop("TELEGRAM_BOT_TOKEN", None)
+    try:
+        notifier = TelegramNotifier()
+    finally:
+        if saved is not None:
+            os.environ["TELEGRAM_BOT_TOKEN"] = saved
+    assert not notifier.enabled
+    assert not notifier.notify("Token expired")
+    assert notifier.queue_depth == 0
+
+
+if __name__ == "__main__":
+    test_duplicates_are_suppressed_and_batched()
+    test_dedup_key_ignores_per_request_details()
+    test_sent_messages_are_not_saved_to_outbox()
+    test_rate_limit_retry_after_is_respected()
+    test_unsent_notifications_survive_restart()
+    test_disabled_without_bot_token()
+    print("✅ Все тесты уведомлений пройдены")
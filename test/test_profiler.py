@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+"""
+Тесты статистического профилировщика (app/services/profiler.py)
+"""
+
+import asyncio
+import os
+import sys
+import time
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.services.profiler import SlowWebhookProfiler, capture_profile
+
+
+def busy_function(seconds):
+    deadline = time.perf_counter() + seconds
+    while time.perf_counter() < deadline:
+        sum(range(1000))
+
+
+async def profile_busy_loop():
+    capture = asyncio.create_task(capture_profile(0.3, interval=0.005))
+    await asyncio.sleep(0.01)
+    busy_function(0.3)
+    return await capture
+
+
+def test_capture_collapsed_and_speedscope():
+    profile = asyncio.run(profile_busy_loop())
+
+    collapsed = profile.to_collapsed().splitlines()
+    busy = [line for line in collapsed if ";busy_function (" in line]
+    assert busy
+    assert all(line.rsplit(" ", 1)[1].isdigit() for line in collapsed)
+    # Большая часть выборок пришлась на занятый цикл
+    assert sum(int(line.rsplit(" ", 1)[1]) for line in busy) > len(profile.samples) / 2
+
+    speedscope = profile.to_speedscope()
+    frames = speedscope["shared"]["frames"]
+    sampled = speedscope["profiles"][0]
+    assert sampled["type"] == "sampled"
+    assert len(sampled["samples"]) == len(sampled["weights"]) == len(profile.samples)
+    assert any(frame["name"] == "busy_function" for frame in frames)
+    assert all(0 <= index < len(frames) for sample in sampled["samples"] for index in sample)
+
+
+def test_slow_webhook_profile_contains_only_own_task(tmp_path):
+    profiler = SlowWebhookProfiler()
+    profiler.enabled = True
+    profiler.threshold = 0.1
+    profiler.interval = 0.002
+    profiler.directory = tmp_path
+
+    async def slow_webhook():
+        started = time.monotonic()
+        busy_function(0.15)
+        await profiler.webhook_finished(started, "record_1")
+
+    async def other_task():
+        busy_function(0.1)
+
+    async def scenario():
+        await profiler.start()
+        await asyncio.gather(other_task(), slow_webhook())
+        await profiler.stop()
+
+    asyncio.run(scenario())
+
+    saved = profiler.list_profiles()
+    assert len(saved) == 1 and saved[0]["name"].endswith("_record_1.collapsed")
+    content = profiler.profile_path(saved[0]["name"]).read_text(encoding="utf-8")
+    assert "slow_webhook" in content
+    assert "other_task" not in content
+    assert profiler.profile_path("../" + saved[0]["name"]) is None
+
+
+if __name__ == "__main__":
+    import pytest
+    sys.exit(pytest.main([__file__, "-q"]))
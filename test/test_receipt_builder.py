@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+"""
+Тесты сборки чека Webkassa (app/services/receipt_builder.py)
+"""
+
+import copy
+import os
+import sys
+from decimal import Decimal
+
+import pytest
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.schemas.altegio import AltegioWebhookPayload
+from app.services.receipt_builder import ACQUIRING_COMMISSION_COMMENT, ReceiptMismatchError, build_receipt
+
+EXAMPLE = AltegioWebhookPayload.model_config["json_schema_extra"]["example"]
+
+
+def make_payload(resource="record", services=None, goods=None) -> AltegioWebhookPayload:
+    data = copy.deepcopy(EXAMPLE)
+    data["resource"] = resource
+    if services is not None:
+        data["data"]["services"] = services
+    if goods is not None:
+        data["data"]["goods_transactions"] = goods
+    return AltegioWebhookPayload(**data)
+
+
+def service(cost_per_unit, cost_to_pay, amount=1, title="Стрижка"):
+    return {
+        "id": 1, "title": title, "cost": cost_to_pay, "cost_to_pay": cost_to_pay, "manual_cost": cost_to_pay,
+        "cost_per_unit": cost_per_unit, "discount": 0, "first_cost": cost_per_unit, "amount": amount
+    }
+
+
+def test_record_with_discount_and_payments():
+    """Услуга со скидкой, наличный и безналичный платежи, комиссия эквайринга пропускается"""
+    payload = make_payload(services=[service(4000, 3600, amount=1)])
+    document = {"data": [
+        {"amount": 1600, "comment": "", "account": {"is_cash": True, "title": "Касса"}},
+        {"amount": 2000, "comment": "", "account": {"is_cash": False, "title": "Kaspi"}},
+        {"amount": 40, "comment": ACQUIRING_COMMISSION_COMMENT, "account": {"is_cash": False}},
+        {"amount": -100, "comment": "", "account": {"is_cash": True}},
+    ]}
+
+    receipt = build_receipt(payload, document, "CB-1")
+
+    assert receipt["CashboxUniqueNumber"] == "CB-1"
+    assert receipt["ExternalCheckNumber"] == payload.data.id
+    assert receipt["CustomerPhone"] == "+77770220606"
+    assert receipt["Positions"] == [{
+        "Count": 1, "Price": 4000.0, "PositionName": "Стрижка", "Discount": 400.0,
+        "Tax": "0", "TaxType": "0", "TaxPercent": "0"
+    }]
+    assert receipt["Payments"] == [{"Sum": 1600.0, "PaymentType": 0}, {"Sum": 2000.0, "PaymentType": 1}]
+
+
+def test_record_goods_and_default_payment():
+    """Товары из goods_transactions; без платежей в документе используется сумма позиций картой"""
+    goods = [{"title": "Шампунь", "amount": -2, "cost_per_unit": 1500, "discount": 10}]
+    payload = make_payload(services=[service(4000, 4000)], goods=goods)
+
+    receipt = build_receipt(payload, [], "CB-1")
+
+    assert [p["PositionName"] for p in receipt["Positions"]] == ["Стрижка", "Шампунь"]
+    assert receipt["Positions"][1]["Count"] == 2
+    assert receipt["Positions"][1]["Discount"] == 300.0
+    assert receipt["Payments"] == [{"Sum": 6700.0, "PaymentType": 1}]
+
+
+def test_goods_sale_document():
+    """Продажа товаров: позиции из state.items, платежи из state.payment_transactions"""
+    payload = make_payload(resource="goods_operations_sale", services=[])
+    document = {"data": {"state": {
+        "items": [{"title": "Воск", "amount": -1, "default_cost_per_unit": 5000, "cost_to_pay_total": 4500}],
+        "payment_transactions": [{"amount": 4500, "comment": "", "account": {"is_cash": False}}],
+    }}}
+
+    receipt = build_receipt(payload, document, "CB-2")
+
+    assert receipt["Positions"][0]["PositionName"] == "Воск"
+    assert receipt["Positions"][0]["Discount"] == 500.0
+    assert receipt["Payments"] == [{"Sum": 4500.0, "PaymentType": 1}]
+
+
+def test_explicit_sources():
+    """Источники позиций и платежей можно выбрать явно"""
+    payload = make_payload(services=[service(4000, 4000)])
+    document = {"data": {"state": {
+        "items": [{"title": "Воск", "amount": 1, "default_cost_per_unit": 5000, "cost_to_pay_total": 5000}],
+        "payment_transactions": [],
+    }}}
+
+    receipt = build_receipt(payload, document, "CB-1", position_sources=["services", "sale_items"])
+
+    assert len(receipt["Positions"]) == 2
+    assert receipt["Payments"] == [{"Sum": 9000.0, "PaymentType": 1}]
+
+
+def test_exact_money_arithmetic():
+    """Копеечные суммы складываются точно, в чеке остаются float"""
+    payload = make_payload(services=[service(0.1, 0.1), service(0.2, 0.2, title="Укладка")])
+    document = {"data": [{"amount": 0.3, "comment": "", "account": {"is_cash": True}}]}
+
+    receipt = build_receipt(payload, document, "CB-1")
+
+    assert receipt["Payments"] == [{"Sum": 0.3, "PaymentType": 0}]
+    assert all(isinstance(p["Price"], float) and isinstance(p["Discount"], float) for p in receipt["Positions"])
+
+
+def test_totals_mismatch_detected_before_send():
+    """Если платежи не сходятся с позициями, чек не собирается"""
+    payload = make_payload(services=[service(4000, 3600)])
+    document = {"data": [{"amount": 3599.99, "comment": "", "account": {"is_cash": False}}]}
+
+    with pytest.raises(ReceiptMismatchError) as error:
+        build_receipt(payload, document, "CB-1")
+
+    assert error.value.positions_total == Decimal("3600.00")
+    assert error.value.payments_total == Decimal("3599.99")
+    assert build_receipt(payload, document, "CB-1", check_totals=False)["Payments"][0]["Sum"] == 3599.99
+
+
+if __name__ == "__main__":
+    test_record_with_discount_and_payments()
+    test_record_goods_and_default_payment()
+    test_goods_sale_document()
+    test_explicit_sources()
+    test_exact_money_arithmetic()
+    test_totals_mismatch_detected_before_send()
+    print("✅ Все тесты сборки чека пройдены")
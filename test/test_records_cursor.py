@@ -0,0 +1,32 @@
+#!/usr/bin/env python3
+"""
+Тесты курсора пагинации /api/webhook/records
+"""
+
+import os
+import sys
+from datetime import datetime
+
+import pytest
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.routes.webhook import decode_records_cursor, encode_records_cursor
+
+
+def test_cursor_round_trip():
+    created_at = datetime(2025, 3, 14, 9, 26, 53, 589793)
+    cursor = encode_records_cursor(created_at, 1234567)
+    assert "=" not in cursor
+    assert decode_records_cursor(cursor) == (created_at, 1234567)
+
+
+def test_invalid_cursor():
+    for cursor in ("", "not-a-cursor", encode_records_cursor(datetime(2025, 1, 1), 1)[:-3]):
+        with pytest.raises(ValueError):
+            decode_records_cursor(cursor)
+
+
+if __name__ == "__main__":
+    test_cursor_round_trip()
+    test_invalid_cursor()
+    print("✅ Все тесты курсора пройдены")
@@ -0,0 +1,45 @@
+#!/usr/bin/env python3
+"""
+Тесты расчета месяцев секций и архивации (app/services/retention.py)
+"""
+
+import os
+import sys
+from datetime import datetime
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.services.retention import RetentionManager, add_months, months_to_archive, partition_name
+
+
+def test_add_months_crosses_year_boundaries():
+    assert add_months(datetime(2025, 11, 17, 13, 45), 1) == datetime(2025, 12, 1)
+    assert add_months(datetime(2025, 11, 17), 2) == datetime(2026, 1, 1)
+    assert add_months(datetime(2025, 1, 31), -1) == datetime(2024, 12, 1)
+    assert add_months(datetime(2025, 3, 1), -15) == datetime(2023, 12, 1)
+    assert add_months(datetime(2025, 3, 1), 0) == datetime(2025, 3, 1)
+    assert partition_name("webhook_records", datetime(2025, 3, 1)) == "webhook_records_p2025_03"
+
+
+def test_cutoff_is_start_of_month_retention_months_ago():
+    manager = RetentionManager()
+    manager.retention_months = 12
+    assert manager.cutoff(datetime(2026, 10, 19, 8, 30)) == datetime(2025, 10, 1)
+    manager.retention_months = 1
+    assert manager.cutoff(datetime(2026, 1, 5)) == datetime(2025, 12, 1)
+
+
+def test_only_months_entirely_before_cutoff_are_archived():
+    months = [datetime(2025, month, 1) for month in range(8, 13)]
+    cutoff = datetime(2025, 10, 1)
+    # Сентябрь кончается ровно на cutoff - архивируется, октябрь - еще нет
+    assert months_to_archive(months, cutoff) == [datetime(2025, 8, 1), datetime(2025, 9, 1)]
+    assert months_to_archive(months, datetime(2025, 8, 1)) == []
+    assert months_to_archive([], cutoff) == []
+
+
+if __name__ == "__main__":
+    test_add_months_crosses_year_boundaries()
+    test_cutoff_is_start_of_month_retention_months_ago()
+    test_only_months_entirely_before_cutoff_are_archived()
+    print("✅ Все тесты архивации пройдены")
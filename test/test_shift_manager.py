@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+"""
+Тесты расписания закрытия смен (app/services/shift_manager.py)
+"""
+
+import os
+import sys
+import time
+from datetime import datetime, timedelta
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.models import CashboxShift
+from app.services.shift_manager import ShiftManager, ShiftState
+
+NOW = datetime(2026, 10, 19, 12, 0)
+
+
+def make_manager(close_time=None):
+    manager = ShiftManager()
+    manager.max_age = timedelta(hours=23)
+    manager.force_age = timedelta(hours=23, minutes=45)
+    manager.idle_seconds = 120
+    manager.close_time = close_time
+    manager.utc_offset = timedelta(hours=5)
+    return manager
+
+
+def make_state(age_hours, idle_seconds=600, shift_number=7):
+    state = ShiftState("SWK1", "Webkassa", shift_number, NOW - timedelta(hours=age_hours))
+    state.last_check_at = time.monotonic() - idle_seconds
+    return state
+
+
+def test_old_shift_closes_only_when_cashbox_is_idle():
+    manager = make_manager()
+    assert manager.is_due(make_state(23.2), NOW)
+    assert not manager.is_due(make_state(23.2, idle_seconds=30), NOW)  # касса только что пробила чек
+    assert not manager.is_due(make_state(10), NOW)
+    # У самого лимита смена закрывается и без простоя
+    assert manager.is_due(make_state(23.8, idle_seconds=0), NOW)
+
+
+def test_in_flight_and_retry_after_block_close():
+    manager = make_manager()
+    state = make_state(23.9)
+    state.in_flight = 1
+    assert not manager.is_due(state, NOW)
+
+    state = make_state(23.9)
+    state.retry_after = time.monotonic() + 60
+    assert not manager.is_due(state, NOW)
+    state.retry_after = time.monotonic() - 1
+    assert manager.is_due(state, NOW)
+
+
+def test_unknown_shift_is_never_due():
+    manager = make_manager()
+    assert not manager.is_due(make_state(30, shift_number=None), NOW)
+    state = make_state(30)
+    state.opened_at = None
+    assert not manager.is_due(state, NOW)
+
+
+def test_scheduled_close_time():
+    # 03:00 по времени кассы (UTC+5) = 22:00 UTC предыдущего дня
+    manager = make_manager(close_time=(3, 0))
+    opened_before_schedule = ShiftState("SWK1", "Webkassa", 7, datetime(2026, 10, 18, 21, 0))
+    opened_before_schedule.last_check_at = time.monotonic() - 600
+    assert manager.is_due(opened_before_schedule, NOW)
+
+    opened_after_schedule = ShiftState("SWK1", "Webkassa", 7, datetime(2026, 10, 18, 23, 0))
+    opened_after_schedule.last_check_at = time.monotonic() - 600
+    assert not manager.is_due(opened_after_schedule, NOW)
+
+
+def test_seed_restores_open_shifts_after_restart():
+    manager = make_manager()
+    manager.seed([
+        CashboxShift(cashbox_id="SWK1", service_name="Webkassa", shift_number=7,
+                     opened_at=NOW - timedelta(hours=23.5)),
+        CashboxShift(cashbox_id="SWK2", service_name="Webkassa", shift_number=None, opened_at=None),
+    ])
+    assert manager.is_due(manager._shifts["SWK1"], NOW)
+    assert not manager.is_due(manager._shifts["SWK2"], NOW)
+
+    # Смена, уже учтенная воркером по чеку, не затирается строкой из БД
+    manager._shifts["SWK2"].shift_number = 3
+    manager._shifts["SWK2"].opened_at = NOW
+    manager.seed([
+        CashboxShift(cashbox_id="SWK2", service_name="Webkassa", shift_number=2, opened_at=NOW - timedelta(days=1)),
+    ])
+    assert manager._shifts["SWK2"].shift_number == 3
+
+
+if __name__ == "__main__":
+    test_old_shift_closes_only_when_cashbox_is_idle()
+    test_in_flight_and_retry_after_block_close()
+    test_unknown_shift_is_never_due()
+    test_scheduled_close_time()
+    test_seed_restores_open_shifts_after_restart()
+    print("✅ Все тесты закрытия смен пройдены")
@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+"""
+Тесты паролей арендаторов Webkassa (app/models.py WebkassaTenant, app/services/tenants.py)
+"""
+
+import os
+import sys
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.models import WebkassaTenant
+from app.services.tenants import tenant_from_record
+
+
+def make_record(**fields):
+    fields.setdefault("company_id", 307626)
+    fields.setdefault("webkassa_login", "login@example.kz")
+    fields.setdefault("cashbox_id", "SWK00000001")
+    return WebkassaTenant(**fields)
+
+
+def test_password_is_read_from_env():
+    os.environ["WEBKASSA_PASSWORD_TEST_TENANT"] = "secret"
+    try:
+        record = make_record(webkassa_password_env="WEBKASSA_PASSWORD_TEST_TENANT")
+        tenant = tenant_from_record(record)
+    finally:
+        del os.environ["WEBKASSA_PASSWORD_TEST_TENANT"]
+    assert tenant.password == "secret"
+    assert tenant.service_name == "Webkassa:307626"
+
+
+def test_env_name_defaults_to_company_id():
+    record = make_record(company_id=1)
+    assert record.password_env == "WEBKASSA_PASSWORD_1"
+    os.environ["WEBKASSA_PASSWORD_1"] = "from-env"
+    try:
+        assert record.password == "from-env"
+    finally:
+        del os.environ["WEBKASSA_PASSWORD_1"]
+
+
+def test_legacy_plaintext_is_used_until_moved_to_env():
+    record = make_record(webkassa_password_env="WEBKASSA_PASSWORD_TEST_MISSING", webkassa_password="legacy")
+    assert tenant_from_record(record).password == "legacy"
+
+    os.environ["WEBKASSA_PASSWORD_TEST_MISSING"] = "from-env"
+    try:
+        assert tenant_from_record(record).password == "from-env"
+    finally:
+        del os.environ["WEBKASSA_PASSWORD_TEST_MISSING"]
+
+
+if __name__ == "__main__":
+    test_password_is_read_from_env()
+    test_env_name_defaults_to_company_id()
+    test_legacy_plaintext_is_used_until_moved_to_env()
+    print("✅ Все тесты арендаторов пройдены")
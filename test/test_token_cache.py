@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+"""
+Тесты кэша токенов Webkassa (app/services/token_cache.py)
+"""
+
+import asyncio
+import os
+import sys
+from datetime import datetime, timedelta
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.models import ApiKey
+from app.services.token_cache import WebkassaTokenCache
+
+SERVICE = "Webkassa"
+NOW = datetime(2026, 10, 19, 12, 0)
+
+
+def make_key(token, updated_at=NOW):
+    return ApiKey(id=1, service_name=SERVICE, api_key=token, user_id="user", created_at=NOW, updated_at=updated_at)
+
+
+class ListenerConnection:
+    """Соединение слушателя: кэшу достаточно, что оно открыто"""
+
+    def is_closed(self):
+        return False
+
+
+class LockConnection:
+    """Соединение для advisory lock: ответы pg_try_advisory_lock задаются списком"""
+
+    def __init__(self, try_lock_results, db_token):
+        self.try_lock_results = list(try_lock_results)
+        self.db_token = db_token
+
+    async def fetchval(self, query, *args):
+        return self.try_lock_results.pop(0)
+
+    async def fetchrow(self, query, *args):
+        return {"id": 1, "service_name": SERVICE, "api_key": self.db_token, "user_id": "user",
+                "created_at": NOW, "updated_at": NOW}
+
+    async def execute(self, query, *args):
+        pass
+
+    async def close(self):
+        pass
+
+
+def make_cache(lock_connection):
+    cache = WebkassaTokenCache()
+    cache._connection = ListenerConnection()
+
+    async def open_lock_connection():
+        return lock_connection
+
+    cache._open_lock_connection = open_lock_connection
+    return cache
+
+
+def test_put_keeps_newest_and_wakes_only_on_rotation():
+    cache = make_cache(None)
+    cache.put(make_key("new", NOW))
+    cache.put(make_key("old", NOW - timedelta(minutes=5)))
+    assert cache.get(SERVICE).api_key == "new"
+
+    event = asyncio.Event()
+    cache._rotation_events[SERVICE] = ("new", event)
+    cache.put(make_key("new", NOW + timedelta(seconds=1)))  # перечитали тот же токен из БД
+    assert not event.is_set()
+    cache.put(make_key("rotated", NOW + timedelta(seconds=2)))
+    assert event.is_set()
+    assert SERVICE not in cache._rotation_events
+
+
+def test_waiter_gets_token_rotated_by_another_worker():
+    calls = []
+
+    async def refresher():
+        calls.append(1)
+        return make_key("mine")
+
+    async def scenario():
+        cache = make_cache(LockConnection([False], db_token="stale"))
+        asyncio.get_running_loop().call_later(0.05, cache.put, make_key("rotated", NOW + timedelta(seconds=1)))
+        result = await cache.refresh_once("stale", refresher, service_name=SERVICE, wait_timeout=1)
+        assert result.api_key == "rotated"
+        assert calls == []
+
+    asyncio.run(scenario())
+
+
+def test_timeout_takes_over_refresh_instead_of_returning_stale_token():
+    async def refresher():
+        return make_key("mine")
+
+    async def scenario():
+        cache = make_cache(LockConnection([False, True], db_token="stale"))
+        cache.put(make_key("stale"))
+        # Чтение того же устаревшего токена не должно разбудить ожидание
+        asyncio.get_running_loop().call_later(0.02, cache.put, make_key("stale", NOW + timedelta(seconds=1)))
+        result = await cache.refresh_once("stale", refresher, service_name=SERVICE, wait_timeout=0.1)
+        assert result.api_key == "mine"
+
+    asyncio.run(scenario())
+
+
+def test_timeout_while_lock_still_held_returns_none():
+    async def refresher():
+        raise AssertionError("refresh must not run while another worker holds the lock")
+
+    async def scenario():
+        cache = make_cache(LockConnection([False, False], db_token="stale"))
+        cache.put(make_key("stale"))
+        assert await cache.refresh_once("stale", refresher, service_name=SERVICE, wait_timeout=0.05) is None
+
+    asyncio.run(scenario())
+
+
+if __name__ == "__main__":
+    test_put_keeps_newest_and_wakes_only_on_rotation()
+    test_waiter_gets_token_rotated_by_another_worker()
+    test_timeout_takes_over_refresh_instead_of_returning_stale_token()
+    test_timeout_while_lock_still_held_returns_none()
+    print("✅ Все тесты кэша токенов пройдены")
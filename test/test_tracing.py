@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+"""
+Тесты трассировки (app/services/tracing.py)
+"""
+
+import os
+import sys
+
+import pytest
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.logging_config import get_log_context
+from app.services import tracing
+from app.services.tracing import STATUS_ERROR, current_trace_id, start_span
+
+
+@pytest.fixture
+def exported(monkeypatch):
+    traces = []
+    monkeypatch.setattr(tracing.exporter, "export", lambda spans: traces.append(list(spans)))
+    return traces
+
+
+def test_child_spans_share_trace_and_correlation_id(exported):
+    with start_span("webhook", resource_id=1) as root:
+        assert get_log_context()["correlation_id"] == root.trace_id
+        with start_span("altegio_fetch") as child:
+            assert current_trace_id() == root.trace_id
+    assert current_trace_id() is None
+
+    assert len(exported) == 1
+    spans = [span.to_otlp() for span in exported[0]]
+    assert [span["name"] for span in spans] == ["webhook", "altegio_fetch"]
+    assert spans[1]["parentSpanId"] == root.span_id
+    assert "parentSpanId" not in spans[0]
+    assert spans[0]["attributes"] == [{"key": "resource_id", "value": {"intValue": "1"}}]
+
+
+def test_traceparent_continues_external_trace(exported):
+    traceparent = "00-" + "ab" * 16 + "-" + "cd" * 8 + "-01"
+    with start_span("webhook", traceparent=traceparent) as root:
+        pass
+    assert root.trace_id == "ab" * 16
+    assert root.parent_span_id == "cd" * 8
+
+
+def test_exception_marks_span_as_error(exported):
+    with pytest.raises(ValueError):
+        with start_span("webkassa_send"):
+            raise ValueError("boom")
+    assert exported[0][0].status_code == STATUS_ERROR
+    assert exported[0][0].status_message == "ValueError: boom"
+
+
+if __name__ == "__main__":
+    sys.exit(pytest.main([__file__, "-q"]))